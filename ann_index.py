@@ -0,0 +1,199 @@
+import os
+import math
+import pickle
+import logging
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+
+logger = logging.getLogger(__name__)
+
+# ----------------------------
+# Settings
+# ----------------------------
+# flat – точный перебор; hnsw – граф; ivfpq – кластеры + сжатие векторов (PQ)
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "flat").strip().lower()
+# До этого числа фрагментов индекс остаётся flat (точный и достаточно быстрый)
+FAISS_TRAIN_THRESHOLD = int(os.getenv("FAISS_TRAIN_THRESHOLD", "50000"))
+
+FAISS_HNSW_M = int(os.getenv("FAISS_HNSW_M", "32"))
+FAISS_EF_CONSTRUCTION = int(os.getenv("FAISS_EF_CONSTRUCTION", "80"))
+FAISS_EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", "64"))
+
+FAISS_IVF_NLIST = int(os.getenv("FAISS_IVF_NLIST", "0"))  # 0 – подобрать по размеру корпуса
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "16"))
+FAISS_PQ_M = int(os.getenv("FAISS_PQ_M", "0"))            # 0 – dim / 8
+FAISS_PQ_NBITS = int(os.getenv("FAISS_PQ_NBITS", "8"))
+
+FAISS_MMAP = os.getenv("FAISS_MMAP", "0") == "1"
+
+# PQ считает расстояния по сжатым векторам – они систематически отличаются от точных,
+# поэтому порог RAG_MAX_L2_DISTANCE калибруется для каждого типа отдельно.
+_DEFAULT_L2_SCALE = {"flat": 1.0, "hnsw": 1.0, "ivfpq": 1.1}
+
+def index_kind(index) -> str:
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivfpq"
+    return "flat"
+
+def max_l2_distance(base: float, kind: str) -> float:
+    """
+    Distance gate for the given index type: RAG_MAX_L2_DISTANCE_<TYPE> if set,
+    otherwise RAG_MAX_L2_DISTANCE scaled by the type's default factor.
+    """
+    override = os.getenv(f"RAG_MAX_L2_DISTANCE_{kind.upper()}")
+    if override:
+        return float(override)
+    return base * _DEFAULT_L2_SCALE.get(kind, 1.0)
+
+# ----------------------------
+# Building / tuning
+# ----------------------------
+def _pq_m(dim: int) -> int:
+    m = FAISS_PQ_M or max(1, dim // 8)
+    while dim % m:
+        m -= 1
+    return m
+
+def _nlist(n: int) -> int:
+    if FAISS_IVF_NLIST:
+        return FAISS_IVF_NLIST
+    return int(min(65536, max(16, 4 * math.sqrt(n))))
+
+def build_index(vectors: np.ndarray, kind: str):
+    """
+    Creates, trains (if needed) and fills an index of the given kind.
+    Positions follow the order of `vectors`.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, dim = vectors.shape
+    if kind == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, FAISS_HNSW_M)
+        index.hnsw.efConstruction = FAISS_EF_CONSTRUCTION
+    elif kind == "ivfpq":
+        nlist = min(_nlist(n), max(1, n // 39))  # faiss хочет ~39 точек на кластер
+        quantizer = faiss.IndexFlatL2(dim)
+        index = faiss.IndexIVFPQ(quantizer, dim, nlist, _pq_m(dim), FAISS_PQ_NBITS)
+        sample = vectors
+        if n > nlist * 256:
+            rng = np.random.default_rng(0)
+            sample = vectors[rng.choice(n, nlist * 256, replace=False)]
+        index.train(sample)
+    else:
+        index = faiss.IndexFlatL2(dim)
+    index.add(vectors)
+    apply_search_params(index)
+    return index
+
+def apply_search_params(index):
+    kind = index_kind(index)
+    if kind == "hnsw":
+        faiss.downcast_index(index).hnsw.efSearch = FAISS_EF_SEARCH
+    elif kind == "ivfpq":
+        faiss.extract_index_ivf(index).nprobe = FAISS_NPROBE
+
+def _all_vectors(index) -> np.ndarray:
+    return index.reconstruct_n(0, index.ntotal)
+
+def maybe_upgrade(store):
+    """
+    Switches a flat store to FAISS_INDEX_TYPE once it holds FAISS_TRAIN_THRESHOLD vectors.
+    The store is modified in place (it must not be visible to readers yet).
+    """
+    if FAISS_INDEX_TYPE == "flat" or index_kind(store.index) != "flat":
+        return store
+    if store.index.ntotal < FAISS_TRAIN_THRESHOLD:
+        return store
+    logger.info("Converting FAISS index (%d vectors) to %s", store.index.ntotal, FAISS_INDEX_TYPE)
+    store.index = build_index(_all_vectors(store.index), FAISS_INDEX_TYPE)
+    return store
+
+# ----------------------------
+# Operations that flat-only LangChain code can't do for HNSW / IVF-PQ
+# ----------------------------
+def merge_into(store, staging):
+    """
+    Appends a (flat) staging store to `store`, whatever the type of store.index.
+    """
+    if index_kind(store.index) == "flat":
+        store.merge_from(staging)
+        return store
+    vectors = _all_vectors(staging.index)
+    if index_kind(store.index) == "ivfpq":
+        # после remove_ids номера идут с пропусками – новые берём после наибольшего
+        offset = max(store.index_to_docstore_id, default=-1) + 1
+        store.index.add_with_ids(vectors, np.arange(offset, offset + len(vectors), dtype=np.int64))
+    else:
+        offset = store.index.ntotal
+        store.index.add(vectors)
+    for pos, chunk_id in staging.index_to_docstore_id.items():
+        store.index_to_docstore_id[offset + pos] = chunk_id
+        store.docstore.add({chunk_id: staging.docstore.search(chunk_id)})
+    return store
+
+def rebuild_without(store, chunk_ids):
+    """
+    Copy of an HNSW / IVF-PQ store without the given chunks (LangChain's delete()
+    only works for flat indexes). Nothing is re-encoded; `store` is not modified.
+    - IVF-PQ: the vectors are dropped with remove_ids, ids of the rest stay as they were
+    - HNSW can't remove vectors: the graph is rebuilt from the exact vectors it
+      stores (as a flat index below FAISS_TRAIN_THRESHOLD)
+    Returns None if no chunks remain.
+    """
+    drop = set(chunk_ids)
+    kept = [(pos, chunk_id) for pos, chunk_id in sorted(store.index_to_docstore_id.items()) if chunk_id not in drop]
+    if not kept:
+        return None
+    if index_kind(store.index) == "ivfpq":
+        index = faiss.clone_index(store.index)
+        removed = [pos for pos, chunk_id in store.index_to_docstore_id.items() if chunk_id in drop]
+        index.remove_ids(np.array(removed, dtype=np.int64))
+        apply_search_params(index)
+        index_to_docstore_id = dict(kept)
+    else:
+        positions = np.array([pos for pos, _chunk_id in kept], dtype=np.int64)
+        kind = "hnsw" if len(kept) >= FAISS_TRAIN_THRESHOLD else "flat"
+        index = build_index(_all_vectors(store.index)[positions], kind)
+        index_to_docstore_id = {i: chunk_id for i, (_pos, chunk_id) in enumerate(kept)}
+    return FAISS(
+        embedding_function=store.embedding_function,
+        index=index,
+        docstore=InMemoryDocstore({chunk_id: store.docstore.search(chunk_id) for _pos, chunk_id in kept}),
+        index_to_docstore_id=index_to_docstore_id,
+        distance_strategy=store.distance_strategy,
+    )
+
+def index_nbytes(index) -> int:
+    """
+    Approximate memory taken by the vectors of an index.
+    """
+    kind = index_kind(index)
+    if kind == "ivfpq":
+        return index.ntotal * (faiss.extract_index_ivf(index).code_size + 8)
+    vectors = index.ntotal * index.d * 4
+    if kind == "hnsw":
+        vectors += index.ntotal * FAISS_HNSW_M * 2 * 4  # рёбра графа
+    return vectors
+
+# ----------------------------
+# Loading
+# ----------------------------
+def load_store(index_dir: str, embeddings):
+    """
+    Same as FAISS.load_local, but applies search parameters and, with
+    FAISS_MMAP=1, memory-maps the index file instead of reading it into RAM.
+    """
+    if not FAISS_MMAP:
+        store = FAISS.load_local(index_dir, embeddings, allow_dangerous_deserialization=True)
+    else:
+        index = faiss.read_index(os.path.join(index_dir, "index.faiss"), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        with open(os.path.join(index_dir, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        store = FAISS(embeddings, index, docstore, index_to_docstore_id)
+    apply_search_params(store.index)
+    return store
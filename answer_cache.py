@@ -0,0 +1,117 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "1") == "1"
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))           # секунды
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "2000"))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))  # косинус
+
+class AnswerKey:
+    """
+    What an /askfile answer depends on: the tenant's index version,
+    the normalized question (plus its embedding for near-duplicates)
+    and the ids of the chunks retrieval returned.
+    """
+
+    def __init__(self, tenant, version: str, question: str, chunk_ids, embedding):
+        self.tenant = str(tenant)
+        self.version = version
+        self.question = question
+        self.chunk_ids = tuple(chunk_ids)
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(vec)) or 1.0
+        self.embedding = vec / norm
+
+    @property
+    def exact(self) -> tuple:
+        return (self.tenant, self.version, self.question, self.chunk_ids)
+
+    @property
+    def group(self) -> tuple:
+        return (self.tenant, self.version, self.chunk_ids)
+
+class AnswerCache:
+    """
+    In-memory LRU cache of RAG answers with TTL.
+    - Exact hit: same tenant, index version, normalized question and retrieved chunks
+    - Near-duplicate hit: same tenant / version / chunks and cosine similarity
+      of question embeddings >= ANSWER_CACHE_SIMILARITY
+    Entries of an older index version are never served and are dropped by invalidate().
+    """
+
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES, ttl: float = ANSWER_CACHE_TTL,
+                 similarity: float = ANSWER_CACHE_SIMILARITY):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self._entries = OrderedDict()  # exact key -> (key, answer, created_at)
+        self._groups = {}              # group -> set of exact keys
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "semantic_hits": 0, "misses": 0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _drop(self, exact: tuple):
+        key, _answer, _created = self._entries.pop(exact)
+        group = self._groups.get(key.group)
+        if group is not None:
+            group.discard(exact)
+            if not group:
+                del self._groups[key.group]
+
+    def get(self, key: AnswerKey) -> str | None:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key.exact)
+            if entry is not None and now - entry[2] <= self.ttl:
+                self._entries.move_to_end(key.exact)
+                self.stats["hits"] += 1
+                return entry[1]
+            if entry is not None:
+                self._drop(key.exact)
+
+            best, best_sim = None, self.similarity
+            for exact in list(self._groups.get(key.group, ())):
+                other, answer, created = self._entries[exact]
+                if now - created > self.ttl:
+                    self._drop(exact)
+                    continue
+                sim = float(np.dot(key.embedding, other.embedding))
+                if sim >= best_sim:
+                    best, best_sim = exact, sim
+            if best is not None:
+                self._entries.move_to_end(best)
+                self.stats["semantic_hits"] += 1
+                return self._entries[best][1]
+
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key: AnswerKey, answer: str):
+        with self._lock:
+            if key.exact in self._entries:
+                self._drop(key.exact)
+            self._entries[key.exact] = (key, answer, time.time())
+            self._groups.setdefault(key.group, set()).add(key.exact)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, tenant, keep_version: str | None = None):
+        """
+        Drops the tenant's entries (except those of `keep_version`).
+        """
+        tenant = str(tenant)
+        with self._lock:
+            stale = [e for e, (k, _a, _c) in self._entries.items() if k.tenant == tenant and k.version != keep_version]
+            for exact in stale:
+                self._drop(exact)
+        if stale:
+            logger.debug("Answer cache: dropped %d entries of tenant %s", len(stale), tenant)
@@ -0,0 +1,141 @@
+"""
+Batch Q&A: runs a checklist of questions against one chat's documents and
+writes a consolidated CSV report (question, status, answer, quoted pages).
+
+Questions come from a TXT file (one per line, lines starting with # are
+skipped) or a CSV file (the "question" / "вопрос" column, else the first one).
+Used by the bot's /batchask command and from the command line:
+
+    python batch_qa.py checklist.csv --tenant 123456789 --out report.csv
+"""
+import io
+import os
+import csv
+import time
+import asyncio
+import logging
+import argparse
+
+logger = logging.getLogger(__name__)
+
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "300"))
+QUESTION_COLUMNS = ("question", "questions", "вопрос", "вопросы")
+STATUS_LABELS = {"answered": "ответ", "refused": "нет в документах", "error": "ошибка"}
+REPORT_COLUMNS = ("№", "Вопрос", "Статус", "Ответ", "Источники", "Время LLM, с")
+
+# ----------------------------
+# Questions
+# ----------------------------
+def _decode(data: bytes) -> str:
+    try:
+        return data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return data.decode("cp1251", errors="replace")  # CSV из русского Excel
+
+def _csv_questions(text: str) -> list[str]:
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    rows = [row for row in csv.reader(io.StringIO(text), dialect) if any(cell.strip() for cell in row)]
+    if not rows:
+        return []
+    header = [cell.strip().lower() for cell in rows[0]]
+    column = next((header.index(name) for name in QUESTION_COLUMNS if name in header), None)
+    if column is None:
+        column = 0
+    else:
+        rows = rows[1:]
+    return [row[column].strip() for row in rows if len(row) > column and row[column].strip()]
+
+def parse_questions(data: bytes, filename: str) -> list[str]:
+    """
+    Questions from the contents of a TXT or CSV file, duplicates removed.
+    """
+    text = _decode(data)
+    if filename.lower().endswith(".csv"):
+        questions = _csv_questions(text)
+    else:
+        questions = [line.strip() for line in text.splitlines()]
+        questions = [q for q in questions if q and not q.startswith("#")]
+    return list(dict.fromkeys(questions))
+
+def read_questions(path: str) -> list[str]:
+    with open(path, "rb") as f:
+        return parse_questions(f.read(), path)
+
+# ----------------------------
+# Report
+# ----------------------------
+def report_rows(results: list[dict]):
+    yield REPORT_COLUMNS
+    for i, r in enumerate(results, 1):
+        sources = "; ".join(c.where() for c in r["citations"])
+        yield (i, r["question"], STATUS_LABELS.get(r["status"], r["status"]), r["answer"], sources, f"{r['seconds']:.1f}")
+
+def report_bytes(results: list[dict]) -> bytes:
+    """
+    CSV report; UTF-8 with BOM and ";" so that Excel opens it as is.
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf, delimiter=";")
+    writer.writerows(report_rows(results))
+    return buf.getvalue().encode("utf-8-sig")
+
+def summarize(results: list[dict], seconds: float) -> str:
+    counts = {status: 0 for status in STATUS_LABELS}
+    for r in results:
+        counts[r["status"]] = counts.get(r["status"], 0) + 1
+    return (
+        f"✅ Вопросов: {len(results)} за {seconds:.0f} с\n"
+        f"Ответов: {counts['answered']}, нет в документах: {counts['refused']}, ошибок: {counts['error']}"
+    )
+
+# ----------------------------
+# CLI
+# ----------------------------
+async def run(path: str, tenant: str, out: str, concurrency: int) -> int:
+    from pdf_handler import aquery_index_batch
+    from llm_client import aclose_client
+
+    questions = read_questions(path)
+    if not questions:
+        print(f"{path}: вопросы не найдены")
+        return 1
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        print(f"Вопросов {len(questions)}, обрабатываются первые {BATCH_MAX_QUESTIONS}")
+        questions = questions[:BATCH_MAX_QUESTIONS]
+
+    async def on_progress(done, total):
+        print(f"\r{done}/{total}", end="", flush=True)
+
+    t0 = time.perf_counter()
+    try:
+        results = await aquery_index_batch(questions, tenant=tenant, concurrency=concurrency, on_progress=on_progress)
+    finally:
+        await aclose_client()
+    print()
+    if results is None:
+        print(f"База знаний для {tenant} не найдена")
+        return 1
+    with open(out, "wb") as f:
+        f.write(report_bytes(results))
+    print(summarize(results, time.perf_counter() - t0))
+    print(f"Отчёт: {out}")
+    return 0
+
+def main(argv=None) -> int:
+    from pdf_handler import BATCH_CONCURRENCY
+    from index_manager import DEFAULT_TENANT
+
+    parser = argparse.ArgumentParser(description="Batch questions against indexed documents")
+    parser.add_argument("questions", help="TXT (one question per line) or CSV")
+    parser.add_argument("--tenant", default=DEFAULT_TENANT, help="chat id whose documents to use")
+    parser.add_argument("--out", default="batch_report.csv")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING"))
+    return asyncio.run(run(args.questions, args.tenant, args.out, args.concurrency))
+
+if __name__ == "__main__":
+    raise SystemExit(main())
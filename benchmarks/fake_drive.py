@@ -0,0 +1,305 @@
+"""
+In-memory stand-in for the Drive v3 service object returned by `build('drive', 'v3')`.
+Implements what gdrive_handler uses: files().list (with q / pagination),
+files().get_media (ranged downloads) and
+changes().getStartPageToken / changes().list.
+FakeDrive holds the data; FakeDrive.service() returns a client that, like a
+real one (httplib2.Http inside), may only be used from a single thread.
+
+    python -m benchmarks.fake_drive --files 200 --size-kb 512
+
+runs a full sync, a no-op sync, an incremental sync after edits and a
+resumed download against it and prints the timings as JSON.
+"""
+import re
+import os
+import json
+import time
+import random
+import hashlib
+import tempfile
+import argparse
+import threading
+
+FOLDER = "application/vnd.google-apps.folder"
+MIME_BY_EXT = {
+    ".pdf": "application/pdf",
+    ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    ".txt": "text/plain",
+}
+
+class _Call:
+    def __init__(self, client, fn):
+        self._client = client
+        self._fn = fn
+
+    def execute(self, num_retries=0):
+        self._client.check_thread()
+        return self._fn()
+
+class _Response(dict):
+    """Looks like httplib2.Response: a header dict with a `status`."""
+
+    def __init__(self, status: int, headers: dict):
+        super().__init__(headers)
+        self.status = status
+
+class _MediaHttp:
+    def __init__(self, client, file_id):
+        self.client = client
+        self.drive = client.drive
+        self.file_id = file_id
+
+    def request(self, uri, method="GET", headers=None, **kwargs):
+        self.client.check_thread()
+        content = self.drive.content(self.file_id)
+        total = len(content)
+        match = re.match(r"bytes=(\d+)-(\d+)", (headers or {}).get("range", ""))
+        start, end = (int(match.group(1)), int(match.group(2))) if match else (0, total - 1)
+        if start >= total:
+            return _Response(416, {"content-range": f"bytes */{total}"}), b""
+        end = min(end, total - 1)
+        with self.drive.lock:
+            self.drive.stats["range_requests"] += 1
+            self.drive.stats["bytes_served"] += end - start + 1
+        return _Response(206, {"content-range": f"bytes {start}-{end}/{total}"}), content[start:end + 1]
+
+class _MediaRequest:
+    def __init__(self, client, file_id):
+        self.http = _MediaHttp(client, file_id)
+        self.uri = f"fake://drive/{file_id}?alt=media"
+        self.headers = {}
+
+class _Files:
+    def __init__(self, client):
+        self.client = client
+        self.drive = client.drive
+
+    def list(self, q="", pageSize=100, pageToken=None, fields=None, **kwargs):
+        return _Call(self.client, lambda: self.drive.list_files(q, pageSize, pageToken))
+
+    def get_media(self, fileId):
+        return _MediaRequest(self.client, fileId)
+
+class _Changes:
+    def __init__(self, client):
+        self.client = client
+        self.drive = client.drive
+
+    def getStartPageToken(self, **kwargs):
+        return _Call(self.client, lambda: {"startPageToken": str(len(self.drive.log))})
+
+    def list(self, pageToken, pageSize=100, **kwargs):
+        return _Call(self.client, lambda: self.drive.list_changes(pageToken, pageSize))
+
+class FakeService:
+    """
+    One client of the FakeDrive. Fails loudly if used from a second thread,
+    the way a shared httplib2.Http fails quietly (mixed-up responses).
+    """
+
+    def __init__(self, drive):
+        self.drive = drive
+        self._owner = None
+
+    def check_thread(self):
+        me = threading.get_ident()
+        if self._owner is None:
+            self._owner = me
+        elif self._owner != me:
+            raise RuntimeError("Drive service used from more than one thread")
+
+    def files(self):
+        return _Files(self)
+
+    def changes(self):
+        return _Changes(self)
+
+class FakeDrive:
+    """
+    Files and folders live in a dict; every add / update / delete is appended to
+    a change log, and page tokens are positions in it (like the real API, a token
+    taken now only sees later changes).
+    """
+
+    def __init__(self):
+        self.items = {}
+        self.blobs = {}
+        self.log = []
+        self.lock = threading.Lock()
+        self.stats = {"list_calls": 0, "range_requests": 0, "bytes_served": 0}
+        self._seq = 0
+        self._clock = 1_700_000_000
+
+    def service(self) -> FakeService:
+        return FakeService(self)
+
+    # --- mutations ---
+    def _new_id(self) -> str:
+        self._seq += 1
+        return f"f{self._seq:06d}"
+
+    def _touch(self, item: dict):
+        self._clock += 1
+        item["modifiedTime"] = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(self._clock))
+        self.log.append(item["id"])
+
+    def add_folder(self, name: str, parent: str | None = None) -> str:
+        with self.lock:
+            item = {"id": self._new_id(), "name": name, "mimeType": FOLDER, "parents": [parent or "root"], "trashed": False}
+            self.items[item["id"]] = item
+            self._touch(item)
+        return item["id"]
+
+    def add_file(self, name: str, content: bytes, parent: str | None = None) -> str:
+        with self.lock:
+            mime = MIME_BY_EXT.get(os.path.splitext(name)[1].lower(), "application/octet-stream")
+            item = {"id": self._new_id(), "name": name, "mimeType": mime, "parents": [parent or "root"], "trashed": False}
+            self.items[item["id"]] = item
+            self._set_content(item, content)
+        return item["id"]
+
+    def update_file(self, file_id: str, content: bytes):
+        with self.lock:
+            self._set_content(self.items[file_id], content)
+
+    def delete_file(self, file_id: str):
+        with self.lock:
+            self.items[file_id]["trashed"] = True
+            self._touch(self.items[file_id])
+
+    def _set_content(self, item: dict, content: bytes):
+        self.blobs[item["id"]] = content
+        item["size"] = str(len(content))
+        item["md5Checksum"] = hashlib.md5(content).hexdigest()
+        self._touch(item)
+
+    def content(self, file_id: str) -> bytes:
+        with self.lock:
+            return self.blobs[file_id]
+
+    # --- queries ---
+    def _matches(self, item: dict, q: str) -> bool:
+        if "trashed=false" in q.replace(" ", "") and item["trashed"]:
+            return False
+        parents = re.findall(r"'([^']+)' in parents", q)
+        if parents and not set(parents).intersection(item["parents"]):
+            return False
+        mimes = re.findall(r"mimeType\s*=\s*'([^']+)'", q)
+        return not mimes or item["mimeType"] in mimes
+
+    def list_files(self, q: str, page_size: int, page_token: str | None) -> dict:
+        with self.lock:
+            self.stats["list_calls"] += 1
+            matched = [dict(item) for item in self.items.values() if self._matches(item, q)]
+        start = int(page_token or 0)
+        page = {"files": matched[start:start + page_size]}
+        if start + page_size < len(matched):
+            page["nextPageToken"] = str(start + page_size)
+        return page
+
+    def list_changes(self, page_token: str, page_size: int) -> dict:
+        with self.lock:
+            self.stats["list_calls"] += 1
+            start = int(page_token)
+            ids = self.log[start:start + page_size]
+            changes = [{"fileId": fid, "removed": False, "file": dict(self.items[fid])} for fid in ids]
+            end = start + len(ids)
+            page = {"changes": changes}
+            if end < len(self.log):
+                page["nextPageToken"] = str(end)
+            else:
+                page["newStartPageToken"] = str(end)
+        return page
+
+def populate(drive: FakeDrive, files: int, size_kb: int, seed: int = 0) -> str:
+    """
+    A folder tree "bench" with `files` random TXT files spread over nested subfolders.
+    """
+    rnd = random.Random(seed)
+    root = drive.add_folder("bench")
+    folders = [root]
+    for i in range(max(1, files // 20)):
+        folders.append(drive.add_folder(f"sub{i}", parent=rnd.choice(folders)))
+    for i in range(files):
+        drive.add_file(f"doc{i:05d}.txt", rnd.randbytes(size_kb * 1024), parent=rnd.choice(folders))
+    drive.add_file("ignored.png", b"\x89PNG", parent=root)
+    return root
+
+def run(files: int, size_kb: int, chunk_kb: int, workers: int) -> dict:
+    import gdrive_handler
+    from gdrive_handler import DriveSyncState, sync_drive, download_file, mark_synced
+
+    gdrive_handler.DRIVE_PAGE_SIZE = 100
+    drive = FakeDrive()
+    folder = populate(drive, files, size_kb)
+    report = {"files": files, "size_kb": size_kb, "chunk_kb": chunk_kb, "workers": workers}
+
+    with tempfile.TemporaryDirectory() as workdir:
+        dest = os.path.join(workdir, "data")
+        state = DriveSyncState(os.path.join(workdir, "state.json"))
+        for label, mutate in (
+            ("full", None),
+            ("noop", None),
+            ("incremental", lambda: _mutate(drive, folder)),
+        ):
+            if mutate:
+                mutate()
+            before = dict(drive.stats)
+            t0 = time.perf_counter()
+            result = sync_drive(
+                drive.service(), dest, state, folder,
+                workers=workers, chunk_size=chunk_kb * 1024, service_factory=drive.service,
+            )
+            for item, _path in result.downloaded:
+                mark_synced(state.path, item)  # как после успешной загрузки в индекс
+            report[label] = {
+                "seconds": round(time.perf_counter() - t0, 3),
+                "downloaded": len(result.downloaded),
+                "unchanged": result.unchanged,
+                "removed": len(result.removed),
+                "failed": len(result.failed),
+                "list_calls": drive.stats["list_calls"] - before["list_calls"],
+                "range_requests": drive.stats["range_requests"] - before["range_requests"],
+                "mb": round((drive.stats["bytes_served"] - before["bytes_served"]) / 2 ** 20, 2),
+            }
+
+        # обрыв на середине: .part с половиной файла той же версии докачивается,
+        # .part другой версии (файл успели изменить) скачивается заново
+        file_id = next(fid for fid, item in drive.items.items() if item["mimeType"] == "text/plain")
+        item = drive.items[file_id]
+        blob = drive.content(file_id)
+        for label, part_version in (
+            ("resume", {"modifiedTime": item["modifiedTime"], "md5Checksum": item["md5Checksum"]}),
+            ("resume_stale", {"modifiedTime": "2000-01-01T00:00:00.000Z", "md5Checksum": "0" * 32}),
+        ):
+            target = os.path.join(workdir, f"{label}.txt")
+            with open(f"{target}.part", "wb") as f:
+                f.write(blob[: len(blob) // 2])
+            with open(f"{target}.part.json", "w") as f:
+                json.dump(part_version, f)
+            before = drive.stats["bytes_served"]
+            download_file(
+                drive.service(), file_id, target, chunk_size=chunk_kb * 1024,
+                md5=item["md5Checksum"], modified_time=item["modifiedTime"],
+            )
+            with open(target, "rb") as f:
+                intact = f.read() == blob
+            report[label] = {"bytes_served": drive.stats["bytes_served"] - before, "file_bytes": len(blob), "intact": intact}
+    return report
+
+def _mutate(drive: FakeDrive, folder: str):
+    txt = [fid for fid, item in drive.items.items() if item["mimeType"] == "text/plain" and not item["trashed"]]
+    drive.update_file(txt[0], b"changed " * 1000)
+    drive.update_file(txt[1], b"changed again " * 1000)
+    drive.delete_file(txt[2])
+    drive.add_file("new.txt", b"fresh " * 1000, parent=folder)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--size-kb", type=int, default=256)
+    parser.add_argument("--chunk-kb", type=int, default=1024)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+    print(json.dumps(run(args.files, args.size_kb, args.chunk_kb, args.workers), indent=2))
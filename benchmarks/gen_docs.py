@@ -0,0 +1,82 @@
+"""
+Synthetic documents for benchmarks: deterministic pseudo-text in PDF, DOCX or TXT.
+
+    python -m benchmarks.gen_docs --format pdf --pages 50 --out /tmp/bench
+"""
+import os
+import random
+import argparse
+
+WORDS = (
+    "выручка маржа клиент продукт рынок стратегия метрика конверсия удержание воронка "
+    "сегмент платеж кредит банк финтех маркетинг бюджет канал аудитория гипотеза "
+    "эксперимент когорта подписка тариф комиссия риск скоринг лимит транзакция кошелек "
+    "retention churn revenue margin pricing onboarding funnel cohort acquisition growth"
+).split()
+
+QUESTION_TEMPLATES = (
+    "Что говорится про {a} и {b}?",
+    "Как {a} влияет на {b}?",
+    "Какие выводы по теме {a}?",
+    "What does the document say about {a} and {b}?",
+)
+
+def _sentence(rng: random.Random) -> str:
+    words = rng.choices(WORDS, k=rng.randint(8, 18))
+    return " ".join(words).capitalize() + "."
+
+def paragraphs(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield " ".join(_sentence(rng) for _ in range(rng.randint(3, 7)))
+
+def questions(count: int, seed: int = 1) -> list[str]:
+    rng = random.Random(seed)
+    return [rng.choice(QUESTION_TEMPLATES).format(a=rng.choice(WORDS), b=rng.choice(WORDS)) for _ in range(count)]
+
+PARAGRAPHS_PER_PAGE = 6
+
+def write_txt(path: str, pages: int, seed: int = 0) -> str:
+    with open(path, "w", encoding="utf-8") as f:
+        for p in paragraphs(pages * PARAGRAPHS_PER_PAGE, seed):
+            f.write(p + "\n\n")
+    return path
+
+def write_docx(path: str, pages: int, seed: int = 0) -> str:
+    import docx
+
+    document = docx.Document()
+    for p in paragraphs(pages * PARAGRAPHS_PER_PAGE, seed):
+        document.add_paragraph(p)
+    document.save(path)
+    return path
+
+def write_pdf(path: str, pages: int, seed: int = 0) -> str:
+    import fitz
+
+    doc = fitz.open()
+    texts = iter(paragraphs(pages * PARAGRAPHS_PER_PAGE, seed))
+    for _ in range(pages):
+        page = doc.new_page()
+        body = "\n\n".join(next(texts) for _ in range(PARAGRAPHS_PER_PAGE))
+        # встроенный шрифт с кириллицей
+        page.insert_textbox(fitz.Rect(40, 40, 555, 800), body, fontsize=8, fontname="helv", encoding=fitz.TEXT_ENCODING_CYRILLIC)
+    doc.save(path)
+    doc.close()
+    return path
+
+WRITERS = {"txt": write_txt, "docx": write_docx, "pdf": write_pdf}
+
+def generate(fmt: str, pages: int, out_dir: str, seed: int = 0) -> str:
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, f"synthetic_{pages}p_{seed}.{fmt}")
+    return WRITERS[fmt](path, pages, seed)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--format", choices=sorted(WRITERS), default="txt")
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="./bench_docs")
+    args = parser.parse_args()
+    print(generate(args.format, args.pages, args.out, args.seed))
@@ -0,0 +1,279 @@
+"""
+Benchmark suite: ingest throughput, retrieval QPS / latency and end-to-end
+bot handler latency under concurrent users, against a local stub OpenRouter.
+Results are printed (or written with --out) as JSON for comparing releases.
+
+    python -m benchmarks.run --pages 20 --queries 200 --concurrency 8 --users 16 --llm-delay 0.5 --out bench.json
+
+Everything the run writes (uploads, FAISS index, embedding cache) goes into a
+temporary working directory, so the bot's own data is never touched.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.gen_docs import generate, questions  # noqa: E402
+from benchmarks.stub_openrouter import start_stub  # noqa: E402
+
+TENANT = "bench"
+
+def _percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def pct(q: float) -> float:
+        return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+    return {
+        "count": len(values),
+        "mean_ms": sum(values) / len(values) * 1000,
+        "p50_ms": pct(0.50) * 1000,
+        "p90_ms": pct(0.90) * 1000,
+        "p99_ms": pct(0.99) * 1000,
+        "max_ms": values[-1] * 1000,
+    }
+
+def _git_revision() -> str | None:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, timeout=5)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+# ----------------------------
+# Ingest: extract_text_from_file + index_text_with_faiss
+# ----------------------------
+def bench_ingest(pdf_handler, paths: dict, pages: int) -> dict:
+    from index_manager import get_embeddings
+
+    t0 = time.perf_counter()
+    get_embeddings().embed_documents(["warm-up"])
+    results = {"model_load_seconds": time.perf_counter() - t0, "files": {}}
+
+    for fmt, path in paths.items():
+        t0 = time.perf_counter()
+        text = pdf_handler.extract_text_from_file(path)
+        t1 = time.perf_counter()
+        pdf_handler.index_text_with_faiss(text, filename=os.path.basename(path), tenant=TENANT)
+        t2 = time.perf_counter()
+
+        chunks = sum(
+            len(info["chunk_ids"]) for info in pdf_handler.list_documents(TENANT).values()
+            if info["filename"] == os.path.basename(path)
+        )
+        results["files"][fmt] = {
+            "bytes": os.path.getsize(path),
+            "pages": pages,
+            "chars": len(text),
+            "chunks": chunks,
+            "extract_seconds": t1 - t0,
+            "index_seconds": t2 - t1,
+            "pages_per_sec": pages / (t2 - t0) if t2 > t0 else None,
+            "chunks_per_sec": chunks / (t2 - t1) if t2 > t1 else None,
+        }
+    return results
+
+# ----------------------------
+# Retrieval: query_index (LLM stub answers instantly)
+# ----------------------------
+def bench_retrieval(pdf_handler, stub, n_queries: int, concurrency: int) -> dict:
+    stub.delay = 0.0
+    qs = questions(n_queries)
+    for q in qs[:5]:
+        pdf_handler.query_index(q, tenant=TENANT)  # прогрев
+
+    def timed(question: str):
+        t0 = time.perf_counter()
+        reply = pdf_handler.query_index(question, tenant=TENANT)
+        return time.perf_counter() - t0, reply == pdf_handler.RAG_REFUSAL_TEXT
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = list(pool.map(timed, qs))
+    wall = time.perf_counter() - t0
+
+    return {
+        "queries": n_queries,
+        "concurrency": concurrency,
+        "qps": n_queries / wall if wall else None,
+        "refusals": sum(1 for _t, refused in samples if refused),
+        "latency": _percentiles([t for t, _refused in samples]),
+    }
+
+# ----------------------------
+# End-to-end: bot handlers with fake Telegram objects
+# ----------------------------
+class FakeMessage:
+    def __init__(self, chat, text: str = ""):
+        self.chat = chat
+        self.text = text
+        self.edits = 0
+
+    async def reply_text(self, text: str, parse_mode=None, **kwargs):
+        self.chat.sent += 1
+        return FakeMessage(self.chat, text)
+
+    async def edit_text(self, text: str, parse_mode=None, **kwargs):
+        self.chat.edits += 1
+        self.text = text
+        return self
+
+    async def delete(self):
+        return True
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+        self.sent = 0
+        self.edits = 0
+
+class FakeUpdate:
+    def __init__(self, chat: FakeChat, text: str):
+        self.effective_chat = chat
+        self.message = FakeMessage(chat, text)
+
+class FakeContext:
+    def __init__(self, args=None):
+        self.args = args or []
+        self.user_data = {}
+        self.bot = None
+
+async def bench_e2e(stub, users: int, requests_per_user: int, llm_delay: float, token_delay: float) -> dict:
+    import bot
+    from pdf_handler import index_registry
+
+    stub.delay = llm_delay
+    stub.token_delay = token_delay
+    qs = questions(users * requests_per_user, seed=2)
+    latencies = {"askfile": [], "chat": []}
+    # у каждого пользователя свой чат (история, очередь в планировщике LLM),
+    # а документы общие – индексы всех чатов ведут на индекс стенда
+    chats = [FakeChat(100000 + i) for i in range(users)]
+    registry_get = index_registry.get
+    index_registry.get = lambda tenant=None: registry_get(TENANT)
+
+    async def user(i: int):
+        chat = chats[i]
+        for j in range(requests_per_user):
+            question = qs[i * requests_per_user + j]
+            t0 = time.perf_counter()
+            if j % 2 == 0:
+                await bot.askfile(FakeUpdate(chat, f"/askfile {question}"), FakeContext(question.split()))
+                latencies["askfile"].append(time.perf_counter() - t0)
+            else:
+                await bot.handle_message(FakeUpdate(chat, question), FakeContext())
+                latencies["chat"].append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    try:
+        await asyncio.gather(*(user(i) for i in range(users)))
+    finally:
+        del index_registry.get  # снова метод класса
+    wall = time.perf_counter() - t0
+    await bot.aclose_client()
+
+    total = sum(len(v) for v in latencies.values())
+    return {
+        "users": users,
+        "requests_per_user": requests_per_user,
+        "llm_delay": llm_delay,
+        "streaming": bot.STREAM_REPLIES,
+        "throughput_rps": total / wall if wall else None,
+        "telegram_messages": sum(c.sent for c in chats),
+        "telegram_edits": sum(c.edits for c in chats),
+        "latency": {kind: _percentiles(values) for kind, values in latencies.items()},
+    }
+
+# ----------------------------
+# Main
+# ----------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--formats", default="pdf,docx,txt")
+    parser.add_argument("--pages", type=int, default=20, help="pages per synthetic document")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8, help="threads for the retrieval benchmark")
+    parser.add_argument("--users", type=int, default=16, help="concurrent users for the end-to-end benchmark")
+    parser.add_argument("--requests-per-user", type=int, default=4)
+    parser.add_argument("--llm-delay", type=float, default=0.5, help="stub LLM delay before the reply")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="stub LLM delay between streamed words")
+    parser.add_argument("--answer-cache", action="store_true", help="keep the answer cache on (off by default)")
+    parser.add_argument("--skip", default="", help="comma-separated: ingest,retrieval,e2e")
+    parser.add_argument("--out", help="write JSON here instead of stdout")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary working directory")
+    args = parser.parse_args()
+    skip = {s.strip() for s in args.skip.split(",") if s.strip()}
+
+    workdir = tempfile.mkdtemp(prefix="finpilot_bench_")
+    stub = start_stub()
+    # Настройки читаются модулями при импорте – выставляем до импорта pdf_handler / bot
+    os.environ.update({
+        "OPENROUTER_URL": stub.url,
+        "OPENROUTER_API_KEY": "stub",
+        "METRICS_PORT": "0",
+        "ANSWER_CACHE": "1" if args.answer_cache else "0",
+        "PRECOMPUTE_SUMMARIES": "0",
+    })
+    paths = {fmt: generate(fmt, args.pages, os.path.join(workdir, "docs")) for fmt in args.formats.split(",")}
+    out_path = os.path.abspath(args.out) if args.out else None
+    os.chdir(workdir)  # data/, faiss_index/, embed_cache/ этого прогона
+
+    import pdf_handler
+
+    results = {
+        "meta": {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "settings": {
+                "EMBED_MODEL": os.getenv("EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2"),
+                "FAISS_INDEX_TYPE": os.getenv("FAISS_INDEX_TYPE", "flat"),
+                "RAG_TOP_K": pdf_handler.RAG_TOP_K,
+                "HYBRID_SEARCH": pdf_handler.HYBRID_SEARCH,
+            },
+            "args": vars(args),
+        },
+    }
+    try:
+        if "ingest" not in skip:
+            results["ingest"] = bench_ingest(pdf_handler, paths, args.pages)
+        elif "retrieval" not in skip or "e2e" not in skip:
+            for path in paths.values():
+                pdf_handler.index_text_with_faiss(pdf_handler.extract_text_from_file(path), os.path.basename(path), tenant=TENANT)
+        if "retrieval" not in skip:
+            results["retrieval"] = bench_retrieval(pdf_handler, stub, args.queries, args.concurrency)
+        if "e2e" not in skip:
+            results["e2e"] = asyncio.run(
+                bench_e2e(stub, args.users, args.requests_per_user, args.llm_delay, args.token_delay)
+            )
+        results["llm_stub_requests"] = stub.requests
+    finally:
+        stub.shutdown()
+        os.chdir(REPO_ROOT)
+        if args.keep:
+            results.setdefault("meta", {})["workdir"] = workdir
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if out_path:
+        with open(out_path, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+
+if __name__ == "__main__":
+    main()
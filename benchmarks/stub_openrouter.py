@@ -0,0 +1,102 @@
+"""
+Local stand-in for the OpenRouter chat completions API.
+Answers every request with a canned completion after a configurable delay;
+supports `stream: true` (SSE) and reports `usage` like OpenRouter does.
+
+    python -m benchmarks.stub_openrouter --port 8765 --delay 0.5
+    OPENROUTER_URL=http://127.0.0.1:8765/api/v1/chat/completions OPENROUTER_API_KEY=stub python bot.py
+"""
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CANNED_REPLY = (
+    "Пункт: В документе описаны метрики удержания и конверсии. "
+    "Цитата: \"retention cohort revenue\"\n"
+    "Пункт: Рекомендуется проверять гипотезы экспериментами. "
+    "Цитата: \"гипотеза эксперимент\""
+)
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            body = {}
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        time.sleep(server.delay)
+
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in body.get("messages", [])) // 4
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(server.reply) // 4}
+        model = body.get("model", "stub")
+
+        if not body.get("stream"):
+            payload = json.dumps({
+                "model": model,
+                "choices": [{"message": {"role": "assistant", "content": server.reply}}],
+                "usage": usage,
+            }, ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        words = server.reply.split(" ")
+        for i, word in enumerate(words):
+            delta = word if i == 0 else " " + word
+            chunk = {"model": model, "choices": [{"delta": {"content": delta}}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            if server.token_delay:
+                self.wfile.flush()
+                time.sleep(server.token_delay)
+        self.wfile.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+def start_stub(host: str = "127.0.0.1", port: int = 0, delay: float = 0.0, token_delay: float = 0.0,
+               reply: str = CANNED_REPLY) -> ThreadingHTTPServer:
+    """
+    Starts the stub in a daemon thread; port 0 picks a free port.
+    The URL to put into OPENROUTER_URL is in `server.url`.
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.delay = delay
+    server.token_delay = token_delay
+    server.reply = reply
+    server.requests = 0
+    server.lock = threading.Lock()
+    server.url = f"http://{host}:{server.server_address[1]}/api/v1/chat/completions"
+    threading.Thread(target=server.serve_forever, name="stub-openrouter", daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--delay", type=float, default=0.5, help="seconds before the reply starts")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="seconds between streamed words")
+    args = parser.parse_args()
+    stub = start_stub(args.host, args.port, args.delay, args.token_delay)
+    print(f"Stub OpenRouter on {stub.url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        stub.shutdown()
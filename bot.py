@@ -1,9 +1,13 @@
+import startup  # первым: от него считается время старта
 import os
 import re
 import html
-import shutil
+import asyncio
+import logging
+import functools
 from dotenv import load_dotenv
 from telegram import Update
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -14,22 +18,50 @@ from telegram.ext import (
 
 from pdf_handler import (
     save_file,
-    extract_text_from_file,
-    index_text_with_faiss,
-    query_index,
-    summarize_pdf,
-    call_openrouter,
+    list_documents,
+    remove_document,
+    aquery_index,
+    asummarize_pdf,
+    astream_query_index,
+    astream_summarize_pdf,
+    reset_index,
+    warm_up_model,
+    warm_up_indexes,
+    aquery_index_batch,
 )
-
+from llm_client import acall_openrouter, astream_openrouter, aclose_client, is_error_reply, join_reply
+from llm_scheduler import PRIORITY_CHAT, current_scheduler, model_health
+from ingest import IngestJob, IngestQueue, QueueFullError
+from conversation_store import CHAT_HISTORY, ConversationStore
+import metrics
+
+from state_store import get_state_store
+from batch_qa import BATCH_MAX_QUESTIONS, parse_questions, report_bytes, summarize as summarize_batch
 from gdrive_handler import (
     start_flow,
-    finish_flow,
+    flow_state,
+    restore_flow,
+    exchange_code,
+    service_from_credentials,
     list_files,
     download_file,
+    DriveSyncState,
+    drive_doc_id,
+    local_filename,
+    mark_synced,
+    state_path as drive_state_path,
+    sync_drive,
 )
 
+startup.mark("imports")
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+logger = logging.getLogger(__name__)
+# blocking – модель и индексы грузятся до приёма первого апдейта,
+# background – параллельно с приёмом, off – при первом запросе
+WARMUP = os.getenv("WARMUP", "blocking").strip().lower()
+# Если задан – бот работает через webhook с несколькими процессами (webhook_server.py)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
 
 BOT_NAME = os.getenv("BOT_NAME", "FinPilot")
 BOT_TAGLINE = os.getenv("BOT_TAGLINE", "AI-ассистент по маркетингу, финтеху и бизнесу")
@@ -86,15 +118,10 @@ def markdown_to_telegram_html(text: str) -> str:
     return text.strip()
 
 
-async def send_html(update: Update, text: str):
+def split_html(formatted: str) -> list[str]:
     """
-    Sends message(s) as Telegram HTML safely, splitting long outputs.
+    Splits formatted HTML into Telegram-sized parts (by paragraphs first).
     """
-    formatted = markdown_to_telegram_html(text)
-    if not formatted:
-        return
-
-    # split by paragraphs first
     parts = []
     buf = ""
     for chunk in formatted.split("\n\n"):
@@ -111,9 +138,88 @@ async def send_html(update: Update, text: str):
             buf = chunk
     if buf:
         parts.append(buf)
+    return parts
+
+async def send_html(update: Update, text: str):
+    """
+    Sends message(s) as Telegram HTML safely, splitting long outputs.
+    """
+    formatted = markdown_to_telegram_html(text)
+    if not formatted:
+        return
 
-    for p in parts:
-        await update.message.reply_text(p, parse_mode="HTML")
+    with metrics.timer("telegram_send"):
+        for p in split_html(formatted):
+            await update.message.reply_text(p, parse_mode="HTML")
+
+# --- Streaming output: progressive edits of the reply ---
+
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+# Telegram терпит примерно одно редактирование в секунду на чат
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.2"))
+
+def _html_to_plain(text: str) -> str:
+    return html.unescape(re.sub(r"<[^>]+>", "", text))
+
+async def _edit_html(message, text: str):
+    try:
+        await message.edit_text(text, parse_mode="HTML")
+    except RetryAfter as e:
+        await asyncio.sleep(e.retry_after)
+        await _edit_html(message, text)
+    except BadRequest as e:
+        if "not modified" in str(e).lower():
+            return
+        # кусок мог разрезать тег пополам – показываем без разметки
+        await message.edit_text(_html_to_plain(text))
+
+async def _reply_html(update: Update, text: str):
+    try:
+        return await update.message.reply_text(text, parse_mode="HTML")
+    except BadRequest:
+        return await update.message.reply_text(_html_to_plain(text))
+
+async def stream_html(update: Update, deltas, placeholder=None):
+    """
+    Renders a streamed reply progressively.
+    - Edits the last message in place, at most once per STREAM_EDIT_INTERVAL
+    - Rolls over into new messages as the text outgrows TG_MAX_LEN
+    - The placeholder message (e.g. "Думаю...") becomes the first part
+    Returns the full text (an LLMError if the stream reported one).
+    """
+    sent = [placeholder] if placeholder is not None else []
+    shown = [None] * len(sent)
+    text = ""
+    deltas_seen = []
+
+    async def flush():
+        parts = split_html(markdown_to_telegram_html(text))
+        with metrics.timer("telegram_send"):
+            for i, part in enumerate(parts):
+                if i < len(sent):
+                    if shown[i] != part:
+                        await _edit_html(sent[i], part)
+                        shown[i] = part
+                else:
+                    sent.append(await _reply_html(update, part))
+                    shown.append(part)
+            # текст мог сократиться (например, закрылся блок ``` и был вырезан)
+            while len(sent) > max(len(parts), 1):
+                await sent.pop().delete()
+                shown.pop()
+
+    loop = asyncio.get_running_loop()
+    started = last_flush = loop.time()
+    async for delta in deltas:
+        if not text:
+            metrics.observe("stream_first_delta_seconds", loop.time() - started)
+        text += delta
+        deltas_seen.append(delta)
+        if loop.time() - last_flush >= STREAM_EDIT_INTERVAL:
+            await flush()
+            last_flush = loop.time()
+    await flush()
+    return join_reply(deltas_seen)
 
 def detect_markdown(text: str) -> bool:
     patterns = [
@@ -144,32 +250,117 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/help – Справка\n"
         "/askfile [вопрос] – Вопрос по загруженному файлу\n"
         "/summary – Краткое содержание загруженного файла\n"
-        "/reset – Сбросить индекс\n"
-        "/syncdrive – Подключить Google Диск и выбрать файл\n"
+        "/batchask – Ответы на список вопросов из TXT/CSV (отчёт файлом)\n"
+        "/docs – Список загруженных документов\n"
+        "/status – Статус обработки документов\n"
+        "/remove [id] – Удалить документ из базы\n"
+        "/reset – Сбросить индекс и историю диалога\n"
+        "/syncdrive [ID папки | все] – Google Диск: выбрать файл или синхронизировать папку\n"
     )
 
 async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if os.path.exists("./faiss_index"):
-        shutil.rmtree("./faiss_index")
-        os.makedirs("./faiss_index", exist_ok=True)
-        await update.message.reply_text("✅ Контекст (индекс) сброшен.")
+    chat_id = update.effective_chat.id
+    had_index = await asyncio.to_thread(reset_index, chat_id)
+    had_history = CHAT_HISTORY and await conversations.aclear(chat_id)
+    if had_index and had_history:
+        await update.message.reply_text("✅ Индекс документов и история диалога сброшены.")
+    elif had_index:
+        await update.message.reply_text("✅ Индекс документов сброшен.")
+    elif had_history:
+        await update.message.reply_text("✅ История диалога сброшена (документов в базе не было).")
     else:
         await update.message.reply_text("Контекст уже пуст.")
 
+async def docs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    docs = await asyncio.to_thread(list_documents, update.effective_chat.id)
+    if not docs:
+        await update.message.reply_text("База документов пуста.")
+        return
+
+    msg = "📚 Документы в базе:\n"
+    for doc_id, info in docs.items():
+        msg += f"{info['filename']} – ID: {doc_id} ({len(info['chunk_ids'])} фрагм.)\n"
+    msg += "\nУдалить документ: /remove [id]"
+    await update.message.reply_text(msg)
+
+async def remove_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    doc_id = " ".join(context.args).strip()
+    if not doc_id:
+        await update.message.reply_text("Пример: /remove 1a2b3c4d (ID – в списке /docs)")
+        return
+
+    if await asyncio.to_thread(remove_document, doc_id, update.effective_chat.id):
+        await update.message.reply_text("✅ Документ удалён из базы.")
+    else:
+        await update.message.reply_text("ID не найден. Посмотрите список: /docs")
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_input = (update.message.text or "").strip()
     if not user_input:
         return
 
-    await update.message.reply_text("🧠 Думаю...")
+    placeholder = await update.message.reply_text("🧠 Думаю...")
+    chat_id = update.effective_chat.id
+
+    # Сжатое начало разговора + последние реплики в пределах CHAT_HISTORY_TOKENS
+    messages = [{"role": "system", "content": SYSTEM_PROMPT_CHAT}]
+    if CHAT_HISTORY:
+        summary, history = await asyncio.to_thread(conversations.window, chat_id)
+        if summary:
+            messages.append({"role": "system", "content": f"Краткое содержание разговора до этого:\n{summary}"})
+        messages += history
+    messages.append({"role": "user", "content": user_input})
+
+    if STREAM_REPLIES:
+        reply = await stream_html(
+            update, astream_openrouter(messages=messages, temperature=0.4, user=chat_id, priority=PRIORITY_CHAT), placeholder,
+        )
+    else:
+        reply = await acall_openrouter(messages=messages, temperature=0.4, user=chat_id, priority=PRIORITY_CHAT)
+        await send_html(update, reply)
 
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT_CHAT},
-        {"role": "user", "content": user_input},
-    ]
-    reply = call_openrouter(messages=messages, temperature=0.4)
+    if CHAT_HISTORY and not is_error_reply(reply):
+        await asyncio.to_thread(conversations.add_exchange, chat_id, user_input, reply)
+        conversations.schedule_compaction(chat_id)
 
-    await send_html(update, reply)
+# ---- Background ingestion ----
+ingest_queue = IngestQueue()
+conversations = ConversationStore()
+
+async def enqueue_document(update: Update, context: ContextTypes.DEFAULT_TYPE, path: str, filename: str, doc_id=None):
+    """
+    Puts a saved file into the ingestion queue. The progress message is edited
+    in place through the stages; a separate message is sent when the document is ready.
+    """
+    progress = await update.message.reply_text("📖 Читаю документ...")
+    chat_id = update.effective_chat.id
+
+    async def on_progress(job):
+        try:
+            await progress.edit_text(job.describe())
+        except BadRequest:
+            pass
+        if job.stage == "done":
+            await context.bot.send_message(
+                chat_id,
+                f"Документ {job.filename} прочитан. Используйте /askfile [вопрос] для быстрого поиска ответа "
+                "или /summary для краткого пересказа документа.",
+            )
+        elif job.stage == "failed":
+            await context.bot.send_message(chat_id, f"❌ Не удалось прочитать документ {job.filename}.")
+
+    try:
+        ingest_queue.submit(IngestJob(path, filename, tenant=chat_id, on_progress=on_progress, doc_id=doc_id))
+    except QueueFullError:
+        await progress.edit_text("⚠️ Сейчас обрабатывается слишком много документов. Попробуйте позже.")
+
+async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    jobs = ingest_queue.jobs(update.effective_chat.id)[-10:]
+    if not jobs:
+        await update.message.reply_text("Нет документов в обработке.")
+        return
+    lines = [job.describe() for job in jobs]
+    await update.message.reply_text("📋 Обработка документов:\n" + "\n".join(lines))
 
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     doc = update.message.document
@@ -177,20 +368,24 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     fname = (doc.file_name or "").lower()
+    caption = (update.message.caption or "").strip().lower()
+    # TXT/CSV после /batchask (или с подписью /batchask) – список вопросов, а не документ
+    is_list = fname.endswith((".txt", ".csv"))
+    if caption.startswith("/batchask") or (is_list and await asyncio.to_thread(get_state_store().pop, _batch_key(update))):
+        await run_batch(update, context, doc)
+        return
+    if fname.endswith(".csv"):
+        await update.message.reply_text("CSV принимается как список вопросов: отправьте его с подписью /batchask.")
+        return
     if not (fname.endswith(".pdf") or fname.endswith(".docx") or fname.endswith(".txt")):
         await update.message.reply_text("Поддерживаются только PDF, DOCX, TXT.")
         return
 
-    await update.message.reply_text("📖 Читаю документ...")
-
     file = await doc.get_file()
     file_bytes = await file.download_as_bytearray()
 
     path = save_file(file_bytes, doc.file_name)
-    text = extract_text_from_file(path)
-    index_text_with_faiss(text)
-
-    await update.message.reply_text("Документ прочитан. Используйте /askfile [вопрос] для быстрого поиска ответа или /summary для краткого пересказа документа.")
+    await enqueue_document(update, context, path, doc.file_name)
 
 async def askfile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = " ".join(context.args).strip()
@@ -198,94 +393,334 @@ async def askfile(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Пример: /askfile Какие выводы в документе по метрикам?")
         return
 
-    await update.message.reply_text("🔍 Ищу ответ...")
-    response = query_index(query)
+    placeholder = await update.message.reply_text("🔍 Ищу ответ...")
+    if STREAM_REPLIES:
+        await stream_html(update, astream_query_index(query, tenant=update.effective_chat.id), placeholder)
+        return
+
+    response = await aquery_index(query, tenant=update.effective_chat.id)
 
     await send_html(update, response)
 
 async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("📝 Пересказываю текст...")
-    result = summarize_pdf()
+    placeholder = await update.message.reply_text("📝 Пересказываю текст...")
+    if STREAM_REPLIES:
+        await stream_html(update, astream_summarize_pdf(tenant=update.effective_chat.id), placeholder)
+        return
+
+    result = await asummarize_pdf(tenant=update.effective_chat.id)
 
     await send_html(update, result)
 
+# ---- Batch questions ----
+BATCH_FILE_TTL = 600   # сколько ждём файл с вопросами после /batchask
+BATCH_PROGRESS_EVERY = 5
+
+def _batch_key(update: Update) -> str:
+    return f"batch:pending:{update.effective_chat.id}:{update.effective_user.id}"
+
+async def batchask(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /batchask в ответ на файл – сразу; иначе ждём следующий присланный файл
+    replied = update.message.reply_to_message
+    if replied is not None and replied.document is not None:
+        await run_batch(update, context, replied.document)
+        return
+    await asyncio.to_thread(get_state_store().set, _batch_key(update), True, BATCH_FILE_TTL)
+    await update.message.reply_text(
+        "Пришлите TXT (вопрос на строке) или CSV (колонка «вопрос») – "
+        f"до {BATCH_MAX_QUESTIONS} вопросов. Ответы придут одним файлом."
+    )
+
+async def run_batch(update: Update, context: ContextTypes.DEFAULT_TYPE, doc):
+    fname = doc.file_name or "questions.txt"
+    if not fname.lower().endswith((".txt", ".csv")):
+        await update.message.reply_text("Список вопросов – файл TXT или CSV.")
+        return
+    file = await doc.get_file()
+    questions = parse_questions(bytes(await file.download_as_bytearray()), fname)
+    if not questions:
+        await update.message.reply_text("В файле не найдено вопросов.")
+        return
+    note = ""
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        note = f" (из {len(questions)}, лимит {BATCH_MAX_QUESTIONS})"
+        questions = questions[:BATCH_MAX_QUESTIONS]
+
+    progress = await update.message.reply_text(f"⏳ Вопросов: {len(questions)}{note}. Ищу ответы...")
+
+    async def on_progress(done, total):
+        if done % BATCH_PROGRESS_EVERY and done != total:
+            return
+        try:
+            await progress.edit_text(f"⏳ Ответы: {done}/{total}")
+        except (BadRequest, RetryAfter):
+            pass
+
+    t0 = asyncio.get_running_loop().time()
+    results = await aquery_index_batch(questions, tenant=update.effective_chat.id, on_progress=on_progress)
+    if results is None:
+        await progress.edit_text("❌ База знаний не найдена. Пожалуйста, загрузите документ.")
+        return
+    summary_text = summarize_batch(results, asyncio.get_running_loop().time() - t0)
+    await progress.edit_text(summary_text)
+    await update.message.reply_document(
+        document=report_bytes(results),
+        filename=f"{os.path.splitext(fname)[0]}_answers.csv",
+        caption="📋 Отчёт: вопрос, ответ, страницы цитат",
+    )
+
 # ---- Google Drive ----
-pending_auth = {}
+# Шаг диалога и токены Google хранятся в общем хранилище (STATE_STORE),
+# а не в памяти процесса – так их видит любой воркер
+DRIVE_ALL = ("все", "all")
+DRIVE_SESSION_TTL = 3600
+
+def _drive_session_key(update: Update) -> str:
+    return f"drive:session:{update.effective_chat.id}:{update.effective_user.id}"
+
+def _drive_creds_key(update: Update) -> str:
+    return f"drive:creds:{update.effective_user.id}"
+
+async def load_drive_session(update: Update) -> dict:
+    return await asyncio.to_thread(get_state_store().get, _drive_session_key(update), {})
+
+async def save_drive_session(update: Update, session: dict | None):
+    if session:
+        await asyncio.to_thread(get_state_store().set, _drive_session_key(update), session, DRIVE_SESSION_TTL)
+    else:
+        await asyncio.to_thread(get_state_store().delete, _drive_session_key(update))
+
+async def drive_service(update: Update):
+    creds = await asyncio.to_thread(get_state_store().get, _drive_creds_key(update))
+    if creds is None:
+        return None
+    return await asyncio.to_thread(service_from_credentials, creds)
 
 async def syncdrive(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /syncdrive – выбрать один файл; /syncdrive <ID папки> или «все» – синхронизировать
+    session = {"folder": " ".join(context.args or []).strip() or None}
+    service = await drive_service(update)
+    if service is not None:
+        await drive_ready(update, context, service, session)
+        return
+
     flow, auth_url = start_flow(update.effective_user.id)
-    pending_auth[update.effective_user.id] = flow
-    context.user_data["step"] = "awaiting_auth_code"
+    session.update(step="awaiting_auth_code", flow=flow_state(flow))
+    await save_drive_session(update, session)
     await update.message.reply_text(f"Перейдите по ссылке и отправьте код:\n{auth_url}")
 
-async def handle_drive_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_drive_code(update: Update, context: ContextTypes.DEFAULT_TYPE, session: dict):
     code = (update.message.text or "").strip()
-    user_id = update.effective_user.id
 
-    flow = pending_auth.pop(user_id, None)
-    if not flow:
+    state = session.pop("flow", None)
+    if not state:
         await update.message.reply_text("Сначала выполните /syncdrive.")
         return
 
-    service = finish_flow(flow, code)
-    context.user_data["gdrive_service"] = service
+    creds = await asyncio.to_thread(exchange_code, restore_flow(state), code)
+    await asyncio.to_thread(get_state_store().set, _drive_creds_key(update), creds)
+    service = await asyncio.to_thread(service_from_credentials, creds)
+    await drive_ready(update, context, service, session)
 
-    files = list_files(service)
+async def drive_ready(update: Update, context: ContextTypes.DEFAULT_TYPE, service, session: dict):
+    folder = session.pop("folder", None)
+    if folder:
+        await save_drive_session(update, None)
+        await run_drive_sync(update, context, service, None if folder.lower() in DRIVE_ALL else folder)
+        return
+
+    files = await asyncio.to_thread(list_files, service)
     if not files:
+        await save_drive_session(update, None)
         await update.message.reply_text("Файлы не найдены.")
         return
 
     msg = "📄 Найденные файлы:\n"
     for fid, fname in files:
         msg += f"{fname} – ID: `{fid}`\n"
-    msg += "\nОтправьте ID файла."
+    msg += "\nОтправьте ID файла или «все», чтобы синхронизировать весь Диск."
 
-    context.user_data["drive_files"] = dict(files)
-    context.user_data["step"] = "awaiting_file_id"
+    session.update(step="awaiting_file_id", files=dict(files))
+    await save_drive_session(update, session)
     await update.message.reply_text(msg, parse_mode="Markdown")
 
-async def handle_drive_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_drive_file(update: Update, context: ContextTypes.DEFAULT_TYPE, session: dict):
     file_id = (update.message.text or "").strip()
-    drive_files = context.user_data.get("drive_files", {})
-
-    if file_id not in drive_files:
-        await update.message.reply_text("ID не найден. Скопируйте ID из списка.")
-        return
+    drive_files = session.get("files", {})
 
-    service = context.user_data.get("gdrive_service")
+    service = await drive_service(update)
     if not service:
+        await save_drive_session(update, None)
         await update.message.reply_text("Сначала выполните /syncdrive.")
         return
 
+    if file_id.lower() in DRIVE_ALL:
+        await save_drive_session(update, None)
+        await run_drive_sync(update, context, service)
+        return
+
+    if file_id not in drive_files:
+        await update.message.reply_text("ID не найден. Скопируйте ID из списка.")
+        return
+
     filename = drive_files[file_id]
-    path = os.path.join("./data", filename)
+    path = os.path.join("./data", local_filename(file_id, filename))
 
-    await update.message.reply_text("📖 Читаю документ...")
+    await update.message.reply_text("📥 Скачиваю документ...")
 
-    download_file(service, file_id, path)
+    await asyncio.to_thread(download_file, service, file_id, path)
 
-    text = extract_text_from_file(path)
-    index_text_with_faiss(text)
+    await save_drive_session(update, None)
+    await enqueue_document(update, context, path, filename, doc_id=drive_doc_id(file_id))
 
-    context.user_data["step"] = None
-    await update.message.reply_text(f"Документ {filename} прочитан. Используйте /askfile [вопрос] для быстрого поиска ответа или /summary для краткого пересказа документа.")
+async def run_drive_sync(update: Update, context: ContextTypes.DEFAULT_TYPE, service, folder_id: str | None = None):
+    """
+    Incremental sync of the Drive (or one folder tree) into the chat's index:
+    only new / changed files are downloaded and ingested, deleted ones are removed.
+    """
+    chat_id = update.effective_chat.id
+    progress = await update.message.reply_text("🔄 Синхронизирую Google Диск...")
+    state = DriveSyncState(drive_state_path(chat_id))
+    dest_dir = os.path.join("./data", "drive", str(chat_id))
+    # у каждого потока загрузки свой клиент: httplib2.Http внутри service не потокобезопасен
+    creds = await asyncio.to_thread(get_state_store().get, _drive_creds_key(update))
+    service_factory = functools.partial(service_from_credentials, creds) if creds else None
+    with metrics.timer("drive_sync"):
+        result = await asyncio.to_thread(
+            sync_drive, service, dest_dir, state, folder_id, service_factory=service_factory,
+        )
+
+    # документы с Диска лежат в индексе под drive_doc_id – загрузки с тем же именем не трогаем
+    for info in result.removed:
+        await asyncio.to_thread(remove_document, drive_doc_id(info["id"]), chat_id)
+
+    jobs = []
+    reported = []
+    items = {}  # id(job) -> метаданные файла на Диске
+
+    async def on_progress(job):
+        if job.stage == "done" and id(job) in items:
+            # только теперь файл считается синхронизированным; упавший останется в pending
+            await asyncio.to_thread(mark_synced, state.path, items[id(job)])
+        if job.finished and not reported and all(j.finished for j in jobs):
+            reported.append(True)
+            failed = sum(1 for j in jobs if j.stage == "failed")
+            text = f"✅ Google Диск синхронизирован: {len(jobs) - failed} докум. обновлено"
+            if failed:
+                text += f", {failed} не удалось прочитать"
+            await context.bot.send_message(chat_id, text + ".")
+
+    skipped = 0
+    for info, path in result.downloaded:
+        job = IngestJob(path, info["name"], tenant=chat_id, on_progress=on_progress, doc_id=drive_doc_id(info["id"]))
+        items[id(job)] = info
+        try:
+            ingest_queue.submit(job)
+        except QueueFullError:
+            # файл остался в pending – следующий /syncdrive возьмёт его снова
+            skipped += 1
+            continue
+        jobs.append(job)
+
+    text = (
+        f"🔄 Google Диск: новых или изменённых {len(result.downloaded) - skipped}, "
+        f"без изменений {result.unchanged}, удалено {len(result.removed)}"
+    )
+    if result.failed:
+        text += f", не скачалось {len(result.failed)}"
+    if skipped:
+        text += f", отложено (очередь заполнена) {skipped}"
+    if jobs:
+        text += ". Документы обрабатываются – /status"
+    try:
+        await progress.edit_text(text + ".")
+    except BadRequest:
+        pass
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    step = context.user_data.get("step")
+    session = await load_drive_session(update)
+    step = session.get("step")
     if step == "awaiting_auth_code":
-        await handle_drive_code(update, context)
+        await handle_drive_code(update, context, session)
     elif step == "awaiting_file_id":
-        await handle_drive_file(update, context)
+        await handle_drive_file(update, context, session)
     else:
         await handle_message(update, context)
 
-if __name__ == "__main__":
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+def timed(name: str, handler):
+    """
+    Wraps a handler so its total time lands in stage_seconds{stage="handler"}.
+    """
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        with metrics.timer("handler", handler=name):
+            await handler(update, context)
+    return wrapper
+
+def _collect_bot_metrics():
+    samples = [
+        ("ingest_queue_pending", ingest_queue.pending(), None),
+        ("ingest_jobs_active", sum(1 for j in ingest_queue.jobs() if not j.finished), None),
+    ]
+    scheduler = current_scheduler()
+    if scheduler is not None:
+        samples += [("llm_waiting", n, {"priority": p}) for p, n in scheduler.waiting().items()]
+        samples += [(f"llm_scheduler_{k}", v, None) for k, v in scheduler.stats.items()]
+    for model, info in model_health.snapshot().items():
+        samples.append(("llm_model_success_rate", info["success"], {"model": model}))
+        samples.append(("llm_model_cooldown_seconds", info["cooldown_until"], {"model": model}))
+    return samples
+
+async def warm_up():
+    try:
+        startup.record("warmup_model", await asyncio.to_thread(warm_up_model))
+        t0 = asyncio.get_running_loop().time()
+        loaded = await asyncio.to_thread(warm_up_indexes)
+        startup.record("warmup_indexes", asyncio.get_running_loop().time() - t0)
+        logger.info("Warm-up: %d indexes loaded", loaded)
+    except Exception:
+        logger.exception("Warm-up failed, models will load on first use")
+    startup.report()
+
+async def on_startup(app):
+    startup.mark("telegram_init")
+    await ingest_queue.start()
+    metrics.register_collector(_collect_bot_metrics)
+    metrics.start_http_server()
+    if WARMUP == "blocking":
+        # post_init отрабатывает до начала polling – апдейты ждут прогретую модель
+        await warm_up()
+    elif WARMUP == "background":
+        app.bot_data["warmup_task"] = asyncio.create_task(warm_up())
+    else:
+        startup.report()
+
+async def on_shutdown(app):
+    await ingest_queue.stop()
+    await conversations.aclose()
+    await aclose_client()
+    get_state_store().close()
+    metrics.stop_http_server()
+
+def build_application(polling: bool = True):
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(True)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if not polling:
+        builder = builder.updater(None)  # апдейты приходят от webhook-фронта
+    app = builder.build()
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_command))
-    app.add_handler(CommandHandler("askfile", askfile))
-    app.add_handler(CommandHandler("summary", summary))
+    app.add_handler(CommandHandler("askfile", timed("askfile", askfile)))
+    app.add_handler(CommandHandler("summary", timed("summary", summary)))
+    app.add_handler(CommandHandler("batchask", timed("batchask", batchask)))
+    app.add_handler(CommandHandler("docs", docs_command))
+    app.add_handler(CommandHandler("status", status_command))
+    app.add_handler(CommandHandler("remove", timed("remove", remove_command)))
     app.add_handler(CommandHandler("reset", reset_command))
     app.add_handler(CommandHandler("syncdrive", syncdrive))
 
@@ -293,12 +728,25 @@ if __name__ == "__main__":
         MessageHandler(
             filters.Document.MimeType("application/pdf")
             | filters.Document.MimeType("application/vnd.openxmlformats-officedocument.wordprocessingml.document")
-            | filters.Document.MimeType("text/plain"),
-            handle_document,
+            | filters.Document.MimeType("text/plain")
+            | filters.Document.FileExtension("csv"),
+            timed("document", handle_document),
         )
     )
 
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed("text", handle_text)))
+    return app
 
-    print(f"{BOT_NAME} работает. Ждите сообщений в Telegram.")
-    app.run_polling()
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "INFO"),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    if WEBHOOK_URL:
+        import webhook_server
+
+        print(f"{BOT_NAME} работает через webhook ({webhook_server.WEBHOOK_WORKERS} воркеров).")
+        webhook_server.serve()
+    else:
+        print(f"{BOT_NAME} работает. Ждите сообщений в Telegram.")
+        build_application().run_polling()
@@ -0,0 +1,308 @@
+import os
+import re
+import json
+import threading
+from collections import deque, namedtuple
+
+# ----------------------------
+# Settings
+# ----------------------------
+CITATIONS = os.getenv("CITATIONS", "1") == "1"   # проверять цитаты и добавлять страницы к ответу
+CITATION_MIN_CHARS = 4   # более короткие куски цитаты (между "...") не проверяются
+CITATION_PREVIEW_CHARS = 40
+
+# Где лежит чанк: файл, страница (None для DOCX/TXT) и позиция в тексте
+# страницы (для DOCX/TXT – в тексте всего документа); start/end – None у старых индексов
+Span = namedtuple("Span", "filename page start end")
+
+def span_from_metadata(metadata: dict) -> Span:
+    metadata = metadata or {}
+    return Span(metadata.get("filename"), metadata.get("page"), metadata.get("start"), metadata.get("end"))
+
+# ----------------------------
+# Side table (chunk_id -> Span)
+# ----------------------------
+class SpanTable:
+    """
+    chunk_id -> Span, kept next to the FAISS store (spans.json).
+    Rows are [file_no, page, start, end] with file names stored once,
+    so the table stays small compared with the docstore.
+    """
+
+    def __init__(self):
+        self._files = []
+        self._file_no = {}
+        self._rows = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def _intern(self, filename) -> int:
+        no = self._file_no.get(filename)
+        if no is None:
+            no = self._file_no[filename] = len(self._files)
+            self._files.append(filename)
+        return no
+
+    def add_many(self, items):
+        """
+        Adds [(chunk_id, Span), ...]; existing rows are replaced.
+        """
+        with self._lock:
+            for chunk_id, span in items:
+                self._rows[chunk_id] = [self._intern(span.filename), span.page, span.start, span.end]
+
+    def remove(self, chunk_ids):
+        with self._lock:
+            for chunk_id in chunk_ids:
+                self._rows.pop(chunk_id, None)
+
+    def get(self, chunk_id) -> Span | None:
+        row = self._rows.get(chunk_id)
+        if row is None:
+            return None
+        return Span(self._files[row[0]], row[1], row[2], row[3])
+
+    def lookup(self, chunk_ids) -> dict:
+        return {chunk_id: span for chunk_id in chunk_ids if (span := self.get(chunk_id)) is not None}
+
+    def copy(self) -> "SpanTable":
+        """
+        Independent copy to modify while readers keep using this one.
+        """
+        with self._lock:
+            table = SpanTable()
+            table._files = list(self._files)
+            table._file_no = dict(self._file_no)
+            table._rows = dict(self._rows)
+        return table
+
+    # --- persistence ---
+    def dump(self, path: str):
+        with self._lock:
+            # имена удалённых документов не сохраняем
+            files, file_no, rows = [], {}, {}
+            for chunk_id, (no, page, start, end) in self._rows.items():
+                name = self._files[no]
+                if name not in file_no:
+                    file_no[name] = len(files)
+                    files.append(name)
+                rows[chunk_id] = [file_no[name], page, start, end]
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"files": files, "rows": rows}, f, ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path: str) -> "SpanTable":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        table = cls()
+        table._files = list(data.get("files", []))
+        table._file_no = {name: no for no, name in enumerate(table._files)}
+        table._rows = data.get("rows", {})
+        return table
+
+# ----------------------------
+# Text normalization
+# ----------------------------
+# перенос слова в PDF: "финан-\nсовый"
+_HYPHENATION_RE = re.compile(r"(?<=\w)[-\u00ad]\s*\n\s*(?=\w)")
+
+def normalize(text: str) -> tuple[str, list[int]]:
+    """
+    Lowercase words separated by single spaces (punctuation, quotes and line
+    breaks ignored, ё -> е, hyphenation removed), plus the position in `text`
+    of every character of the result.
+    """
+    skip = {}
+    for m in _HYPHENATION_RE.finditer(text):
+        skip[m.start()] = m.end()
+    chars, offsets = [], []
+    i, n = 0, len(text)
+    while i < n:
+        if i in skip:
+            i = skip[i]
+            continue
+        ch = text[i]
+        if ch.isalnum():
+            ch = ch.lower()
+            chars.append("е" if ch == "ё" else ch)
+            offsets.append(i)
+        elif chars and chars[-1] != " ":
+            chars.append(" ")
+            offsets.append(i)
+        i += 1
+    if chars and chars[-1] == " ":
+        chars.pop()
+        offsets.pop()
+    return "".join(chars), offsets
+
+# ----------------------------
+# Multi-pattern search (Aho-Corasick)
+# ----------------------------
+class PhraseMatcher:
+    """
+    Aho-Corasick automaton over a set of phrases: one pass over a text
+    finds every occurrence of every phrase.
+    """
+
+    def __init__(self, phrases):
+        self.phrases = list(phrases)
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for no, phrase in enumerate(self.phrases):
+            state = 0
+            for ch in phrase:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                state = nxt
+            self._out[state].append(no)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def finditer(self, text: str):
+        """
+        Yields (start, phrase_no) for every occurrence, in order of their end.
+        """
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for no in out[state]:
+                yield i - len(self.phrases[no]) + 1, no
+
+# ----------------------------
+# Quote verification
+# ----------------------------
+# Промпт требует `Цитата: "..."`; модели ставят и «», и “”
+_QUOTE_RE = re.compile(r'Цитат[аы]?\s*:?\s*(?:«(.+?)»|"(.+?)"|“(.+?)[”“]|„(.+?)[“”])', re.S | re.I)
+_ELLIPSIS_RE = re.compile(r"\[?(?:\.\.\.|…)\]?")
+
+class Citation:
+    """
+    One quote of the answer and where it was found (filename / page / start /
+    end stay None if it was not).
+    """
+
+    def __init__(self, quote: str, span: Span | None = None):
+        self.quote = quote
+        self.verified = span is not None
+        self.filename = span.filename if span else None
+        self.page = span.page if span else None
+        self.start = span.start if span else None
+        self.end = span.end if span else None
+
+    def where(self) -> str:
+        if not self.verified:
+            return "⚠️ не найдено в документах"
+        if self.page is not None:
+            return f"{self.filename}, стр. {self.page}"
+        return self.filename or "документ"
+
+    def __repr__(self):
+        return f"Citation({self.quote[:30]!r}, {self.filename!r}, page={self.page}, verified={self.verified})"
+
+def extract_quotes(answer: str) -> list[str]:
+    quotes = []
+    for m in _QUOTE_RE.finditer(answer):
+        quote = next(g for g in m.groups() if g is not None).strip()
+        if quote:
+            quotes.append(quote)
+    return quotes
+
+def _runs(sources):
+    """
+    Glues overlapping chunks of the same page back together using their offsets,
+    so a quote that crosses a chunk boundary is still found.
+    sources: [(text, Span), ...] -> [(text, Span), ...]
+    """
+    runs, placed = [], {}
+    for text, span in sorted(
+        sources, key=lambda s: (s[1].start is None, str(s[1].filename), s[1].page or 0, s[1].start or 0),
+    ):
+        if span.start is None or span.end is None:
+            runs.append([text, span])
+            continue
+        key = (span.filename, span.page)
+        run = placed.get(key)
+        if run is not None and span.start <= run[1].end:
+            run_text, run_span = run
+            run[0] = run_text + text[max(0, run_span.end - span.start):]
+            run[1] = run_span._replace(end=max(run_span.end, span.end))
+        else:
+            run = [text, span]
+            runs.append(run)
+            placed[key] = run
+    return [(text, span) for text, span in runs]
+
+def verify_quotes(answer: str, sources) -> list[Citation]:
+    """
+    Checks every quote of the answer against the retrieved chunks.
+    sources: [(chunk_text, Span), ...]. A quote counts as found if all its parts
+    (between "..." if the model shortened it) occur as whole words in one place.
+    No LLM calls: one Aho-Corasick pass over the normalized sources.
+    """
+    quotes = extract_quotes(answer)
+    if not quotes:
+        return []
+    parts_of = []
+    phrases = {}
+    for quote in quotes:
+        parts = [normalize(p)[0] for p in _ELLIPSIS_RE.split(quote)]
+        parts = [p for p in parts if len(p) >= CITATION_MIN_CHARS] or [normalize(quote)[0]]
+        parts_of.append([phrases.setdefault(p, len(phrases)) for p in parts if p])
+    matcher = PhraseMatcher(phrases)
+
+    found = []   # [(run span, offsets, {phrase_no: start in normalized text})]
+    for text, span in _runs(sources):
+        norm, offsets = normalize(text)
+        first = {}
+        for start, no in matcher.finditer(norm):
+            end = start + len(matcher.phrases[no])
+            if no in first or (start and norm[start - 1] != " ") or (end < len(norm) and norm[end] != " "):
+                continue
+            first[no] = start
+        if first:
+            found.append((span, offsets, first))
+
+    citations = []
+    for quote, nos in zip(quotes, parts_of):
+        located = None
+        for span, offsets, first in found:
+            if nos and all(no in first for no in nos):
+                located = span
+                if span.start is not None:
+                    begin = first[nos[0]]
+                    last = first[nos[-1]] + len(matcher.phrases[nos[-1]]) - 1
+                    located = span._replace(start=span.start + offsets[begin], end=span.start + offsets[last] + 1)
+                break
+        citations.append(Citation(quote, located))
+    return citations
+
+def format_sources(citations: list[Citation]) -> str:
+    """
+    "📄 Источники" footer: one line per quote with its file and page.
+    """
+    if not citations:
+        return ""
+    lines = []
+    for i, c in enumerate(citations, 1):
+        preview = c.quote if len(c.quote) <= CITATION_PREVIEW_CHARS else c.quote[:CITATION_PREVIEW_CHARS].rstrip() + "…"
+        lines.append(f"{i}. «{preview}» – {c.where()}")
+    return "\n\n📄 Источники:\n" + "\n".join(lines)
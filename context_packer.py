@@ -0,0 +1,147 @@
+import os
+import re
+import logging
+
+import numpy as np
+
+try:
+    import tiktoken
+except ImportError:  # точный токенизатор не обязателен, есть эвристика
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# ----------------------------
+# Settings
+# ----------------------------
+CONTEXT_PACKING = os.getenv("CONTEXT_PACKING", "1") == "1"
+RAG_CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "1200"))          # бюджет контекста в промпте
+RAG_DEDUP_SIMILARITY = float(os.getenv("RAG_DEDUP_SIMILARITY", "0.92"))    # косинус, выше – дубль
+TIKTOKEN_ENCODING = os.getenv("TIKTOKEN_ENCODING", "cl100k_base")
+
+MAX_OVERLAP_CHARS = 200  # чанки режутся с overlap=50, берём с запасом
+MIN_OVERLAP_CHARS = 8
+
+# ----------------------------
+# Token counting
+# ----------------------------
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+_encoder = None
+
+def count_tokens(text: str) -> int:
+    """
+    tiktoken if installed, otherwise ~1.3 tokens per word / punctuation mark
+    (close enough for Russian and English with BPE vocabularies).
+    """
+    global _encoder
+    if tiktoken is not None:
+        if _encoder is None:
+            _encoder = tiktoken.get_encoding(TIKTOKEN_ENCODING)
+        return len(_encoder.encode(text, disallowed_special=()))
+    return int(len(_TOKEN_RE.findall(text)) * 1.3) + 1
+
+# ----------------------------
+# Span assembly
+# ----------------------------
+def _join(a: str, b: str) -> str:
+    """
+    Glues consecutive chunks, dropping the text they share (splitter overlap).
+    """
+    for n in range(min(len(a), len(b), MAX_OVERLAP_CHARS), MIN_OVERLAP_CHARS - 1, -1):
+        if a.endswith(b[:n]):
+            return a + b[n:]
+    return f"{a} {b}"
+
+class PackedContext:
+    """
+    Result of pack_context: prompt text plus accounting.
+    """
+
+    def __init__(self, text: str, spans: int, tokens: int, tokens_before: int, dropped_duplicates: int):
+        self.text = text
+        self.spans = spans
+        self.tokens = tokens
+        self.tokens_before = tokens_before
+        self.dropped_duplicates = dropped_duplicates
+
+    @property
+    def tokens_saved(self) -> int:
+        return max(0, self.tokens_before - self.tokens)
+
+def _drop_near_duplicates(docs: list, vectors) -> tuple[list, int]:
+    """
+    Keeps the better-ranked one of any two chunks with cosine >= RAG_DEDUP_SIMILARITY.
+    Neighbouring chunks of the same document are never treated as duplicates.
+    """
+    if vectors is None or len(docs) < 2:
+        return docs, 0
+    vectors = np.array(vectors, dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+    sims = vectors @ vectors.T
+    kept = []
+    for i, doc in enumerate(docs):
+        duplicate = any(sims[i, j] >= RAG_DEDUP_SIMILARITY and not _adjacent(doc, docs[j]) for j in kept)
+        if not duplicate:
+            kept.append(i)
+    return [docs[i] for i in kept], len(docs) - len(kept)
+
+def _position(doc):
+    meta = getattr(doc, "metadata", None) or {}
+    if meta.get("doc_id") is None or meta.get("chunk") is None:
+        return None
+    return meta["doc_id"], meta["chunk"]
+
+def _adjacent(a, b) -> bool:
+    pa, pb = _position(a), _position(b)
+    return pa is not None and pb is not None and pa[0] == pb[0] and abs(pa[1] - pb[1]) <= 1
+
+def _merge_spans(docs: list) -> list[tuple[int, str]]:
+    """
+    Merges chunks of the same document with consecutive indexes into one span.
+    Returns [(best_rank, text), ...]; rank is the position in `docs` (relevance order).
+    """
+    runs = {}   # (doc_id, chunk) of the run's last chunk -> run
+    spans = []
+    ranked = sorted(enumerate(docs), key=lambda item: _position(item[1]) or ("", item[0]))
+    for rank, doc in ranked:
+        pos = _position(doc)
+        text = doc.page_content.strip()
+        run = runs.pop((pos[0], pos[1] - 1), None) if pos is not None else None
+        if run is None:
+            run = {"rank": rank, "text": text}
+            spans.append(run)
+        else:
+            run["rank"] = min(run["rank"], rank)
+            run["text"] = _join(run["text"], text)
+        if pos is not None:
+            runs[pos] = run
+    return sorted(((s["rank"], s["text"]) for s in spans), key=lambda s: s[0])
+
+def pack_context(docs: list, vectors=None, budget: int = RAG_CONTEXT_TOKENS) -> PackedContext:
+    """
+    Builds the prompt context from retrieved chunks (best first):
+    - drops near-duplicates (cosine of `vectors`, the chunks' stored embeddings
+      in the same order; skipped if None)
+    - merges adjacent / overlapping chunks back into contiguous spans
+    - packs spans by relevance into `budget` tokens
+    """
+    tokens_before = sum(count_tokens(d.page_content.strip()) for d in docs)
+    if not CONTEXT_PACKING:
+        text = "\n".join(d.page_content.strip() for d in docs).strip()
+        return PackedContext(text, len(docs), tokens_before, tokens_before, 0)
+
+    unique, dropped = _drop_near_duplicates(docs, vectors)
+    parts, used = [], 0
+    for _rank, text in _merge_spans(unique):
+        tokens = count_tokens(text)
+        if used + tokens > budget:
+            if parts:
+                continue  # может влезть следующий, более короткий фрагмент
+            # даже самый релевантный фрагмент больше бюджета – обрезаем
+            text = text[: max(1, len(text) * budget // tokens)]
+            tokens = count_tokens(text)
+        parts.append(text)
+        used += tokens
+
+    text = "\n---\n".join(parts).strip()
+    return PackedContext(text, len(parts), used, tokens_before, dropped)
@@ -0,0 +1,205 @@
+import os
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+
+from context_packer import count_tokens
+from llm_client import acall_openrouter, is_error_reply
+from llm_scheduler import PRIORITY_BACKGROUND
+
+logger = logging.getLogger(__name__)
+
+# ----------------------------
+# Settings
+# ----------------------------
+CONVERSATION_DB = os.getenv("CONVERSATION_DB", "./conversations.db")
+CHAT_HISTORY = os.getenv("CHAT_HISTORY", "1") == "1"
+CHAT_HISTORY_TOKENS = int(os.getenv("CHAT_HISTORY_TOKENS", "1500"))         # последние реплики дословно
+CHAT_COMPACT_MIN_TOKENS = int(os.getenv("CHAT_COMPACT_MIN_TOKENS", "300"))  # сколько старых реплик копим до сжатия
+CHAT_SUMMARY_WORDS = int(os.getenv("CHAT_SUMMARY_WORDS", "150"))
+
+COMPACT_PROMPT = (
+    "Ниже краткое содержание предыдущего разговора (может быть пустым) и следующие реплики. "
+    "Обнови краткое содержание: сохрани факты о пользователе и его задаче, принятые решения, "
+    "цифры и открытые вопросы. Не более {words} слов, без вступлений.\n\n"
+    "Краткое содержание:\n{summary}\n\nРеплики:\n{turns}"
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    tokens INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS turns_chat ON turns (chat_id, id);
+CREATE TABLE IF NOT EXISTS summaries (
+    chat_id TEXT PRIMARY KEY,
+    summary TEXT NOT NULL,
+    upto_id INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+class ConversationStore:
+    """
+    Per-chat history in SQLite (WAL).
+    - The newest turns that fit CHAT_HISTORY_TOKENS go into the prompt verbatim
+    - Older turns are folded into a running summary in the background and deleted,
+      so both the prompt and the database stay bounded per chat
+    """
+
+    def __init__(self, path: str = CONVERSATION_DB):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+        self._compacting = {}
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def add_exchange(self, chat_id, user_text: str, assistant_text: str):
+        now = time.time()
+        rows = [
+            (str(chat_id), "user", user_text, count_tokens(user_text), now),
+            (str(chat_id), "assistant", assistant_text, count_tokens(assistant_text), now),
+        ]
+        with self._lock:
+            self._db().executemany(
+                "INSERT INTO turns (chat_id, role, content, tokens, created_at) VALUES (?, ?, ?, ?, ?)", rows,
+            )
+
+    def _turns(self, chat_id) -> list[tuple]:
+        # вызывается под self._lock
+        return self._db().execute(
+            "SELECT id, role, content, tokens FROM turns WHERE chat_id = ? ORDER BY id", (str(chat_id),),
+        ).fetchall()
+
+    @staticmethod
+    def _split(turns: list[tuple], budget: int) -> int:
+        """
+        Index of the first turn of the newest suffix that fits `budget` tokens.
+        The suffix always starts with a user turn.
+        """
+        used, start = 0, len(turns)
+        for i in range(len(turns) - 1, -1, -1):
+            used += turns[i][3]
+            if used > budget:
+                break
+            start = i
+        while start < len(turns) and turns[start][1] != "user":
+            start += 1
+        return start
+
+    def window(self, chat_id, budget: int = CHAT_HISTORY_TOKENS) -> tuple[str | None, list[dict]]:
+        """
+        (summary of older turns or None, recent turns as chat messages).
+        """
+        with self._lock:
+            row = self._db().execute("SELECT summary FROM summaries WHERE chat_id = ?", (str(chat_id),)).fetchone()
+            turns = self._turns(chat_id)
+        recent = turns[self._split(turns, budget):]
+        return (row[0] if row else None), [{"role": role, "content": content} for _id, role, content, _t in recent]
+
+    def _pending(self, chat_id, budget: int) -> tuple[str, list[tuple]]:
+        """
+        Current summary and the turns that have fallen out of the window.
+        """
+        with self._lock:
+            row = self._db().execute("SELECT summary FROM summaries WHERE chat_id = ?", (str(chat_id),)).fetchone()
+            turns = self._turns(chat_id)
+        return (row[0] if row else ""), turns[: self._split(turns, budget)]
+
+    def _save_summary(self, chat_id, summary: str, upto_id: int):
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN")
+            # историю успели очистить (/reset) – резюме старых реплик не нужно
+            if db.execute("SELECT 1 FROM turns WHERE chat_id = ? AND id = ?", (str(chat_id), upto_id)).fetchone() is None:
+                db.execute("ROLLBACK")
+                return
+            db.execute(
+                "INSERT INTO summaries (chat_id, summary, upto_id, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET summary = excluded.summary, "
+                "upto_id = excluded.upto_id, updated_at = excluded.updated_at",
+                (str(chat_id), summary, upto_id, time.time()),
+            )
+            db.execute("DELETE FROM turns WHERE chat_id = ? AND id <= ?", (str(chat_id), upto_id))
+            db.execute("COMMIT")
+
+    def clear(self, chat_id) -> bool:
+        with self._lock:
+            db = self._db()
+            deleted = db.execute("DELETE FROM turns WHERE chat_id = ?", (str(chat_id),)).rowcount
+            deleted += db.execute("DELETE FROM summaries WHERE chat_id = ?", (str(chat_id),)).rowcount
+        return deleted > 0
+
+    async def aclear(self, chat_id) -> bool:
+        """
+        clear() for the bot: a compaction running for the chat is cancelled
+        first, so it cannot write the old summary back.
+        """
+        task = self._compacting.get(str(chat_id))
+        if task is not None and not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        return await asyncio.to_thread(self.clear, chat_id)
+
+    # --- background compaction ---
+    async def compact(self, chat_id, budget: int = CHAT_HISTORY_TOKENS) -> bool:
+        """
+        Folds turns that fell out of the window into the chat's summary.
+        """
+        summary, pending = await asyncio.to_thread(self._pending, chat_id, budget)
+        if sum(t[3] for t in pending) < CHAT_COMPACT_MIN_TOKENS:
+            return False
+        turns = "\n".join(f"{'Пользователь' if role == 'user' else 'Ассистент'}: {content}" for _id, role, content, _t in pending)
+        prompt = COMPACT_PROMPT.format(words=CHAT_SUMMARY_WORDS, summary=summary or "–", turns=turns)
+        reply = await acall_openrouter(
+            messages=[{"role": "user", "content": prompt}], temperature=0.2,
+            user=chat_id, priority=PRIORITY_BACKGROUND,
+        )
+        if is_error_reply(reply):
+            logger.warning("Conversation compaction for chat %s failed: %s", chat_id, reply[:200])
+            return False
+        await asyncio.to_thread(self._save_summary, chat_id, reply.strip(), pending[-1][0])
+        return True
+
+    def schedule_compaction(self, chat_id):
+        """
+        Starts compact() in the background unless one is already running for the chat.
+        """
+        key = str(chat_id)
+        task = self._compacting.get(key)
+        if task is not None and not task.done():
+            return
+        task = asyncio.create_task(self._compact_logged(chat_id))
+        self._compacting[key] = task
+        task.add_done_callback(lambda _t: self._compacting.pop(key, None))
+
+    async def _compact_logged(self, chat_id):
+        try:
+            await self.compact(chat_id)
+        except Exception:
+            logger.exception("Conversation compaction for chat %s failed", chat_id)
+
+    async def aclose(self):
+        tasks = list(self._compacting.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
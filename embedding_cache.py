@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: один процесс, межпроцессная блокировка не нужна
+    fcntl = None
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+EMBED_CACHE_DIR = os.getenv("EMBED_CACHE_DIR", "./embed_cache")
+EMBED_CACHE_MAX_ENTRIES = int(os.getenv("EMBED_CACHE_MAX_ENTRIES", "200000"))
+
+_DIGEST_SIZE = 20  # sha1
+
+def _digest(text: str) -> bytes:
+    return hashlib.sha1(text.encode("utf-8")).digest()
+
+def _model_slug(model_name: str) -> str:
+    return "".join(ch if ch.isalnum() or ch in "-_." else "_" for ch in model_name)
+
+# ----------------------------
+# On-disk vector store (memory-mapped)
+# ----------------------------
+class EmbeddingCache:
+    """
+    Persistent cache of chunk embeddings for one model, keyed by sha1(chunk text).
+    Layout in `<cache_dir>/<model>/`:
+    - vectors.f32   float32 [capacity, dim] (np.memmap)
+    - keys.bin      uint8   [capacity, 20]  sha1 digest per slot
+    - used.u32      uint32  [capacity]      last access tick (for LRU eviction)
+    - meta.json     dim / capacity / tick
+    Several processes may share one directory: slots are allocated under an
+    fcntl lock (.lock), after re-reading what the others wrote, and a hit is
+    only served if the slot still holds the requested key.
+    """
+
+    def __init__(self, model_name: str, cache_dir: str = EMBED_CACHE_DIR, capacity: int = EMBED_CACHE_MAX_ENTRIES):
+        self.model_name = model_name
+        self.dir = os.path.join(cache_dir, _model_slug(model_name))
+        self.capacity = capacity
+        self.dim = None
+        self._tick = 0
+        self._slots = {}  # digest -> slot
+        self._free = []
+        self._meta_tick = None  # tick из meta.json, по которому построены _slots / _free
+        self._lock = threading.Lock()
+        os.makedirs(self.dir, exist_ok=True)
+        with self._file_lock():
+            self._open_existing()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.dir, name)
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self._path(".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield  # flock снимается при закрытии файла
+
+    def _read_meta(self) -> dict | None:
+        try:
+            with open(self._path("meta.json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _open_existing(self):
+        meta = self._read_meta()
+        if meta is None:
+            return
+        if meta.get("capacity") != self.capacity:
+            # Размер кэша поменяли в настройках – проще начать заново
+            logger.info("Embedding cache capacity changed, resetting %s", self.dir)
+            return
+        self.dim = meta["dim"]
+        self._tick = max(self._tick, meta.get("tick", 0))
+        self._meta_tick = meta.get("tick", 0)
+        self._map_files(mode="r+")
+        self._rebuild_slots()
+
+    def _rebuild_slots(self):
+        # memmap открыт как MAP_SHARED – записи других процессов уже видны в _keys
+        self._slots = {}
+        occupied = self._keys.any(axis=1)
+        for slot in np.flatnonzero(occupied).tolist():
+            self._slots[self._keys[slot].tobytes()] = slot
+        self._free = np.flatnonzero(~occupied)[::-1].tolist()
+
+    def _map_files(self, mode: str):
+        self._vectors = np.memmap(self._path("vectors.f32"), dtype=np.float32, mode=mode, shape=(self.capacity, self.dim))
+        self._keys = np.memmap(self._path("keys.bin"), dtype=np.uint8, mode=mode, shape=(self.capacity, _DIGEST_SIZE))
+        self._used = np.memmap(self._path("used.u32"), dtype=np.uint32, mode=mode, shape=(self.capacity,))
+
+    def _create(self, dim: int):
+        self.dim = dim
+        self._map_files(mode="w+")
+        self._free = list(range(self.capacity - 1, -1, -1))
+
+    def _write_meta(self):
+        tmp = self._path("meta.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"model": self.model_name, "dim": self.dim, "capacity": self.capacity, "tick": self._tick}, f)
+        os.replace(tmp, self._path("meta.json"))
+        self._meta_tick = self._tick
+
+    def _refresh(self):
+        """
+        Catches up with writes of other processes (under the file lock).
+        Every put_many bumps the tick in meta.json, so an unchanged tick means
+        nobody else wrote since we last looked.
+        """
+        meta = self._read_meta()
+        if meta is None or meta.get("tick") == self._meta_tick:
+            return
+        if self.dim is None:
+            self._open_existing()
+            return
+        self._tick = max(self._tick, meta.get("tick", 0))
+        self._meta_tick = meta.get("tick", 0)
+        self._rebuild_slots()
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def get_many(self, keys: list[bytes]) -> list:
+        """
+        Returns a vector (np.ndarray) or None per key.
+        """
+        with self._lock:
+            if self.dim is None:
+                return [None] * len(keys)
+            self._tick += 1
+            out = []
+            for key in keys:
+                slot = self._slots.get(key)
+                if slot is None:
+                    out.append(None)
+                    continue
+                vector = np.array(self._vectors[slot])
+                if self._keys[slot].tobytes() != key:
+                    # слот освободил и занял другой процесс (проверяем после чтения вектора)
+                    del self._slots[key]
+                    out.append(None)
+                    continue
+                self._used[slot] = self._tick
+                out.append(vector)
+            return out
+
+    def _evict(self, count: int):
+        # LRU: освобождаем слоты с самым старым временем доступа
+        occupied = np.fromiter(self._slots.values(), dtype=np.int64)
+        if count >= len(occupied):
+            victims = occupied
+        else:
+            victims = occupied[np.argpartition(self._used[occupied], count)[:count]]
+        for slot in victims.tolist():
+            key = self._keys[slot].tobytes()
+            self._slots.pop(key, None)
+            self._keys[slot] = 0
+            self._free.append(slot)
+
+    def put_many(self, keys: list[bytes], vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(keys) == 0:
+            return
+        with self._lock, self._file_lock():
+            self._refresh()
+            if self.dim is None:
+                self._create(vectors.shape[1])
+            new = {}
+            for key, vector in zip(keys, vectors):
+                if key not in self._slots and key not in new:
+                    new[key] = vector
+            new = list(new.items())[: self.capacity]
+            shortage = len(new) - len(self._free)
+            if shortage > 0:
+                self._evict(shortage)
+            self._tick += 1
+            for key, vector in new:
+                slot = self._free.pop()
+                self._vectors[slot] = vector
+                self._keys[slot] = np.frombuffer(key, dtype=np.uint8)
+                self._used[slot] = self._tick
+                self._slots[key] = slot
+            self._vectors.flush()
+            self._keys.flush()
+            self._used.flush()
+            self._write_meta()
+
+# ----------------------------
+# Embeddings wrapper
+# ----------------------------
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an Embeddings model: chunks already seen (same model, same text)
+    are served from EmbeddingCache and skip the encoder entirely.
+    """
+
+    def __init__(self, base: Embeddings, cache: EmbeddingCache):
+        self.base = base
+        self.cache = cache
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.encode_seconds = 0.0
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            total = self.hits + self.misses
+            per_chunk = self.encode_seconds / self.misses if self.misses else 0.0
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "encode_seconds": self.encode_seconds,
+                # оценка: сколько бы стоило закодировать попадания заново
+                "saved_seconds": self.hits * per_chunk,
+                "entries": len(self.cache),
+            }
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [_digest(t) for t in texts]
+        cached = self.cache.get_many(keys)
+        missing = [i for i, v in enumerate(cached) if v is None]
+
+        if missing:
+            t0 = time.perf_counter()
+            fresh = self.base.embed_documents([texts[i] for i in missing])
+            elapsed = time.perf_counter() - t0
+            self.cache.put_many([keys[i] for i in missing], fresh)
+            for i, vector in zip(missing, fresh):
+                cached[i] = vector
+        else:
+            elapsed = 0.0
+
+        with self._stats_lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+            self.encode_seconds += elapsed
+
+        stats = self.stats()
+        logger.info(
+            "Embedding cache: %d/%d hits, hit rate %.0f%%, saved ~%.1fs so far",
+            len(texts) - len(missing), len(texts), stats["hit_rate"] * 100, stats["saved_seconds"],
+        )
+        return [np.asarray(v, dtype=np.float32).tolist() for v in cached]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.base.embed_query(text)
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        # вопросы не кэшируем – они вытесняли бы векторы чанков
+        return self.base.embed_queries(texts)
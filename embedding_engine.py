@@ -0,0 +1,157 @@
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+# ----------------------------
+# Settings
+# ----------------------------
+EMBED_BATCH = int(os.getenv("EMBED_BATCH", "64"))                     # текстов на один проход модели
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", str(os.cpu_count() or 1)))
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch").strip().lower()   # torch | onnx
+EMBED_ONNX_FILE = os.getenv("EMBED_ONNX_FILE", "")                   # напр. onnx/model_qint8_avx512_vnni.onnx
+EMBED_QUANTIZE = os.getenv("EMBED_QUANTIZE", "0") == "1"              # int8 dynamic quantization (torch)
+# Запросы от параллельных /askfile копятся до EMBED_QUERY_WINDOW_MS и кодируются одним батчем
+EMBED_QUERY_WINDOW_MS = float(os.getenv("EMBED_QUERY_WINDOW_MS", "5"))
+EMBED_QUERY_MAX_BATCH = int(os.getenv("EMBED_QUERY_MAX_BATCH", "32"))
+
+def engine_variant() -> str:
+    """
+    Suffix that tells apart vectors of the same model computed differently
+    (used to keep separate embedding caches).
+    """
+    if EMBED_BACKEND == "onnx":
+        return f"onnx-{os.path.basename(EMBED_ONNX_FILE) or 'fp32'}"
+    return "int8" if EMBED_QUANTIZE else ""
+
+def _load_model(model_name: str):
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    torch.set_num_threads(EMBED_THREADS)
+    if EMBED_BACKEND == "onnx":
+        model_kwargs = {"file_name": EMBED_ONNX_FILE} if EMBED_ONNX_FILE else None
+        try:
+            return SentenceTransformer(model_name, device="cpu", backend="onnx", model_kwargs=model_kwargs)
+        except TypeError:
+            # sentence-transformers < 3.2 не умеет backend=
+            logger.warning("ONNX backend is not supported by this sentence-transformers, using torch")
+
+    model = SentenceTransformer(model_name, device="cpu")
+    if EMBED_QUANTIZE:
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+class _QueryBatcher:
+    """
+    Collects embed_query() calls coming from different threads and encodes
+    them together: the first request waits at most `window` seconds for others.
+    """
+
+    def __init__(self, encode, window: float, max_batch: int):
+        self._encode = encode
+        self._window = window
+        self._max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="embed-queries", daemon=True)
+        self._thread.start()
+        self.batches = 0
+        self.queries = 0
+
+    def submit(self, text: str) -> list[float]:
+        future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self._window
+            while len(batch) < self._max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                vectors = self._encode([text for text, _f in batch])
+            except Exception as e:
+                for _text, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.queries += len(batch)
+            for (_text, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+class EmbeddingEngine(Embeddings):
+    """
+    sentence-transformers model on CPU with explicit control over
+    batch size, torch threads and precision (fp32 / int8 / ONNX).
+    - embed_documents: batched encode, throughput logged in chunks/sec
+    - embed_query: micro-batched across concurrent callers
+    - embed_queries: a known batch of queries in one go
+    """
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.model = _load_model(model_name)
+        self._encode_lock = threading.Lock()
+        self._queries = _QueryBatcher(self._encode, EMBED_QUERY_WINDOW_MS / 1000, EMBED_QUERY_MAX_BATCH)
+        self.chunks = 0
+        self.encode_seconds = 0.0
+
+    def _encode(self, texts: list[str]) -> list[list[float]]:
+        # Модель сама раскладывает батч по EMBED_THREADS потокам, параллельные
+        # вызовы только мешали бы друг другу. Лок берём на каждый батч отдельно,
+        # чтобы запросы /askfile не ждали векторизацию всего документа.
+        out = []
+        for start in range(0, len(texts), EMBED_BATCH):
+            with self._encode_lock:
+                vectors = self.model.encode(
+                    texts[start:start + EMBED_BATCH], batch_size=EMBED_BATCH,
+                    convert_to_numpy=True, show_progress_bar=False,
+                )
+            out.extend(np.asarray(vectors, dtype=np.float32).tolist())
+        return out
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        t0 = time.perf_counter()
+        vectors = self._encode(list(texts))
+        elapsed = time.perf_counter() - t0
+        self.chunks += len(texts)
+        self.encode_seconds += elapsed
+        logger.info(
+            "Embedded %d chunks in %.2fs (%.0f chunks/sec)",
+            len(texts), elapsed, len(texts) / elapsed if elapsed else 0.0,
+        )
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._queries.submit(text)
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        """
+        Many queries at once (batch questions): encoded directly, not counted as chunks.
+        """
+        return self._encode(list(texts)) if texts else []
+
+    def stats(self) -> dict:
+        return {
+            "chunks": self.chunks,
+            "encode_seconds": self.encode_seconds,
+            "chunks_per_sec": self.chunks / self.encode_seconds if self.encode_seconds else 0.0,
+            "query_batches": self._queries.batches,
+            "queries": self._queries.queries,
+        }
@@ -1,13 +1,34 @@
 import os
-import io
-from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
-from googleapiclient.http import MediaIoBaseDownload
+import json
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Клиент Google API тяжёлый, а Диск нужен редко – импортируем его
+# внутри функций, чтобы не замедлять старт бота
+
+logger = logging.getLogger(__name__)
 
 SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
 
-def start_flow(user_id: int):
+SUPPORTED_MIME_TYPES = (
+    'application/pdf',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'text/plain',
+)
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+FILE_FIELDS = "id, name, mimeType, modifiedTime, md5Checksum, size, parents, trashed"
+
+DRIVE_PAGE_SIZE = int(os.getenv("DRIVE_PAGE_SIZE", "1000"))
+DRIVE_DOWNLOAD_WORKERS = int(os.getenv("DRIVE_DOWNLOAD_WORKERS", "4"))
+DRIVE_CHUNK_SIZE = int(float(os.getenv("DRIVE_CHUNK_MB", "16")) * 1024 * 1024)  # по умолчанию у клиента 100 КБ
+DRIVE_STATE_DIR = os.getenv("DRIVE_STATE_DIR", "./drive_state")
+
+def _new_flow(**kwargs):
+    from google_auth_oauthlib.flow import Flow
+
     # Если файла нет – создаём его из переменной окружения
     if not os.path.exists('credentials.json'):
         creds_json = os.getenv('GOOGLE_CREDENTIALS_JSON')
@@ -18,33 +39,421 @@ def start_flow(user_id: int):
         with open('credentials.json', 'w') as f:
             f.write(creds_json)
 
-    flow = Flow.from_client_secrets_file(
+    return Flow.from_client_secrets_file(
         'credentials.json',
         scopes=SCOPES,
-        redirect_uri='urn:ietf:wg:oauth:2.0:oob'
+        redirect_uri='urn:ietf:wg:oauth:2.0:oob',
+        **kwargs
     )
+
+def start_flow(user_id: int):
+    flow = _new_flow()
     auth_url, _ = flow.authorization_url(prompt='consent')
     return flow, auth_url
 
-def finish_flow(flow: Flow, code: str):
+def flow_state(flow) -> dict:
+    """
+    What is needed to finish the flow in another process (PKCE verifier).
+    """
+    return {'code_verifier': getattr(flow, 'code_verifier', None)}
+
+def restore_flow(state: dict):
+    return _new_flow(code_verifier=state.get('code_verifier'))
+
+def exchange_code(flow, code: str) -> str:
+    """
+    Finishes the flow; returns the user's credentials as JSON (to be stored).
+    """
     flow.fetch_token(code=code)
-    creds = flow.credentials
-    service = build('drive', 'v3', credentials=creds)
-    return service
-
-def list_files(service):
-    results = service.files().list(
-        pageSize=10,
-        fields="files(id, name)",
-        q="mimeType='application/pdf' or mimeType='application/vnd.openxmlformats-officedocument.wordprocessingml.document' or mimeType='text/plain'"
-    ).execute()
-    items = results.get('files', [])
-    return [(item['id'], item['name']) for item in items]
-
-def download_file(service, file_id, destination_path):
+    return flow.credentials.to_json()
+
+def service_from_credentials(creds_json: str):
+    from googleapiclient.discovery import build
+    from google.oauth2.credentials import Credentials
+
+    creds = Credentials.from_authorized_user_info(json.loads(creds_json), SCOPES)
+    return build('drive', 'v3', credentials=creds)
+
+def finish_flow(flow, code: str):
+    return service_from_credentials(exchange_code(flow, code))
+
+def _mime_query() -> str:
+    return "(" + " or ".join(f"mimeType='{m}'" for m in SUPPORTED_MIME_TYPES) + ")"
+
+def _iter_pages(service, q: str, fields: str = FILE_FIELDS, page_size: int | None = None):
+    page_size = page_size or DRIVE_PAGE_SIZE
+    page_token = None
+    while True:
+        results = service.files().list(
+            q=q,
+            pageSize=page_size,
+            pageToken=page_token,
+            fields=f"nextPageToken, files({fields})",
+        ).execute()
+        yield from results.get('files', [])
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return
+
+def list_files(service, limit: int | None = 10):
+    """
+    Supported files on the Drive as (id, name), following pagination up to `limit`.
+    """
+    files = []
+    for item in _iter_pages(service, f"{_mime_query()} and trashed=false", fields="id, name", page_size=min(limit or DRIVE_PAGE_SIZE, DRIVE_PAGE_SIZE)):
+        files.append((item['id'], item['name']))
+        if limit and len(files) >= limit:
+            break
+    return files
+
+def iter_folder_files(service, folder_id: str | None = None, folders: set | None = None):
+    """
+    Yields metadata of every supported file: in the whole Drive, or in `folder_id`
+    and all its subfolders (breadth-first). Visited folder ids are added to `folders`.
+    """
+    if folder_id is None:
+        yield from _iter_pages(service, f"{_mime_query()} and trashed=false")
+        return
+
+    pending = [folder_id]
+    while pending:
+        current = pending.pop(0)
+        if folders is not None:
+            folders.add(current)
+        for item in _iter_pages(service, f"'{current}' in parents and trashed=false"):
+            if item.get('mimeType') == FOLDER_MIME_TYPE:
+                pending.append(item['id'])
+            elif item.get('mimeType') in SUPPORTED_MIME_TYPES:
+                yield item
+
+DRIVE_DOWNLOAD_RETRIES = 3
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def _read_part_meta(path: str):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _remove(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+def _fetch_range(request, start: int, end: int):
+    """
+    One ranged GET of the media request: (status, total size or None, content).
+    Transient errors are retried with backoff.
+    """
+    headers = dict(getattr(request, 'headers', None) or {})
+    headers['range'] = f"bytes={start}-{end}"
+    for attempt in range(DRIVE_DOWNLOAD_RETRIES + 1):
+        try:
+            resp, content = request.http.request(request.uri, method='GET', headers=headers)
+        except (ConnectionError, TimeoutError, OSError):
+            if attempt == DRIVE_DOWNLOAD_RETRIES:
+                raise
+        else:
+            if resp.status not in _RETRY_STATUSES or attempt == DRIVE_DOWNLOAD_RETRIES:
+                break
+        time.sleep(2 ** attempt)
+    total = None
+    content_range = resp.get('content-range', '')
+    if '/' in content_range and not content_range.endswith('/*'):
+        total = int(content_range.rsplit('/', 1)[1])
+    elif resp.status == 200:
+        total = len(content)
+    return resp.status, total, content
+
+def download_file(service, file_id, destination_path, chunk_size: int = DRIVE_CHUNK_SIZE,
+                  md5: str | None = None, modified_time: str | None = None):
+    """
+    Downloads into `<destination>.part` with explicit Range requests of `chunk_size`
+    and renames when done. `<destination>.part.json` records which version
+    (modifiedTime / md5) the .part belongs to: an interrupted download of the same
+    version is resumed from where the .part ends, anything else (or a call without
+    either) starts from zero.
+    If `md5` is given, the result is verified against it.
+    """
+    part_path = f"{destination_path}.part"
+    meta_path = f"{part_path}.json"
+    version = {'modifiedTime': modified_time, 'md5Checksum': md5}
+    offset = 0
+    if os.path.exists(part_path):
+        if (md5 or modified_time) and _read_part_meta(meta_path) == version:
+            offset = os.path.getsize(part_path)
+        else:
+            _remove(part_path)  # другая версия файла или неизвестно какая – качаем заново
+    if offset and md5 and _md5(part_path) == md5:
+        os.replace(part_path, destination_path)  # докачано до конца, но не переименовано
+        _remove(meta_path)
+        return destination_path
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(version, f)
+
     request = service.files().get_media(fileId=file_id)
-    fh = io.FileIO(destination_path, 'wb')
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while not done:
-        status, done = downloader.next_chunk()
\ No newline at end of file
+    total = None
+    with open(part_path, 'r+b' if offset else 'wb') as fh:
+        fh.seek(offset)
+        while total is None or offset < total:
+            status, size, content = _fetch_range(request, offset, offset + chunk_size - 1)
+            if status == 416 and size is not None and offset >= size:
+                break  # .part уже полный (или файл пустой)
+            if status not in (200, 206):
+                raise IOError(f"download of {file_id} failed: HTTP {status}")
+            if status == 200 and offset:
+                # сервер не поддержал Range и прислал файл целиком
+                fh.seek(0)
+                fh.truncate()
+            fh.write(content)
+            offset = fh.tell()
+            total = size
+            if not content:
+                break
+        fh.truncate()
+
+    if md5 and _md5(part_path) != md5:
+        _remove(part_path, meta_path)
+        raise IOError(f"checksum mismatch for {file_id}")
+    os.replace(part_path, destination_path)
+    _remove(meta_path)
+    return destination_path
+
+def _md5(path: str) -> str:
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# ----------------------------
+# Incremental sync
+# ----------------------------
+class DriveSyncState:
+    """
+    What has been synced for one chat: file id -> {name, modifiedTime, md5Checksum},
+    the crawled folders and the changes API page token. Stored as JSON.
+    A file goes to `files` only once it is ingested (mark_synced); until then –
+    downloaded, failed or still in the ingest queue – it waits in `pending`
+    (id -> Drive metadata) and the next sync fetches it again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.reload()
+
+    def reload(self):
+        self.files = {}
+        self.pending = {}
+        self.folders = []
+        self.folder_id = None
+        self.page_token = None
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.files = data.get('files', {})
+            self.pending = data.get('pending', {})
+            self.folders = data.get('folders', [])
+            self.folder_id = data.get('folder_id')
+            self.page_token = data.get('page_token')
+        except (OSError, ValueError):
+            pass
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(f"{self.path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump({
+                'files': self.files,
+                'pending': self.pending,
+                'folders': self.folders,
+                'folder_id': self.folder_id,
+                'page_token': self.page_token,
+            }, f, ensure_ascii=False)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def is_current(self, item: dict) -> bool:
+        known = self.files.get(item['id'])
+        if known is None:
+            return False
+        if item.get('md5Checksum') and known.get('md5Checksum'):
+            return item['md5Checksum'] == known['md5Checksum']
+        return item.get('modifiedTime') == known.get('modifiedTime')
+
+def _file_info(item: dict) -> dict:
+    return {
+        'name': item['name'],
+        'modifiedTime': item.get('modifiedTime'),
+        'md5Checksum': item.get('md5Checksum'),
+    }
+
+def local_filename(file_id: str, name: str) -> str:
+    """
+    Local file name for a Drive file: its id plus the name with everything
+    but letters, digits and "-_." replaced ("/" is legal in Drive names).
+    The extension is kept – the parser is chosen by it.
+    """
+    safe = "".join(ch if ch.isalnum() or ch in "-_." else "_" for ch in name)
+    return f"{file_id}_{safe}"
+
+def drive_doc_id(file_id: str) -> str:
+    """
+    Index doc_id of a Drive file: stable across renames and independent of
+    uploads with the same name.
+    """
+    return f"gd_{file_id}"
+
+# Состояние читают и пишут sync_drive и mark_synced из разных потоков
+_state_locks = {}
+_state_locks_guard = threading.Lock()
+
+def _state_lock(path: str) -> threading.Lock:
+    with _state_locks_guard:
+        return _state_locks.setdefault(os.path.abspath(path), threading.Lock())
+
+def mark_synced(path: str, item: dict):
+    """
+    Moves a downloaded file from `pending` to `files` once it is ingested.
+    """
+    with _state_lock(path):
+        state = DriveSyncState(path)
+        state.pending.pop(item['id'], None)
+        state.files[item['id']] = _file_info(item)
+        state.save()
+
+def state_path(tenant) -> str:
+    safe = "".join(ch if ch.isalnum() or ch in "-_" else "_" for ch in str(tenant))
+    return os.path.join(DRIVE_STATE_DIR, f"{safe}.json")
+
+def _changed_since(service, state: DriveSyncState):
+    """
+    Changes API since state.page_token: (changed file metadata, removed file ids, new token).
+    Subfolders created inside the synced tree are added to state.folders.
+    """
+    changed, removed = {}, set()
+    folders = set(state.folders)
+    page_token = state.page_token
+    new_token = page_token
+    while page_token:
+        results = service.changes().list(
+            pageToken=page_token,
+            spaces='drive',
+            pageSize=DRIVE_PAGE_SIZE,
+            fields=f"nextPageToken, newStartPageToken, changes(fileId, removed, file({FILE_FIELDS}))",
+        ).execute()
+        for change in results.get('changes', []):
+            item = change.get('file') or {}
+            file_id = change.get('fileId') or item.get('id')
+            if change.get('removed') or item.get('trashed'):
+                changed.pop(file_id, None)
+                removed.add(file_id)
+                continue
+            in_scope = state.folder_id is None or folders.intersection(item.get('parents') or [])
+            if item.get('mimeType') == FOLDER_MIME_TYPE and in_scope:
+                folders.add(file_id)
+            if item.get('mimeType') not in SUPPORTED_MIME_TYPES:
+                continue
+            if in_scope:
+                changed[file_id] = item
+                removed.discard(file_id)
+            elif file_id in state.files or file_id in state.pending:
+                removed.add(file_id)  # файл перенесли из синхронизируемой папки
+        page_token = results.get('nextPageToken')
+        new_token = results.get('newStartPageToken', new_token)
+    state.folders = sorted(folders)
+    known = set(state.files) | set(state.pending)
+    return list(changed.values()), [f for f in removed if f in known], new_token
+
+class SyncResult:
+    def __init__(self):
+        self.downloaded = []   # [(metadata, local path)] – ingest, then mark_synced
+        self.removed = []      # [metadata of files that disappeared]
+        self.failed = []       # [(metadata, error)]
+        self.unchanged = 0
+
+def sync_drive(service, dest_dir: str, state: DriveSyncState, folder_id: str | None = None,
+               workers: int = DRIVE_DOWNLOAD_WORKERS, chunk_size: int = DRIVE_CHUNK_SIZE,
+               service_factory=None) -> SyncResult:
+    """
+    Brings `dest_dir` in line with the Drive (or one folder tree):
+    - first run (or another folder): full paginated crawl
+    - later runs: only the changes API since the saved page token
+    New / changed files (by md5Checksum, else modifiedTime) are downloaded
+    in parallel; the caller ingests `downloaded` and drops `removed`.
+    A service object is not thread-safe (one httplib2.Http inside), so each
+    download thread gets its own from `service_factory()`; without a factory
+    downloads run one at a time on `service`.
+    `state` is re-read from its file under the state lock.
+    """
+    with _state_lock(state.path):
+        state.reload()
+        return _sync_drive(service, dest_dir, state, folder_id, workers, chunk_size, service_factory)
+
+def _sync_drive(service, dest_dir, state, folder_id, workers, chunk_size, service_factory) -> SyncResult:
+    result = SyncResult()
+    if state.page_token and state.folder_id == folder_id:
+        candidates, removed_ids, token = _changed_since(service, state)
+        # недокачанные / не загруженные в индекс в прошлый раз – ещё раз
+        fresh = {item['id'] for item in candidates}
+        candidates += [item for fid, item in state.pending.items() if fid not in fresh and fid not in removed_ids]
+    else:
+        # токен берём до обхода, чтобы не потерять изменения, случившиеся во время него
+        token = service.changes().getStartPageToken().execute().get('startPageToken')
+        folders = set()
+        candidates = list(iter_folder_files(service, folder_id, folders))
+        seen = {item['id'] for item in candidates}
+        removed_ids = [f for f in list(state.files) + list(state.pending) if f not in seen]
+        state.folders = sorted(folders)
+        state.folder_id = folder_id
+
+    to_fetch = []
+    for item in candidates:
+        if state.is_current(item):
+            result.unchanged += 1
+        else:
+            to_fetch.append(item)
+
+    os.makedirs(dest_dir, exist_ok=True)
+    if service_factory is None:
+        workers = 1
+    local = threading.local()
+
+    def thread_service():
+        if service_factory is None:
+            return service
+        if getattr(local, 'service', None) is None:
+            local.service = service_factory()
+        return local.service
+
+    def fetch(item):
+        path = os.path.join(dest_dir, local_filename(item['id'], item['name']))
+        return download_file(
+            thread_service(), item['id'], path, chunk_size=chunk_size,
+            md5=item.get('md5Checksum'), modified_time=item.get('modifiedTime'),
+        )
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [(item, pool.submit(fetch, item)) for item in to_fetch]
+        for item, future in futures:
+            try:
+                path = future.result()
+            except Exception as e:
+                logger.warning("Drive download of %s failed: %s", item.get('name'), e)
+                result.failed.append((item, str(e)))
+            else:
+                result.downloaded.append((item, path))
+            # в files файл попадёт после загрузки в индекс (mark_synced)
+            state.pending[item['id']] = item
+
+    for file_id in removed_ids:
+        info = state.files.pop(file_id, None)
+        pending = state.pending.pop(file_id, None)
+        if info is None and pending is not None:
+            info = _file_info(pending)
+        if info is not None:
+            result.removed.append({'id': file_id, **info})
+
+    # несделанное лежит в pending, так что токен можно двигать всегда
+    state.page_token = token
+    state.save()
+    return result
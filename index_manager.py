@@ -0,0 +1,767 @@
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+from uuid import uuid4
+from contextlib import contextmanager
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows: один процесс, межпроцессная блокировка не нужна
+    fcntl = None
+
+import numpy as np
+from langchain_community.vectorstores import FAISS
+
+from ann_index import index_kind, index_nbytes, load_store, maybe_upgrade, merge_into, rebuild_without
+from embedding_cache import CachedEmbeddings, EmbeddingCache
+from embedding_engine import EmbeddingEngine, engine_variant
+from lexical_index import LexicalIndex, count_terms
+from citation_index import SpanTable, span_from_metadata
+
+logger = logging.getLogger(__name__)
+
+EMBED_MODEL = os.getenv("EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+# Кэш эмбеддингов чанков на диске (повторные загрузки не кодируются заново)
+EMBED_CACHE = os.getenv("EMBED_CACHE", "1") == "1"
+
+# ----------------------------
+# Embedding model (one per process)
+# ----------------------------
+_embeddings = None
+_embeddings_lock = threading.Lock()
+
+def get_embeddings():
+    """
+    Returns the process-wide embedding model, loading it on first use.
+    """
+    global _embeddings
+    if _embeddings is None:
+        with _embeddings_lock:
+            if _embeddings is None:
+                t0 = time.perf_counter()
+                base = EmbeddingEngine(EMBED_MODEL)
+                if EMBED_CACHE:
+                    # int8 / ONNX дают чуть другие векторы – у них свой кэш
+                    variant = engine_variant()
+                    cache_name = f"{EMBED_MODEL}@{variant}" if variant else EMBED_MODEL
+                    base = CachedEmbeddings(base, EmbeddingCache(cache_name))
+                _embeddings = base
+                logger.info("Embedding model %s loaded in %.2fs", EMBED_MODEL, time.perf_counter() - t0)
+    return _embeddings
+
+def loaded_embeddings():
+    """
+    The embedding model if it is already loaded, else None (never triggers loading).
+    """
+    return _embeddings
+
+# ----------------------------
+# Resident FAISS store
+# ----------------------------
+MANIFEST_FILE = "documents.json"
+VERSION_FILE = "VERSION"
+SUMMARY_FILE = "summaries.json"
+LEXICAL_FILE = "lexical.json"
+SPANS_FILE = "spans.json"
+# Каждое изменение пишется в snapshots/<version>/, CURRENT указывает на актуальный
+SNAPSHOT_DIR = "snapshots"
+CURRENT_FILE = "CURRENT"
+LOCK_FILE = ".lock"
+SNAPSHOT_FILES = ("index.faiss", "index.pkl", MANIFEST_FILE, VERSION_FILE, LEXICAL_FILE, SPANS_FILE)
+
+INDEX_KEEP_SNAPSHOTS = int(os.getenv("INDEX_KEEP_SNAPSHOTS", "3"))
+# Как часто (с) читатель проверяет CURRENT – индекс мог обновить другой процесс
+INDEX_RELOAD_CHECK = float(os.getenv("INDEX_RELOAD_CHECK", "1.0"))
+
+def _clone_store(store):
+    """
+    Shallow copy of a LangChain FAISS store with its own faiss index,
+    so that writers never mutate the store readers are searching.
+    """
+    import faiss
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+
+    return FAISS(
+        embedding_function=store.embedding_function,
+        index=faiss.clone_index(store.index),
+        docstore=InMemoryDocstore(dict(store.docstore._dict)),
+        index_to_docstore_id=dict(store.index_to_docstore_id),
+        distance_strategy=store.distance_strategy,
+    )
+
+def _store_nbytes(store) -> int:
+    """
+    Rough resident size of a store: index vectors + chunk texts.
+    """
+    if store is None:
+        return 0
+    vectors = index_nbytes(store.index)
+    texts = sum(len(d.page_content.encode("utf-8")) for d in store.docstore._dict.values())
+    return vectors + texts
+
+class IndexManager:
+    """
+    Keeps a FAISS store resident in memory for the lifetime of the process.
+    - Loads the store from disk once, lazily
+    - Adds / removes documents incrementally (copy-on-write, then atomic swap)
+    - Keeps a manifest of indexed documents (documents.json)
+    - Keeps where every chunk came from – file, page, char span (spans.json)
+    - Records load and query timings in `stats`
+    - Can be shared by several processes: every write is an immutable snapshot
+      published through CURRENT under an fcntl lock; readers pick up a newer
+      CURRENT on their next access (checked at most every INDEX_RELOAD_CHECK s)
+    """
+
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        self._store = None
+        self._documents = {}
+        self._summaries = {}
+        self._summaries_stamp = None
+        self._lexical = LexicalIndex()
+        self._spans = SpanTable()
+        self._loaded = False
+        # Меняется при каждом изменении индекса (и переживает перезапуск),
+        # по нему инвалидируются кэши ответов
+        self.version = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.RLock()
+        self._lock_file = None
+        self._checked_at = 0.0
+        self._rows = (None, {})  # (store, docstore id -> позиция вектора в faiss)
+        self.nbytes = 0
+        self.stats = {
+            "load_seconds": None,
+            "queries": 0,
+            "last_query_ms": None,
+            "reloads": 0,
+        }
+
+    # --- on-disk layout ---
+    def _snapshot_dir(self, version: str) -> str:
+        return os.path.join(self.index_dir, SNAPSHOT_DIR, version)
+
+    def _read_current(self) -> str | None:
+        try:
+            with open(os.path.join(self.index_dir, CURRENT_FILE), "r", encoding="utf-8") as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def _data_dir(self, current: str | None) -> str:
+        # без CURRENT – индекс в старом формате, файлы прямо в index_dir
+        return self._snapshot_dir(current) if current else self.index_dir
+
+    def _load_manifest(self, data_dir: str) -> dict:
+        try:
+            with open(os.path.join(data_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _load_version(self, data_dir: str) -> str:
+        try:
+            with open(os.path.join(data_dir, VERSION_FILE), "r", encoding="utf-8") as f:
+                return f.read().strip() or uuid4().hex
+        except OSError:
+            return uuid4().hex
+
+    def _summaries_file_stamp(self):
+        # os.replace даёт новый inode, так что запись видна даже при грубом mtime
+        try:
+            st = os.stat(os.path.join(self.index_dir, SUMMARY_FILE))
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _load_summaries(self) -> dict:
+        try:
+            with open(os.path.join(self.index_dir, SUMMARY_FILE), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_summaries(self, summaries: dict):
+        os.makedirs(self.index_dir, exist_ok=True)
+        path = os.path.join(self.index_dir, SUMMARY_FILE)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(summaries, f, ensure_ascii=False)
+        os.replace(f"{path}.tmp", path)
+        with self._lock:
+            self._summaries, self._summaries_stamp = summaries, self._summaries_file_stamp()
+
+    def _fresh_summaries(self) -> dict:
+        """
+        summaries.json lives outside the snapshots and other processes write it
+        too: it is re-read whenever the file has changed.
+        """
+        stamp = self._summaries_file_stamp()
+        if stamp != self._summaries_stamp:
+            summaries = self._load_summaries()
+            with self._lock:
+                self._summaries, self._summaries_stamp = summaries, stamp
+        return self._summaries
+
+    def _read_snapshot(self) -> dict:
+        """
+        Reads the snapshot CURRENT points to. A snapshot is never modified, but an
+        old one may be garbage-collected while we read it – then CURRENT has
+        moved on and we read again.
+        """
+        for attempt in range(3):
+            current = self._read_current()
+            data_dir = self._data_dir(current)
+            try:
+                return self._read_data_dir(data_dir, current)
+            except (OSError, RuntimeError):
+                if attempt == 2 or self._read_current() == current:
+                    raise
+
+    def _read_data_dir(self, data_dir: str, current: str | None) -> dict:
+        snapshot = {
+            "store": None,
+            "documents": self._load_manifest(data_dir),
+            "summaries_stamp": self._summaries_file_stamp(),
+            "summaries": self._load_summaries(),
+            "version": current or self._load_version(data_dir),
+            "lexical": LexicalIndex(),
+            "spans": SpanTable(),
+        }
+        if not os.path.exists(os.path.join(data_dir, "index.faiss")):
+            return snapshot
+        t0 = time.perf_counter()
+        store = load_store(data_dir, get_embeddings())
+        snapshot["store"] = store
+        snapshot["lexical"] = self._load_lexical(data_dir, store)
+        snapshot["spans"] = self._load_spans(data_dir, store)
+        self.stats["load_seconds"] = time.perf_counter() - t0
+        logger.info("FAISS index %s loaded in %.2fs", data_dir, self.stats["load_seconds"])
+        return snapshot
+
+    def _apply(self, snapshot: dict):
+        # вызывается под self._lock
+        self._store = snapshot["store"]
+        self._documents = snapshot["documents"]
+        self._summaries = snapshot["summaries"]
+        self._summaries_stamp = snapshot.get("summaries_stamp")
+        self._lexical = snapshot["lexical"]
+        self._spans = snapshot["spans"]
+        self.version = snapshot["version"]
+        self._loaded = True
+        self.nbytes = _store_nbytes(self._store)
+
+    def _load_lexical(self, data_dir: str, store) -> LexicalIndex:
+        path = os.path.join(data_dir, LEXICAL_FILE)
+        try:
+            return LexicalIndex.load(path)
+        except (OSError, ValueError):
+            pass
+        # индекс собран до появления BM25 – строим по docstore один раз
+        lexical = LexicalIndex()
+        lexical.add_many((chunk_id, doc.page_content) for chunk_id, doc in store.docstore._dict.items())
+        return lexical
+
+    def _load_spans(self, data_dir: str, store) -> SpanTable:
+        path = os.path.join(data_dir, SPANS_FILE)
+        try:
+            return SpanTable.load(path)
+        except (OSError, ValueError):
+            pass
+        # индекс собран до появления таблицы – берём что есть в метаданных (без start/end)
+        spans = SpanTable()
+        spans.add_many((chunk_id, span_from_metadata(doc.metadata)) for chunk_id, doc in store.docstore._dict.items())
+        return spans
+
+    def get(self):
+        """
+        Returns the resident store, or None if no index exists yet.
+        """
+        while True:
+            # store берём под блокировкой: unload() из enforce_budget может
+            # обнулить его между проверкой _loaded и чтением
+            with self._lock:
+                if not self._loaded:
+                    self._apply(self._read_snapshot())
+                    self._checked_at = time.monotonic()
+                store = self._store
+            if not self._changed_on_disk():
+                return store
+            self._reload()
+
+    def _changed_on_disk(self) -> bool:
+        """
+        True if another process has published a newer snapshot.
+        """
+        now = time.monotonic()
+        if now - self._checked_at < INDEX_RELOAD_CHECK:
+            return False
+        self._checked_at = now
+        current = self._read_current()
+        return current is not None and current != self.version
+
+    def _reload(self):
+        # читаем новый снимок без блокировки: остальные запросы пока идут по старому
+        snapshot = self._read_snapshot()
+        with self._lock:
+            # тот же процесс мог успеть записать ещё более новую версию
+            if snapshot["version"] != self.version and snapshot["version"] == self._read_current():
+                self._apply(snapshot)
+                self.stats["reloads"] += 1
+                logger.info("Index %s reloaded at version %s", self.index_dir, self.version)
+
+    @contextmanager
+    def _exclusive(self):
+        """
+        Write lock shared with other processes (fcntl on <index_dir>/.lock).
+        Inside it the resident state is the latest published snapshot.
+        Re-entrant within the thread that holds it.
+        """
+        with self._write_lock:
+            if self._lock_file is not None:
+                yield
+                return
+            os.makedirs(self.index_dir, exist_ok=True)
+            with open(os.path.join(self.index_dir, LOCK_FILE), "a") as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                self._lock_file = f
+                try:
+                    self.get()
+                    current = self._read_current()
+                    if current is not None and current != self.version:
+                        self._reload()
+                    yield
+                finally:
+                    self._lock_file = None  # flock снимается при закрытии файла
+
+    def unload(self) -> bool:
+        """
+        Drops the in-memory store (it is already persisted); next get() reloads it.
+        Returns False if a write is in progress.
+        """
+        if not self._write_lock.acquire(blocking=False):
+            return False
+        try:
+            with self._lock:
+                self._store = None
+                self._documents = {}
+                self._summaries = {}
+                self._summaries_stamp = None
+                self._lexical = LexicalIndex()
+                self._spans = SpanTable()
+                self._loaded = False
+                self.nbytes = 0
+        finally:
+            self._write_lock.release()
+        return True
+
+    def documents(self) -> dict:
+        """
+        doc_id -> {"filename", "chunk_ids", "pages", "added_at"}
+        """
+        self.get()
+        return dict(self._documents)
+
+    def summaries(self) -> dict:
+        """
+        doc_id -> {"filename", "summary", "created_at"} for documents still in the index.
+        """
+        self.get()
+        docs = self._documents
+        return {d: info for d, info in self._fresh_summaries().items() if d in docs}
+
+    def set_summary(self, doc_id: str, summary: str) -> bool:
+        """
+        Stores a precomputed summary next to the index (summaries.json).
+        Ignored if the document was removed meanwhile.
+        """
+        with self._exclusive():
+            info = self._documents.get(doc_id)
+            if info is None:
+                return False
+            # файл перечитываем под блокировкой – в нём могут быть резюме других процессов
+            summaries = {d: v for d, v in self._fresh_summaries().items() if d in self._documents}
+            summaries[doc_id] = {"filename": info["filename"], "summary": summary, "created_at": time.time()}
+            self._write_summaries(summaries)
+        return True
+
+    def _persist(self, store, documents: dict, version: str,
+                 lexical: LexicalIndex | None = None, spans: SpanTable | None = None):
+        # Новый снимок пишется целиком во временную папку, переименовывается
+        # и только потом публикуется через CURRENT (os.replace атомарен) –
+        # читатели видят либо старый, либо новый индекс целиком.
+        final_dir = self._snapshot_dir(version)
+        tmp_dir = f"{final_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        if store is not None:
+            store.save_local(tmp_dir)
+            (lexical or self._lexical).dump(os.path.join(tmp_dir, LEXICAL_FILE))
+            (spans or self._spans).dump(os.path.join(tmp_dir, SPANS_FILE))
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+            json.dump(documents, f, ensure_ascii=False)
+        with open(os.path.join(tmp_dir, VERSION_FILE), "w", encoding="utf-8") as f:
+            f.write(version)
+        os.replace(tmp_dir, final_dir)
+
+        current_path = os.path.join(self.index_dir, CURRENT_FILE)
+        with open(f"{current_path}.tmp", "w", encoding="utf-8") as f:
+            f.write(version)
+        os.replace(f"{current_path}.tmp", current_path)
+        self._collect_snapshots(keep=version)
+
+    def _collect_snapshots(self, keep: str):
+        """
+        Deletes all but the INDEX_KEEP_SNAPSHOTS newest snapshots (a reader in
+        another process may still be loading a recent one) and legacy root files.
+        """
+        root = os.path.join(self.index_dir, SNAPSHOT_DIR)
+        snapshots = [os.path.join(root, name) for name in os.listdir(root)]
+        snapshots.sort(key=lambda path: os.path.getmtime(path), reverse=True)
+        for path in snapshots[max(1, INDEX_KEEP_SNAPSHOTS):]:
+            if os.path.basename(path) != keep:
+                shutil.rmtree(path, ignore_errors=True)
+        for name in SNAPSHOT_FILES:
+            legacy = os.path.join(self.index_dir, name)
+            if os.path.exists(legacy):
+                os.remove(legacy)
+
+    def swap(self, store, documents: dict | None = None, persist: bool = True,
+             lexical: LexicalIndex | None = None, spans: SpanTable | None = None):
+        """
+        Replaces the resident store (and the BM25 index / span table built for it,
+        if given); readers see either the old or the new ones.
+        """
+        if documents is None:
+            documents = self._documents
+        if lexical is None:
+            lexical = self._lexical
+        if spans is None:
+            spans = self._spans
+        version = uuid4().hex
+        if persist:
+            self._persist(store, documents, version, lexical, spans)
+        with self._lock:
+            self._store = store
+            self._documents = documents
+            self._lexical = lexical
+            self._spans = spans
+            self.version = version
+            self._loaded = True
+            self.nbytes = _store_nbytes(store)
+
+    def add_document(self, doc_id: str, filename: str, documents: list, vectors=None) -> list[str]:
+        """
+        Appends the given chunks to the store, embedding only them
+        (or using `vectors` if they were computed elsewhere).
+        A previously indexed document with the same filename is replaced.
+        Returns the chunk ids.
+        """
+        return self.add_document_batches(doc_id, filename, [(documents, vectors)])
+
+    def add_document_batches(self, doc_id: str, filename: str, batches, replace_filename: bool = True) -> list[str]:
+        """
+        Streaming variant of add_document: `batches` yields (documents, vectors_or_None).
+        Batches are embedded into a small staging store for this document only,
+        which is merged into the resident store in one swap at the end.
+        A document with the same doc_id is always replaced. `replace_filename=False` –
+        doc_id is a stable external id (e.g. a Drive file): documents with the same
+        name are left alone, and later uploads do not replace this one by name.
+        """
+        staging = None
+        chunk_ids = []
+        pages = set()
+        lexical_items = []
+        span_items = []
+        for documents, vectors in batches:
+            if not documents:
+                continue
+            if vectors is None:
+                vectors = get_embeddings().embed_documents([d.page_content for d in documents])
+            ids = [f"{doc_id}:{d.metadata.get('chunk', len(chunk_ids) + i)}" for i, d in enumerate(documents)]
+            text_embeddings = list(zip((d.page_content for d in documents), vectors))
+            metadatas = [d.metadata for d in documents]
+            if staging is None:
+                staging = FAISS.from_embeddings(text_embeddings, get_embeddings(), metadatas=metadatas, ids=ids)
+            else:
+                staging.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+            chunk_ids.extend(ids)
+            pages.update(d.metadata.get("page") for d in documents)
+            lexical_items.extend((chunk_id, count_terms(d.page_content)) for chunk_id, d in zip(ids, documents))
+            span_items.extend((chunk_id, span_from_metadata(d.metadata)) for chunk_id, d in zip(ids, documents))
+
+        if staging is None:
+            return []
+
+        with self._exclusive():
+            current = self._store
+            manifest = dict(self._documents)
+            stale = [
+                d for d, info in manifest.items()
+                if d == doc_id or (replace_filename and not info.get("keyed") and info.get("filename") == filename)
+            ]
+
+            store = current
+            if store is not None and stale:
+                store = self._without(store, [c for old_id in stale for c in manifest[old_id]["chunk_ids"]])
+            if store is None:
+                store = staging
+            else:
+                if store is current:
+                    store = _clone_store(current)
+                store = merge_into(store, staging)
+            store = maybe_upgrade(store)
+
+            # копии: до swap() читатели продолжают работать со старыми
+            lexical = self._lexical.copy()
+            spans = self._spans.copy()
+            for old_id in stale:
+                lexical.remove(manifest[old_id]["chunk_ids"])
+                spans.remove(manifest[old_id]["chunk_ids"])
+                manifest.pop(old_id, None)
+            lexical.add_counted(lexical_items)
+            spans.add_many(span_items)
+            manifest[doc_id] = {
+                "filename": filename,
+                "chunk_ids": chunk_ids,
+                "pages": len(pages),
+                "added_at": time.time(),
+            }
+            if not replace_filename:
+                manifest[doc_id]["keyed"] = True
+            self.swap(store, manifest, lexical=lexical, spans=spans)
+        return chunk_ids
+
+    def remove_document(self, doc_id: str) -> bool:
+        """
+        Removes one document's chunks without re-embedding the rest.
+        """
+        with self._exclusive():
+            current = self._store
+            manifest = dict(self._documents)
+            info = manifest.pop(doc_id, None)
+            if current is None or info is None:
+                return False
+
+            if not manifest:
+                self.reset()
+                return True
+
+            store = self._without(current, info["chunk_ids"])
+            lexical = self._lexical.copy()
+            lexical.remove(info["chunk_ids"])
+            spans = self._spans.copy()
+            spans.remove(info["chunk_ids"])
+            self.swap(store, manifest, lexical=lexical, spans=spans)
+            summaries = self._fresh_summaries()
+            if doc_id in summaries:
+                self._write_summaries({d: v for d, v in summaries.items() if d in manifest})
+        return True
+
+    def _without(self, store, chunk_ids):
+        """
+        New store without the given chunks (None if nothing is left).
+        """
+        if index_kind(store.index) != "flat":
+            return rebuild_without(store, chunk_ids)
+        store = _clone_store(store)
+        store.delete(chunk_ids)
+        return store
+
+    def index_kind(self) -> str:
+        """
+        Type of the resident index: "flat", "hnsw" or "ivfpq".
+        """
+        store = self.get()
+        return index_kind(store.index) if store is not None else "flat"
+
+    def chunk_texts(self, doc_id: str) -> list[str]:
+        """
+        Texts of one document's chunks, in document order.
+        """
+        store = self.get()
+        info = self._documents.get(doc_id)
+        if store is None or info is None:
+            return []
+        texts = []
+        for chunk_id in info["chunk_ids"]:
+            doc = store.docstore.search(chunk_id)
+            if hasattr(doc, "page_content"):
+                texts.append(doc.page_content)
+        return texts
+
+    def reset(self) -> bool:
+        """
+        Drops the resident store and publishes an empty snapshot
+        (so other processes drop theirs too).
+        Returns False if there was nothing to reset.
+        """
+        with self._exclusive():
+            existed = self._store is not None
+            self._lexical = LexicalIndex()
+            self._spans = SpanTable()
+            version = uuid4().hex
+            self._persist(None, {}, version)
+            summaries = os.path.join(self.index_dir, SUMMARY_FILE)
+            if os.path.exists(summaries):
+                os.remove(summaries)
+            with self._lock:
+                self._apply({
+                    "store": None, "documents": {}, "summaries": {},
+                    "lexical": self._lexical, "spans": self._spans, "version": version,
+                })
+        return existed
+
+    def similarity_search_with_score(self, question: str, k: int, embedding=None):
+        """
+        `embedding` – the already computed question vector, if the caller has one.
+        """
+        store = self.get()
+        if store is None:
+            return None
+        t0 = time.perf_counter()
+        if embedding is not None:
+            hits = store.similarity_search_with_score_by_vector(embedding, k=k)
+        else:
+            hits = store.similarity_search_with_score(question, k=k)
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        self.stats["queries"] += 1
+        self.stats["last_query_ms"] = elapsed_ms
+        logger.debug("FAISS query (k=%d) took %.1fms", k, elapsed_ms)
+        return hits
+
+    def similarity_search_batch(self, embeddings, k: int):
+        """
+        similarity_search_with_score for many query vectors in one FAISS call.
+        Returns [[(doc, score), ...], ...] in the order of `embeddings`.
+        """
+        store = self.get()
+        if store is None:
+            return None
+        t0 = time.perf_counter()
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if getattr(store, "_normalize_L2", False):
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+        scores, indices = store.index.search(vectors, k)
+        results = []
+        for row_scores, row_ids in zip(scores, indices):
+            hits = []
+            for score, i in zip(row_scores, row_ids):
+                if i == -1:
+                    continue
+                doc = store.docstore.search(store.index_to_docstore_id[int(i)])
+                if hasattr(doc, "page_content"):
+                    hits.append((doc, float(score)))
+            results.append(hits)
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        self.stats["queries"] += len(results)
+        self.stats["last_query_ms"] = elapsed_ms / max(1, len(results))
+        logger.debug("FAISS batch query (%d x k=%d) took %.1fms", len(results), k, elapsed_ms)
+        return results
+
+    def lexical_search(self, question: str, k: int) -> list[tuple[str, float]]:
+        self.get()
+        return self._lexical.search(question, k=k)
+
+    def lexical_overlap(self, question: str, chunk_ids) -> int | None:
+        self.get()
+        return self._lexical.overlap(question, chunk_ids)
+
+    def chunk_spans(self, chunk_ids) -> dict:
+        """
+        chunk_id -> Span(filename, page, start, end) from the side table.
+        """
+        self.get()
+        return self._spans.lookup(chunk_ids)
+
+    def chunk_vectors(self, chunk_ids):
+        """
+        Stored vectors of the given chunks, read back from the FAISS index
+        (no embedding calls). None if a chunk is unknown or the index keeps
+        only approximate vectors (IVF-PQ).
+        """
+        store = self.get()
+        if store is None or index_kind(store.index) == "ivfpq":
+            return None
+        cached, rows = self._rows
+        if cached is not store:
+            rows = {chunk_id: i for i, chunk_id in store.index_to_docstore_id.items()}
+            self._rows = (store, rows)
+        if any(chunk_id not in rows for chunk_id in chunk_ids):
+            return None
+        try:
+            return np.vstack([store.index.reconstruct(int(rows[chunk_id])) for chunk_id in chunk_ids])
+        except RuntimeError as e:  # индекс без reconstruct
+            logger.debug("FAISS reconstruct failed: %s", e)
+            return None
+
+    def get_chunks(self, chunk_ids) -> list:
+        store = self.get()
+        if store is None:
+            return []
+        docs = (store.docstore.search(chunk_id) for chunk_id in chunk_ids)
+        return [d for d in docs if hasattr(d, "page_content")]
+
+# ----------------------------
+# Per-tenant indexes (one per chat)
+# ----------------------------
+DEFAULT_TENANT = "default"
+INDEX_MEMORY_BUDGET_MB = float(os.getenv("INDEX_MEMORY_BUDGET_MB", "1024"))
+
+class IndexRegistry:
+    """
+    One IndexManager per tenant (Telegram chat), each persisted under
+    `<root_dir>/<tenant>`. Indexes are loaded lazily and the least recently
+    used ones are unloaded when the resident total exceeds the byte budget.
+    """
+
+    def __init__(self, root_dir: str, budget_bytes: int | None = None):
+        self.root_dir = root_dir
+        self.budget_bytes = budget_bytes if budget_bytes is not None else int(INDEX_MEMORY_BUDGET_MB * 1024 * 1024)
+        self._managers = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"evictions": 0}
+
+    def _tenant_dir(self, tenant: str) -> str:
+        safe = "".join(ch if ch.isalnum() or ch in "-_" else "_" for ch in tenant)
+        return os.path.join(self.root_dir, safe)
+
+    def get(self, tenant=None) -> IndexManager:
+        key = str(tenant) if tenant is not None else DEFAULT_TENANT
+        with self._lock:
+            manager = self._managers.get(key)
+            if manager is None:
+                manager = IndexManager(self._tenant_dir(key))
+                self._managers[key] = manager
+            self._managers.move_to_end(key)
+        return manager
+
+    def resident_bytes(self) -> int:
+        with self._lock:
+            return sum(m.nbytes for m in self._managers.values())
+
+    def enforce_budget(self, keep=None):
+        """
+        Unloads least recently used indexes until the resident total fits the budget.
+        The tenant given in `keep` (the one being served) is never evicted.
+        Managers stay registered (requests in flight may hold them) – only
+        their stores are dropped and reloaded on the next get().
+        """
+        keep = str(keep) if keep is not None else DEFAULT_TENANT
+        with self._lock:
+            total = sum(m.nbytes for m in self._managers.values())
+            for key in list(self._managers):
+                if total <= self.budget_bytes:
+                    break
+                if key == keep:
+                    continue
+                manager = self._managers[key]
+                freed = manager.nbytes
+                if freed and manager.unload():
+                    total -= freed
+                    self.stats["evictions"] += 1
+                    logger.info("Evicted index %s (%.1f MB)", key, freed / 1024 / 1024)
@@ -0,0 +1,268 @@
+import os
+import time
+import asyncio
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from pdf_handler import (
+    EMBED_BATCH_SIZE,
+    count_pdf_pages,
+    iter_pdf_pages,
+    iter_pages_from_file,
+    iter_chunks,
+    chunk_pages,
+    iter_batches,
+    embed_chunks,
+    index_chunk_batches,
+    new_doc_id,
+    precompute_summary,
+    PRECOMPUTE_SUMMARIES,
+)
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# ----------------------------
+# Settings
+# ----------------------------
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))            # документов одновременно
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "20"))     # ожидающих в очереди
+INGEST_PROCESSES = int(os.getenv("INGEST_PROCESSES", str(max(1, (os.cpu_count() or 2) // 2))))
+INGEST_HISTORY = int(os.getenv("INGEST_HISTORY", "200"))
+PDF_PAGE_WINDOW = int(os.getenv("PDF_PAGE_WINDOW", "16"))         # страниц на одну задачу в пуле
+PROGRESS_INTERVAL = float(os.getenv("INGEST_PROGRESS_INTERVAL", "3"))
+
+STAGES = ("queued", "extract", "embed", "index", "done")
+STAGE_TITLES = {
+    "queued": "в очереди",
+    "extract": "извлечение текста и разбиение на фрагменты",
+    "embed": "векторизация",
+    "index": "добавление в индекс",
+    "done": "готово",
+    "failed": "ошибка",
+}
+
+class QueueFullError(Exception):
+    pass
+
+def _mp_context():
+    # к старту пула уже работают потоки (батчер эмбеддингов, torch, metrics) –
+    # fork копирует их захваченные локи, и дочерний процесс может зависнуть
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+class IngestJob:
+    """
+    One document moving through extract -> chunk -> embed -> index.
+    `on_progress` (async, optional) is awaited on every stage change.
+    """
+
+    def __init__(self, path: str, filename: str, tenant=None, on_progress=None, doc_id=None):
+        # свой doc_id (файл с Диска) – документ заменяется по нему, а не по имени файла
+        self.id = doc_id or new_doc_id()
+        self.keyed = doc_id is not None
+        self.path = path
+        self.filename = filename
+        self.tenant = tenant
+        self.on_progress = on_progress
+        self.stage = "queued"
+        self.error = None
+        self.chunks = 0
+        self.pages_done = 0
+        self.pages_total = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def finished(self) -> bool:
+        return self.stage in ("done", "failed")
+
+    def describe(self) -> str:
+        if self.stage == "failed":
+            return f"❌ {self.filename}: {self.error}"
+        if self.stage == "done":
+            return f"✅ {self.filename}: готово ({self.chunks} фрагм., {self.finished_at - self.created_at:.1f} c)"
+        step = STAGES.index(self.stage)
+        text = f"⏳ {self.filename}: {STAGE_TITLES[self.stage]} ({step}/{len(STAGES) - 2})"
+        if self.pages_total:
+            text += f", стр. {self.pages_done}/{self.pages_total}"
+        if self.chunks:
+            text += f", фрагм. {self.chunks}"
+        return text
+
+def _chunk_pdf_window(path: str, start: int, stop: int, doc_id: str, filename: str):
+    """
+    Runs in a worker process: extracts and chunks pages [start, stop).
+    """
+    return chunk_pages(iter_pdf_pages(path, start, stop), doc_id, filename)
+
+class IngestQueue:
+    """
+    Background document ingestion.
+    - Bounded queue: submit() fails fast when it is full (backpressure)
+    - INGEST_WORKERS jobs run concurrently; PDF pages are extracted and chunked
+      in a process pool, embedding and indexing run in threads (torch and faiss release the GIL)
+    - Documents are streamed page window by page window, so memory does not grow with file size
+    - Job status is kept for /status
+    """
+
+    def __init__(self, workers: int = INGEST_WORKERS, queue_size: int = INGEST_QUEUE_SIZE, processes: int = INGEST_PROCESSES):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.processes = processes
+        self._queue = None
+        self._tasks = []
+        self._pool = None
+        self._jobs = deque(maxlen=INGEST_HISTORY)
+        self._background = set()
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=_mp_context())
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in list(self._tasks) + list(self._background):
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._background, return_exceptions=True)
+        self._tasks = []
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def submit(self, job: IngestJob) -> IngestJob:
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFullError("ingest queue is full")
+        self._jobs.append(job)
+        return job
+
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def jobs(self, tenant=None) -> list[IngestJob]:
+        return [j for j in self._jobs if tenant is None or j.tenant == tenant]
+
+    async def _set_stage(self, job: IngestJob, stage: str):
+        if job.finished:
+            return  # запоздавший отчёт из потока не должен перетирать итог
+        job.stage = stage
+        if stage in ("done", "failed"):
+            job.finished_at = time.time()
+        if job.on_progress is not None:
+            try:
+                await job.on_progress(job)
+            except Exception:
+                logger.exception("Progress callback failed for %s", job.filename)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception("Ingest of %s failed", job.filename)
+                job.error = str(e)
+                await self._set_stage(job, "failed")
+            finally:
+                self._queue.task_done()
+
+    def _iter_chunk_windows(self, job: IngestJob):
+        """
+        Yields lists of chunks in document order.
+        PDFs are split into page windows that are extracted in the process pool,
+        at most `processes` windows ahead; DOCX/TXT are streamed block by block.
+        """
+        if not job.path.lower().endswith(".pdf"):
+            pages = iter_pages_from_file(job.path)
+            yield from iter_batches(iter_chunks(pages, job.id, job.filename), EMBED_BATCH_SIZE)
+            return
+
+        total = count_pdf_pages(job.path)
+        job.pages_total = total
+        windows = [(start, min(start + PDF_PAGE_WINDOW, total)) for start in range(0, total, PDF_PAGE_WINDOW)]
+        in_flight = deque()
+        for start, stop in windows:
+            in_flight.append((stop, self._pool.submit(_chunk_pdf_window, job.path, start, stop, job.id, job.filename)))
+            if len(in_flight) >= self.processes:
+                stop_done, future = in_flight.popleft()
+                job.pages_done = stop_done
+                yield future.result()
+        while in_flight:
+            stop_done, future = in_flight.popleft()
+            job.pages_done = stop_done
+            yield future.result()
+
+    def _pipeline(self, job: IngestJob, report):
+        """
+        Runs in a thread: extract -> chunk -> embed batch -> staged index add.
+        Only a few batches are alive at any time, whatever the file size.
+        """
+        def batches():
+            n = 0
+            for window in self._iter_chunk_windows(job):
+                # нумерация фрагментов сквозная по всему документу
+                for doc in window:
+                    doc.metadata["chunk"] = n
+                    n += 1
+                for batch in iter_batches(window, EMBED_BATCH_SIZE):
+                    report("embed")
+                    vectors = embed_chunks(batch)
+                    job.chunks += len(batch)
+                    yield batch, vectors
+            report("index")
+
+        return index_chunk_batches(batches(), job.filename, job.id, job.tenant, replace_filename=not job.keyed)
+
+    async def _run(self, job: IngestJob):
+        loop = asyncio.get_running_loop()
+        last_report = [0.0]
+        posted = []
+
+        def report(stage: str):
+            # вызывается из потока; сообщение правим не чаще PROGRESS_INTERVAL
+            now = time.monotonic()
+            if stage == job.stage and now - last_report[0] < PROGRESS_INTERVAL:
+                return
+            last_report[0] = now
+            posted.append(asyncio.run_coroutine_threadsafe(self._set_stage(job, stage), loop))
+
+        await self._set_stage(job, "extract")
+        t0 = time.perf_counter()
+        try:
+            chunk_ids = await asyncio.to_thread(self._pipeline, job, report)
+        finally:
+            # отчёты этапов из потока должны дойти раньше "готово" / "ошибка"
+            await asyncio.gather(*(asyncio.wrap_future(f) for f in posted), return_exceptions=True)
+        if not chunk_ids:
+            raise ValueError("в документе не найден текст")
+
+        elapsed = time.perf_counter() - t0
+        logger.info(
+            "Ingested %s: %d chunks in %.2fs (%.0f chunks/sec)",
+            job.filename, job.chunks, elapsed, job.chunks / elapsed if elapsed else 0.0,
+        )
+        metrics.observe("ingest_seconds", elapsed)
+        metrics.inc("ingest_chunks_total", job.chunks)
+        await self._set_stage(job, "done")
+
+        if PRECOMPUTE_SUMMARIES:
+            # Документ уже доступен для /askfile, резюме считаем в фоне
+            task = asyncio.create_task(self._summarize(job))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+
+    async def _summarize(self, job: IngestJob):
+        t0 = time.perf_counter()
+        try:
+            await precompute_summary(job.id, job.tenant)
+        except Exception:
+            logger.exception("Summary of %s failed", job.filename)
+            return
+        logger.info("Summarized %s in %.2fs", job.filename, time.perf_counter() - t0)
@@ -0,0 +1,218 @@
+import re
+import math
+import json
+import heapq
+import threading
+from collections import Counter
+
+try:
+    import snowballstemmer
+except ImportError:  # стеммер не обязателен, есть упрощённый запасной вариант
+    snowballstemmer = None
+
+# ----------------------------
+# Tokenization (RU / EN)
+# ----------------------------
+_WORD_RE = re.compile(r"[^\W_]+", re.UNICODE)
+_CYRILLIC_RE = re.compile(r"[а-я]")
+
+STOPWORDS = {
+    # ru
+    "и", "в", "во", "не", "что", "он", "на", "я", "с", "со", "как", "а", "то", "все", "она", "так",
+    "его", "но", "да", "ты", "к", "у", "же", "вы", "за", "бы", "по", "только", "ее", "мне", "было",
+    "вот", "от", "меня", "еще", "нет", "о", "из", "ему", "теперь", "когда", "даже", "ну", "ли",
+    "если", "уже", "или", "ни", "быть", "был", "него", "до", "вас", "нибудь", "опять", "уж", "вам",
+    "ведь", "там", "потом", "себя", "ничего", "ей", "может", "они", "тут", "где", "есть", "надо",
+    "ней", "для", "мы", "тебя", "их", "чем", "была", "сам", "чтоб", "без", "будто", "чего", "раз",
+    "тоже", "себе", "под", "будет", "ж", "тогда", "кто", "этот", "того", "потому", "этого", "какой",
+    "совсем", "ним", "здесь", "этом", "один", "почти", "мой", "тем", "чтобы", "нее", "были", "куда",
+    "зачем", "всех", "можно", "при", "об", "другой", "хоть", "после", "над", "больше", "тот", "через",
+    "эти", "нас", "про", "всего", "них", "какая", "много", "разве", "три", "эту", "моя", "впрочем",
+    "хорошо", "свою", "этой", "перед", "иногда", "лучше", "чуть", "том", "нельзя", "такой", "им",
+    "более", "всегда", "конечно", "всю", "между", "это", "такие", "почему", "какие", "каких", "ли",
+    # en
+    "a", "an", "the", "and", "or", "but", "if", "of", "at", "by", "for", "with", "about", "to", "from",
+    "in", "on", "is", "are", "was", "were", "be", "been", "being", "do", "does", "did", "what", "which",
+    "who", "whom", "this", "that", "these", "those", "how", "why", "when", "where", "it", "its", "as",
+    "not", "no", "can", "will", "should", "there", "their", "they", "them", "we", "you", "i",
+}
+
+_RU_SUFFIXES = sorted(
+    [
+        "иями", "ями", "ами", "иях", "ях", "ах", "ией", "ей", "ой", "ий", "ый", "ая", "яя", "ое", "ее",
+        "ые", "ие", "ого", "его", "ому", "ему", "ыми", "ими", "ом", "ем", "ам", "ям", "ую", "юю",
+        "ость", "ости", "ение", "ения", "ении", "ать", "ять", "ить", "еть", "ут", "ют", "ет", "ит",
+        "ла", "ло", "ли", "ов", "ев", "ы", "и", "а", "я", "о", "е", "у", "ю", "ь",
+    ],
+    key=len,
+    reverse=True,
+)
+_EN_SUFFIXES = ["ingly", "edly", "ing", "ies", "ied", "ed", "es", "ly", "s"]
+
+def _light_stem(word: str) -> str:
+    suffixes = _RU_SUFFIXES if _CYRILLIC_RE.search(word) else _EN_SUFFIXES
+    for suffix in suffixes:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 4:
+            return word[: -len(suffix)]
+    return word
+
+class _Stemmer:
+    def __init__(self):
+        self._ru = self._en = None
+        if snowballstemmer is not None:
+            self._ru = snowballstemmer.stemmer("russian")
+            self._en = snowballstemmer.stemmer("english")
+        self._cache = {}
+
+    def stem(self, word: str) -> str:
+        stem = self._cache.get(word)
+        if stem is None:
+            if self._ru is None:
+                stem = _light_stem(word)
+            elif _CYRILLIC_RE.search(word):
+                stem = self._ru.stemWord(word)
+            else:
+                stem = self._en.stemWord(word)
+            if len(self._cache) < 200_000:
+                self._cache[word] = stem
+        return stem
+
+_stemmer = _Stemmer()
+
+def tokenize(text: str) -> list[str]:
+    """
+    Lowercased, stopword-free, stemmed terms.
+    """
+    words = _WORD_RE.findall(text.lower().replace("ё", "е"))
+    return [_stemmer.stem(w) for w in words if w not in STOPWORDS and (len(w) > 1 or w.isdigit())]
+
+def count_terms(text: str) -> dict:
+    return dict(Counter(tokenize(text)))
+
+# ----------------------------
+# BM25 inverted index
+# ----------------------------
+class LexicalIndex:
+    """
+    Incremental BM25 index over chunks, kept next to the FAISS store.
+    - `_terms[chunk_id]` – term frequencies of the chunk (what gets persisted)
+    - `_postings[term]` – {chunk_id: tf} and `_lengths`, rebuilt on load
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._terms = {}
+        self._lengths = {}
+        self._postings = {}
+        self._total_len = 0
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._terms)
+
+    def __contains__(self, chunk_id) -> bool:
+        return chunk_id in self._terms
+
+    def _add_counts(self, chunk_id: str, counts: dict):
+        self._terms[chunk_id] = counts
+        self._lengths[chunk_id] = sum(counts.values())
+        self._total_len += self._lengths[chunk_id]
+        for term, tf in counts.items():
+            self._postings.setdefault(term, {})[chunk_id] = tf
+
+    def add(self, chunk_id: str, text: str):
+        self.add_many([(chunk_id, text)])
+
+    def add_many(self, items):
+        self.add_counted([(chunk_id, count_terms(text)) for chunk_id, text in items])
+
+    def add_counted(self, counted):
+        """
+        Adds [(chunk_id, count_terms(text)), ...] – counting can be done outside any lock.
+        """
+        with self._lock:
+            for chunk_id, counts in counted:
+                if chunk_id in self._terms:
+                    self._remove_one(chunk_id)
+                self._add_counts(chunk_id, counts)
+
+    def _remove_one(self, chunk_id: str):
+        counts = self._terms.pop(chunk_id, None)
+        if counts is None:
+            return
+        self._total_len -= self._lengths.pop(chunk_id, 0)
+        for term in counts:
+            posting = self._postings.get(term)
+            if posting is not None:
+                posting.pop(chunk_id, None)
+                if not posting:
+                    del self._postings[term]
+
+    def remove(self, chunk_ids):
+        with self._lock:
+            for chunk_id in chunk_ids:
+                self._remove_one(chunk_id)
+
+    def search(self, query: str, k: int = 8) -> list[tuple[str, float]]:
+        """
+        Top-k chunks by BM25: [(chunk_id, score), ...], best first.
+        """
+        terms = set(tokenize(query))
+        with self._lock:
+            n = len(self._terms)
+            if not n or not terms:
+                return []
+            avg_len = self._total_len / n or 1.0
+            scores = {}
+            for term in terms:
+                posting = self._postings.get(term)
+                if not posting:
+                    continue
+                idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+                for chunk_id, tf in posting.items():
+                    doc_len = self._lengths[chunk_id]
+                    norm = tf + self.k1 * (1 - self.b + self.b * doc_len / avg_len)
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (self.k1 + 1) / norm
+        return heapq.nlargest(k, scores.items(), key=lambda kv: kv[1])
+
+    def overlap(self, question: str, chunk_ids) -> int | None:
+        """
+        Number of distinct question terms present in the given chunks,
+        from precomputed term statistics. None if the chunks are unknown.
+        """
+        terms = set(tokenize(question))
+        with self._lock:
+            known = [c for c in chunk_ids if c in self._terms]
+            if not known:
+                return None
+            return sum(1 for t in terms if any(t in self._terms[c] for c in known))
+
+    def copy(self) -> "LexicalIndex":
+        """
+        Independent copy to modify while readers keep using this one.
+        Term counts of a chunk are never changed in place, so they are shared.
+        """
+        with self._lock:
+            index = LexicalIndex(k1=self.k1, b=self.b)
+            index._terms = dict(self._terms)
+            index._lengths = dict(self._lengths)
+            index._postings = {term: dict(posting) for term, posting in self._postings.items()}
+            index._total_len = self._total_len
+        return index
+
+    # --- persistence ---
+    def dump(self, path: str):
+        with self._lock:
+            data = {"k1": self.k1, "b": self.b, "terms": self._terms}
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path: str) -> "LexicalIndex":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        index = cls(k1=data.get("k1", 1.5), b=data.get("b", 0.75))
+        for chunk_id, counts in data.get("terms", {}).items():
+            index._add_counts(chunk_id, counts)
+        return index
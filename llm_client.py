@@ -0,0 +1,395 @@
+import os
+import json
+import time
+import hashlib
+import asyncio
+import logging
+
+import httpx
+import requests
+from dotenv import load_dotenv
+
+import metrics
+from llm_scheduler import PRIORITY_INTERACTIVE, get_scheduler, model_health, parse_retry_after
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# ----------------------------
+# OpenRouter LLM (robust routing)
+# ----------------------------
+OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+
+DEFAULT_MODELS = [
+    "deepseek/deepseek-chat-v3-0324",  # stable id (may require credits)
+    "deepseek/deepseek-chat",          # alias / fallback
+]
+
+def _models_from_env():
+    raw = os.getenv("OPENROUTER_MODELS", "").strip()
+    if not raw:
+        return DEFAULT_MODELS
+    return [m.strip() for m in raw.split(",") if m.strip()]
+
+OPENROUTER_MODELS = _models_from_env()
+
+HEADERS = {
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}" if OPENROUTER_API_KEY else "",
+    "Content-Type": "application/json",
+    "HTTP-Referer": os.getenv("OPENROUTER_REFERER", "http://localhost"),
+    "X-Title": os.getenv("OPENROUTER_APP_NAME", "BizSense"),
+}
+
+OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
+
+# --- Timeouts / pooling ---
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "16"))
+
+def _model_timeouts_from_env():
+    """
+    OPENROUTER_MODEL_TIMEOUTS=model_a=30,model_b=90
+    """
+    raw = os.getenv("OPENROUTER_MODEL_TIMEOUTS", "").strip()
+    timeouts = {}
+    for item in raw.split(","):
+        name, sep, value = item.strip().rpartition("=")
+        if not sep or not name:
+            continue
+        try:
+            timeouts[name.strip()] = float(value)
+        except ValueError:
+            logger.warning("Ignoring bad timeout %r for model %s", value, name)
+    return timeouts
+
+OPENROUTER_MODEL_TIMEOUTS = _model_timeouts_from_env()
+
+def _timeout_for(model: str) -> float:
+    return OPENROUTER_MODEL_TIMEOUTS.get(model, LLM_TIMEOUT)
+
+MISSING_KEY_TEXT = "Ошибка: не задан OPENROUTER_API_KEY в переменных окружения."
+NO_REPLY_TEXT = "Не удалось получить ответ от LLM."
+
+class LLMError(str):
+    """
+    Readable error text returned (or yielded, when streaming) instead of an answer.
+    It is a str, so callers can show it as is; they tell it from an answer by type.
+    """
+
+def is_error_reply(text: str) -> bool:
+    """
+    True for an empty reply or an LLMError – never decided by the wording,
+    an answer may well start with "Ошибка".
+    """
+    return not text or isinstance(text, LLMError)
+
+def join_reply(parts) -> str:
+    """
+    Streamed deltas -> the whole reply; an LLMError if any delta was one.
+    """
+    text = "".join(parts)
+    return LLMError(text) if any(isinstance(p, LLMError) for p in parts) else text
+
+def _request_body(model: str, messages, temperature: float, max_tokens: int | None) -> dict:
+    body = {"model": model, "messages": messages, "temperature": temperature}
+    if max_tokens is not None:
+        body["max_tokens"] = max_tokens
+    return body
+
+def _model_failed(status_code: int) -> bool:
+    """
+    Responses that say something about the model / provider rather than about
+    our request: worth trying another model and counting against its health.
+    """
+    return status_code in (402, 404, 408, 429) or status_code >= 500
+
+def _error_message(status_code: int, model: str, payload, raw_text: str) -> tuple[str, bool]:
+    """
+    Builds a readable error for a non-200 response.
+    Returns (message, try_next_model).
+    """
+    err_json = payload if isinstance(payload, dict) else {"raw": raw_text}
+    msg = (err_json.get("error") or {}).get("message") or str(err_json)
+    text = f"Ошибка запроса к LLM ({status_code}) для модели {model}: {msg}"
+    return LLMError(text), _model_failed(status_code)
+
+def _record(model: str, outcome: str, started: float, data=None):
+    """
+    Request latency / outcome per model, model health and tokens from OpenRouter's `usage`.
+    """
+    elapsed = time.perf_counter() - started
+    metrics.observe("llm_request_seconds", elapsed, model=model, outcome=outcome)
+    metrics.inc("llm_requests_total", model=model, outcome=outcome)
+    if outcome == "ok":
+        model_health.record(model, True, elapsed)
+    elif outcome == "error" or (outcome.startswith("http_") and _model_failed(int(outcome[5:]))):
+        model_health.record(model, False)
+    usage = data.get("usage") if isinstance(data, dict) else None
+    if usage:
+        for kind in ("prompt", "completion"):
+            tokens = usage.get(f"{kind}_tokens")
+            if tokens:
+                metrics.inc("llm_tokens_total", tokens, model=model, kind=kind)
+
+def _fallback(model: str):
+    metrics.inc("llm_fallbacks_total", model=model)
+
+def _models() -> list[str]:
+    """
+    OPENROUTER_MODELS, healthiest first.
+    """
+    return model_health.order(OPENROUTER_MODELS)
+
+def _reply_text(data) -> str:
+    try:
+        return data["choices"][0]["message"]["content"]
+    except Exception:
+        return LLMError(f"Ошибка разбора ответа LLM: {data}")
+
+def call_openrouter(messages, temperature: float = 0.3, max_tokens: int | None = None) -> str:
+    """
+    Tries models (healthiest first) until one responds successfully.
+    Returns assistant text or an LLMError with a readable message.
+    Blocking; async code should use `acall_openrouter`.
+    """
+    if not OPENROUTER_API_KEY:
+        return LLMError(MISSING_KEY_TEXT)
+
+    last_err = None
+    models = _models()
+    for i, model in enumerate(models):
+        if i:
+            _fallback(models[i - 1])
+        body = _request_body(model, messages, temperature, max_tokens)
+
+        started = time.perf_counter()
+        try:
+            resp = requests.post(OPENROUTER_URL, headers=HEADERS, json=body, timeout=_timeout_for(model))
+        except Exception as e:
+            _record(model, "error", started)
+            last_err = LLMError(f"Ошибка запроса к LLM: {e}")
+            continue
+
+        if resp.status_code == 200:
+            data = resp.json()
+            _record(model, "ok", started, data)
+            return _reply_text(data)
+
+        try:
+            payload = resp.json()
+        except Exception:
+            payload = None
+
+        _record(model, f"http_{resp.status_code}", started)
+        last_err, try_next = _error_message(resp.status_code, model, payload, resp.text)
+        if try_next:
+            continue  # try next model
+
+        break
+
+    return last_err or LLMError(NO_REPLY_TEXT)
+
+# ----------------------------
+# Async client (pooled, keep-alive)
+# ----------------------------
+_client: httpx.AsyncClient | None = None
+_client_loop = None
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Returns the shared AsyncClient for the running event loop.
+    Connections are pooled and kept alive between requests.
+    """
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop or _client.is_closed:
+        _client = httpx.AsyncClient(
+            headers=HEADERS,
+            timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONCURRENCY,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE,
+            ),
+        )
+        _client_loop = loop
+    return _client
+
+async def aclose_client():
+    global _client, _client_loop
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+    _client_loop = None
+
+def _prompt_key(messages, temperature: float, max_tokens: int | None, priority: int) -> str:
+    # приоритет входит в ключ: /askfile не должен ждать в очереди фонового
+    # вызова (резюме, пакет вопросов) с тем же промптом
+    raw = json.dumps([messages, temperature, max_tokens, priority], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+async def acall_openrouter(messages, temperature: float = 0.3, max_tokens: int | None = None,
+                           user=None, priority: int = PRIORITY_INTERACTIVE) -> str:
+    """
+    Async counterpart of `call_openrouter`: same LLMError texts, but never blocks
+    the event loop. Requests go through the LLM scheduler (priority, per-user
+    fairness, rate limit); identical prompts in flight are sent only once.
+    """
+    if not OPENROUTER_API_KEY:
+        return LLMError(MISSING_KEY_TEXT)
+
+    scheduler = get_scheduler(LLM_MAX_CONCURRENCY)
+    key = _prompt_key(messages, temperature, max_tokens, priority)
+    return await scheduler.single_flight(key, lambda: _acall(messages, temperature, max_tokens, user, priority))
+
+async def _acall(messages, temperature: float, max_tokens: int | None, user, priority: int) -> str:
+    client = get_async_client()
+    scheduler = get_scheduler(LLM_MAX_CONCURRENCY)
+    last_err = None
+    # После 429 на последней модели пробуем её ещё раз –
+    # планировщик придержит запрос до истечения Retry-After
+    retried = False
+    models = _models()
+    prev = None
+    while models:
+        model = models.pop(0)
+        if prev is not None and prev != model:
+            _fallback(prev)
+        prev = model
+        body = _request_body(model, messages, temperature, max_tokens)
+
+        async with scheduler.slot(user, priority):
+            started = time.perf_counter()
+            try:
+                resp = await client.post(OPENROUTER_URL, json=body, timeout=_timeout_for(model))
+            except Exception as e:
+                _record(model, "error", started)
+                last_err = LLMError(f"Ошибка запроса к LLM: {e}")
+                continue
+
+        if resp.status_code == 200:
+            data = resp.json()
+            _record(model, "ok", started, data)
+            return _reply_text(data)
+
+        try:
+            payload = resp.json()
+        except Exception:
+            payload = None
+
+        _record(model, f"http_{resp.status_code}", started)
+        last_err, try_next = _error_message(resp.status_code, model, payload, resp.text)
+        if resp.status_code == 429:
+            scheduler.pause(parse_retry_after(resp.headers.get("Retry-After")))
+            if not models and not retried:
+                retried = True
+                models.append(model)
+        if try_next:
+            continue  # try next model
+
+        break
+
+    return last_err or LLMError(NO_REPLY_TEXT)
+
+# ----------------------------
+# Streaming (SSE)
+# ----------------------------
+def _delta_text(data) -> str:
+    try:
+        return data["choices"][0]["delta"].get("content") or ""
+    except Exception:
+        return ""
+
+async def astream_openrouter(messages, temperature: float = 0.3, max_tokens: int | None = None,
+                             user=None, priority: int = PRIORITY_INTERACTIVE):
+    """
+    Streams the completion as text deltas (OpenRouter SSE, `stream: true`).
+    Scheduling and model fallback work as in `acall_openrouter` as long as
+    nothing has been yielded yet; errors are yielded as an LLMError.
+    Streams are not deduplicated – each caller needs its own deltas.
+    """
+    if not OPENROUTER_API_KEY:
+        yield LLMError(MISSING_KEY_TEXT)
+        return
+
+    client = get_async_client()
+    scheduler = get_scheduler(LLM_MAX_CONCURRENCY)
+    last_err = None
+    retried = False
+    models = _models()
+    prev = None
+    while models:
+        model = models.pop(0)
+        if prev is not None and prev != model:
+            _fallback(prev)
+        prev = model
+        body = _request_body(model, messages, temperature, max_tokens)
+        body["stream"] = True
+        body["usage"] = {"include": True}  # OpenRouter присылает usage последним чанком
+        yielded = False
+        stream_err = None
+        usage_chunk = None
+        retry_after = None
+
+        async with scheduler.slot(user, priority):
+            started = time.perf_counter()
+            try:
+                async with client.stream("POST", OPENROUTER_URL, json=body, timeout=_timeout_for(model)) as resp:
+                    if resp.status_code != 200:
+                        raw = (await resp.aread()).decode("utf-8", errors="replace")
+                        try:
+                            payload = json.loads(raw)
+                        except Exception:
+                            payload = None
+                        _record(model, f"http_{resp.status_code}", started)
+                        last_err, try_next = _error_message(resp.status_code, model, payload, raw)
+                        if resp.status_code == 429:
+                            retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                        elif not try_next:
+                            break
+                    else:
+                        async for line in resp.aiter_lines():
+                            # SSE: "data: {...}", комментарии ": OPENROUTER PROCESSING", пустые строки
+                            if not line.startswith("data:"):
+                                continue
+                            data = line[len("data:"):].strip()
+                            if data == "[DONE]":
+                                break
+                            try:
+                                chunk = json.loads(data)
+                            except ValueError:
+                                continue
+                            if chunk.get("error"):
+                                err = chunk["error"]
+                                message = err.get("message", err) if isinstance(err, dict) else err
+                                stream_err = LLMError(f"Ошибка LLM для модели {model}: {message}")
+                                break
+                            if chunk.get("usage"):
+                                usage_chunk = chunk
+                            text = _delta_text(chunk)
+                            if text:
+                                yielded = True
+                                yield text
+                        _record(model, "error" if stream_err else "ok", started, usage_chunk)
+            except Exception as e:
+                _record(model, "error", started)
+                stream_err = LLMError(f"Ошибка запроса к LLM: {e}")
+
+        if retry_after is not None:
+            scheduler.pause(retry_after)
+            if not models and not retried:
+                retried = True
+                models.append(model)
+            continue
+        if yielded:
+            # Часть ответа уже отдана – другую модель не пробуем
+            if stream_err:
+                yield LLMError(f"\n\n{stream_err}")
+            return
+        if stream_err:
+            last_err = stream_err
+            continue
+
+    yield last_err or LLMError(NO_REPLY_TEXT)
@@ -0,0 +1,290 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+# ----------------------------
+# Settings
+# ----------------------------
+LLM_RATE_PER_SEC = float(os.getenv("LLM_RATE_PER_SEC", "5"))      # запросов в секунду (0 – без лимита)
+LLM_BURST = int(os.getenv("LLM_BURST", "10"))
+LLM_RETRY_AFTER_DEFAULT = float(os.getenv("LLM_RETRY_AFTER_DEFAULT", "5"))
+# Ожидание в очереди понижает "номер" приоритета на 1 каждые LLM_PRIORITY_AGING секунд,
+# чтобы фоновые резюме не голодали под постоянной нагрузкой
+LLM_PRIORITY_AGING = float(os.getenv("LLM_PRIORITY_AGING", "20"))
+LLM_HEALTH_COOLDOWN = float(os.getenv("LLM_HEALTH_COOLDOWN", "10"))   # первая пауза модели после сбоя
+
+# Классы приоритета: меньше – важнее
+PRIORITY_INTERACTIVE = 0   # /askfile
+PRIORITY_CHAT = 1          # свободный чат
+PRIORITY_BACKGROUND = 2    # резюме при загрузке
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_CHAT, PRIORITY_BACKGROUND)
+
+def parse_retry_after(value) -> float:
+    """
+    Retry-After header: delta seconds or an HTTP date. Falls back to LLM_RETRY_AFTER_DEFAULT.
+    """
+    if not value:
+        return LLM_RETRY_AFTER_DEFAULT
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return LLM_RETRY_AFTER_DEFAULT
+
+# ----------------------------
+# Per-model health
+# ----------------------------
+class ModelHealth:
+    """
+    Success rate (EWMA) and latency (EWMA) per model; consecutive failures put
+    a model on an exponentially growing cooldown. Thread-safe, shared by the
+    sync and async clients.
+    """
+
+    def __init__(self, alpha: float = 0.2, cooldown: float = LLM_HEALTH_COOLDOWN, max_cooldown: float = 300.0):
+        self.alpha = alpha
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _get(self, model: str) -> dict:
+        info = self._models.get(model)
+        if info is None:
+            info = self._models[model] = {"success": 1.0, "latency": None, "failures": 0, "cooldown_until": 0.0}
+        return info
+
+    def order(self, models: list[str]) -> list[str]:
+        """
+        Healthy models first (by success rate, then latency, then configured order),
+        models on cooldown last – they are still tried if nothing else works.
+        """
+        now = time.monotonic()
+        with self._lock:
+            def key(item):
+                pos, model = item
+                info = self._get(model)
+                cooling = info["cooldown_until"] > now
+                return (cooling, -round(info["success"], 1), round(info["latency"] or 0.0, 1), pos)
+            return [model for _pos, model in sorted(enumerate(models), key=key)]
+
+    def record(self, model: str, ok: bool, latency: float | None = None):
+        with self._lock:
+            info = self._get(model)
+            info["success"] += self.alpha * ((1.0 if ok else 0.0) - info["success"])
+            if ok:
+                info["failures"] = 0
+                info["cooldown_until"] = 0.0
+                if latency is not None:
+                    prev = info["latency"]
+                    info["latency"] = latency if prev is None else prev + self.alpha * (latency - prev)
+            else:
+                info["failures"] += 1
+                pause = min(self.max_cooldown, self.cooldown * 2 ** (info["failures"] - 1))
+                info["cooldown_until"] = time.monotonic() + pause
+                logger.info("Model %s failed %d time(s) in a row, cooling down for %.0fs", model, info["failures"], pause)
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                m: {**info, "cooldown_until": max(0.0, info["cooldown_until"] - now)}
+                for m, info in self._models.items()
+            }
+
+model_health = ModelHealth()
+
+# ----------------------------
+# Scheduler (one per event loop)
+# ----------------------------
+class LLMScheduler:
+    """
+    Decides which waiting request may talk to OpenRouter next.
+    - at most `max_concurrency` requests in flight
+    - token bucket (`rate`/s, `burst`), paused entirely while a Retry-After is pending
+    - strict priority classes with aging; round-robin between users inside a class
+    - single-flight: identical prompts in flight share one upstream call
+    """
+
+    def __init__(self, max_concurrency: int, rate: float = LLM_RATE_PER_SEC, burst: int = LLM_BURST):
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._active = 0
+        self._queues = {p: OrderedDict() for p in PRIORITIES}  # user -> deque[(future, enqueued_at)]
+        self._wakeup = None
+        self._inflight = {}
+        self.stats = {"dispatched": 0, "deduplicated": 0, "rate_limited": 0}
+
+    # --- slots ---
+    def waiting(self) -> dict:
+        return {p: sum(len(q) for q in users.values()) for p, users in self._queues.items()}
+
+    def slot(self, user=None, priority: int = PRIORITY_INTERACTIVE):
+        return _Slot(self, user, priority)
+
+    async def acquire(self, user=None, priority: int = PRIORITY_INTERACTIVE):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        users = self._queues[priority if priority in self._queues else PRIORITY_BACKGROUND]
+        users.setdefault(str(user), deque()).append((future, time.monotonic()))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # слот уже выдан, но ждать его некому
+            raise
+
+    def release(self):
+        self._active -= 1
+        self._dispatch()
+
+    def pause(self, seconds: float):
+        """
+        Holds all dispatching for `seconds` (OpenRouter answered 429 / Retry-After).
+        """
+        self.stats["rate_limited"] += 1
+        until = time.monotonic() + seconds
+        if until > self._paused_until:
+            self._paused_until = until
+            logger.warning("OpenRouter rate limit: pausing LLM requests for %.1fs", seconds)
+
+    def _refill(self, now: float):
+        if self.rate <= 0:
+            self._tokens = float(self.burst)
+            return
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _schedule_wakeup(self, delay: float):
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+        self._wakeup = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    def _next_waiter(self):
+        now = time.monotonic()
+        best = None
+        for priority, users in self._queues.items():
+            while users:
+                user, queue = next(iter(users.items()))
+                future, enqueued_at = queue[0]
+                if future.cancelled():
+                    queue.popleft()
+                    if not queue:
+                        del users[user]
+                    continue
+                aged = priority - (now - enqueued_at) / LLM_PRIORITY_AGING if LLM_PRIORITY_AGING > 0 else priority
+                if best is None or aged < best[0]:
+                    best = (aged, priority, user)
+                break
+        if best is None:
+            return None
+        _aged, priority, user = best
+        users = self._queues[priority]
+        queue = users[user]
+        future, _enqueued = queue.popleft()
+        if queue:
+            users.move_to_end(user)  # следующий запрос этого пользователя – после остальных
+        else:
+            del users[user]
+        return future
+
+    def _dispatch(self):
+        while self._active < self.max_concurrency:
+            now = time.monotonic()
+            if not any(self._queues.values()):
+                return
+            if now < self._paused_until:
+                self._schedule_wakeup(self._paused_until - now)
+                return
+            self._refill(now)
+            if self._tokens < 1:
+                self._schedule_wakeup((1 - self._tokens) / self.rate)
+                return
+            future = self._next_waiter()
+            if future is None:
+                return
+            self._tokens -= 1
+            self._active += 1
+            self.stats["dispatched"] += 1
+            future.set_result(None)
+
+    # --- single-flight ---
+    async def single_flight(self, key, factory):
+        """
+        Runs `factory()` once per key at a time, as a task of its own; concurrent
+        callers with the same key await the same result. A cancelled caller does
+        not cancel the others – the call itself is cancelled only when nobody
+        waits for it any more.
+        """
+        flight = self._inflight.get(key)
+        if flight is None:
+            task = asyncio.get_running_loop().create_task(factory())
+            flight = self._inflight[key] = [task, 0]   # [задача, сколько её ждут]
+            task.add_done_callback(lambda t: self._landed(key, flight))
+        else:
+            self.stats["deduplicated"] += 1
+        task = flight[0]
+        flight[1] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and flight[1] == 1:
+                task.cancel()   # отменили последнего ждущего
+            raise
+        finally:
+            flight[1] -= 1
+
+    def _landed(self, key, flight):
+        if self._inflight.get(key) is flight:
+            del self._inflight[key]
+        task = flight[0]
+        if not task.cancelled():
+            task.exception()   # иначе "exception was never retrieved", если никто уже не ждёт
+
+class _Slot:
+    def __init__(self, scheduler: LLMScheduler, user, priority: int):
+        self.scheduler = scheduler
+        self.user = user
+        self.priority = priority
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.user, self.priority)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.scheduler.release()
+        return False
+
+_schedulers = {}
+
+def get_scheduler(max_concurrency: int) -> LLMScheduler:
+    """
+    Scheduler of the running event loop (asyncio primitives are bound to a loop).
+    """
+    loop = asyncio.get_running_loop()
+    scheduler = _schedulers.get(loop)
+    if scheduler is None:
+        for old in [l for l in _schedulers if l.is_closed()]:
+            del _schedulers[old]
+        scheduler = _schedulers[loop] = LLMScheduler(max_concurrency)
+    return scheduler
+
+def current_scheduler() -> LLMScheduler | None:
+    """
+    Most recently created scheduler (for metrics), without creating one.
+    """
+    return next(reversed(_schedulers.values()), None) if _schedulers else None
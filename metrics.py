@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+trace_logger = logging.getLogger("trace")
+
+# ----------------------------
+# Settings
+# ----------------------------
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))   # 0 – не поднимать HTTP-эндпоинт
+TRACE_LOG = os.getenv("TRACE_LOG", "0") == "1"          # JSON-строка на каждый замер
+
+# Секунды: от быстрых стадий (FAISS, гейты) до долгих (LLM, загрузка индекса)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# ----------------------------
+# Registry
+# ----------------------------
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+_help = {}
+_collectors = []
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+def describe(name: str, text: str):
+    _help[name] = text
+
+def inc(name: str, value: float = 1, **labels):
+    """
+    Adds `value` to a counter, e.g. inc("rag_refusals_total", gate="overlap").
+    """
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name: str, value: float, **labels):
+    key = (name, _labels(labels))
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [0] * len(DEFAULT_BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(DEFAULT_BUCKETS):
+            if value <= bound:
+                hist[i] += 1
+        hist[-2] += value
+        hist[-1] += 1
+
+def trace(event: str, **fields):
+    """
+    Structured trace line (TRACE_LOG=1), one JSON object per event.
+    """
+    if TRACE_LOG:
+        trace_logger.info(json.dumps({"ts": round(time.time(), 3), "event": event, **fields}, ensure_ascii=False, default=str))
+
+@contextmanager
+def timer(stage: str, **labels):
+    """
+    Times a block into the `stage_seconds{stage=...}` histogram.
+    Works the same in sync and async code.
+    """
+    t0 = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - t0
+        observe("stage_seconds", elapsed, stage=stage, **labels)
+        trace("stage", stage=stage, ms=round(elapsed * 1000, 2), status=status, **labels)
+
+def register_collector(collect):
+    """
+    `collect()` returns [(name, value, labels_dict), ...] read at scrape time –
+    for gauges that already live elsewhere (cache sizes, hit rates, ...).
+    """
+    _collectors.append(collect)
+
+# ----------------------------
+# Prometheus text format
+# ----------------------------
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _fmt_labels(labels: tuple, extra: tuple = ()) -> str:
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+def render() -> str:
+    lines = []
+    seen = set()
+
+    def header(name: str, kind: str):
+        if name in seen:
+            return
+        seen.add(name)
+        if name in _help:
+            lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((k, list(v)) for k, v in _histograms.items())
+
+    for (name, labels), value in counters:
+        header(name, "counter")
+        lines.append(f"{name}{_fmt_labels(labels)} {value}")
+
+    for (name, labels), hist in histograms:
+        header(name, "histogram")
+        for bound, count in zip(DEFAULT_BUCKETS, hist):
+            lines.append(f"{name}_bucket{_fmt_labels(labels, (('le', str(bound)),))} {count}")
+        lines.append(f"{name}_bucket{_fmt_labels(labels, (('le', '+Inf'),))} {hist[-1]}")
+        lines.append(f"{name}_sum{_fmt_labels(labels)} {hist[-2]}")
+        lines.append(f"{name}_count{_fmt_labels(labels)} {hist[-1]}")
+
+    for collect in list(_collectors):
+        try:
+            samples = collect()
+        except Exception:
+            logger.exception("Metrics collector failed")
+            continue
+        for name, value, labels in samples:
+            header(name, "gauge")
+            lines.append(f"{name}{_fmt_labels(_labels(labels or {}))} {value}")
+
+    return "\n".join(lines) + "\n"
+
+# ----------------------------
+# HTTP endpoint
+# ----------------------------
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+_server = None
+
+def start_http_server(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    """
+    Serves /metrics from a daemon thread. Does nothing if port is 0 or it is already running.
+    """
+    global _server
+    if not port or _server is not None:
+        return _server
+    try:
+        _server = ThreadingHTTPServer((host, port), _Handler)
+    except OSError as e:
+        logger.warning("Metrics endpoint on %s:%d not started: %s", host, port, e)
+        return None
+    threading.Thread(target=_server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info("Metrics endpoint on http://%s:%d/metrics", host, port)
+    return _server
+
+def stop_http_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+
+describe("stage_seconds", "Time spent per request stage")
+describe("rag_refusals_total", "RAG answers refused, by gate")
+describe("llm_fallbacks_total", "Requests moved on to the next model")
+describe("llm_tokens_total", "Tokens reported by OpenRouter usage")
+describe("llm_requests_total", "LLM requests by model and outcome")
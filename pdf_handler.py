@@ -1,16 +1,29 @@
 import os
+import time
+import asyncio
+import logging
 import fitz
-import docx
 from uuid import uuid4
 from dotenv import load_dotenv
-import requests
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain.docstore.document import Document
 
+from ann_index import max_l2_distance
+from index_manager import DEFAULT_TENANT, IndexRegistry, get_embeddings, loaded_embeddings
+from embedding_cache import CachedEmbeddings
+from answer_cache import ANSWER_CACHE, AnswerCache, AnswerKey
+from summarizer import summarize_texts
+from context_packer import pack_context
+from citation_index import CITATIONS, format_sources, span_from_metadata, verify_quotes
+from reranker import RAG_MIN_RERANK_SCORE, RERANK_CANDIDATES, get_reranker
+from llm_client import call_openrouter, acall_openrouter, astream_openrouter, is_error_reply, join_reply
+from llm_scheduler import PRIORITY_BACKGROUND
+import metrics
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # ----------------------------
 # Storage (files + FAISS index)
 # ----------------------------
@@ -28,15 +41,79 @@ def save_file(file_bytes, original_filename: str) -> str:
     return filepath
 
 # ----------------------------
-# Text extraction
+# Text extraction (streaming: page / block at a time)
 # ----------------------------
+TEXT_BLOCK_CHARS = int(os.getenv("TEXT_BLOCK_CHARS", "20000"))
+
+def count_pdf_pages(filepath: str) -> int:
+    with fitz.open(filepath) as doc:
+        return len(doc)
+
+def iter_pdf_pages(filepath: str, start: int = 0, stop: int | None = None):
+    """
+    Yields (page_number, text) one page at a time; page_number is 1-based.
+    """
+    with fitz.open(filepath) as doc:
+        stop = len(doc) if stop is None else min(stop, len(doc))
+        for i in range(start, stop):
+            yield i + 1, doc[i].get_text()
+
+def iter_docx_blocks(filepath: str, block_chars: int = TEXT_BLOCK_CHARS):
+    """
+    Yields (None, text) blocks of whole paragraphs, about block_chars each.
+    Blocks keep the line break after their last paragraph, so together they
+    are exactly the document text (chunk offsets stay right across blocks).
+    """
+    import docx  # python-docx нужен только для DOCX – не грузим его на старте
+
+    doc = docx.Document(filepath)
+    buf, size = [], 0
+    for para in doc.paragraphs:
+        buf.append(para.text)
+        size += len(para.text) + 1
+        if size >= block_chars:
+            yield None, "\n".join(buf) + "\n"
+            buf, size = [], 0
+    if buf:
+        yield None, "\n".join(buf)
+
+def iter_txt_blocks(filepath: str, block_chars: int = TEXT_BLOCK_CHARS):
+    """
+    Yields (None, text) blocks of about block_chars, cut after a line break
+    (which stays in the block, so the blocks add up to the file exactly).
+    """
+    with open(filepath, "r", encoding="utf-8") as f:
+        tail = ""
+        while True:
+            data = f.read(block_chars)
+            if not data:
+                break
+            data = tail + data
+            cut = data.rfind("\n")
+            if cut <= 0:
+                tail = ""
+                yield None, data
+            else:
+                tail = data[cut + 1:]
+                yield None, data[:cut + 1]
+        if tail:
+            yield None, tail
+
+def iter_pages_from_file(filepath: str):
+    lower = filepath.lower()
+    if lower.endswith(".pdf"):
+        return iter_pdf_pages(filepath)
+    if lower.endswith(".docx"):
+        return iter_docx_blocks(filepath)
+    if lower.endswith(".txt"):
+        return iter_txt_blocks(filepath)
+    raise ValueError("❌ Поддерживаются только PDF, DOCX и TXT файлы.")
+
 def extract_text_from_pdf(filepath: str) -> str:
-    doc = fitz.open(filepath)
-    return "".join(page.get_text() for page in doc)
+    return "".join(text for _page, text in iter_pdf_pages(filepath))
 
 def extract_text_from_docx(filepath: str) -> str:
-    doc = docx.Document(filepath)
-    return "\n".join(para.text for para in doc.paragraphs)
+    return "".join(text for _page, text in iter_docx_blocks(filepath))
 
 def extract_text_from_txt(filepath: str) -> str:
     with open(filepath, "r", encoding="utf-8") as f:
@@ -52,97 +129,202 @@ def extract_text_from_file(filepath: str) -> str:
         return extract_text_from_txt(filepath)
     raise ValueError("❌ Поддерживаются только PDF, DOCX и TXT файлы.")
 
+def extract_pages_from_file(filepath: str) -> list[tuple[int | None, str]]:
+    """
+    Like extract_text_from_file, but keeps page boundaries:
+    [(page_number, text), ...]; page_number is None for DOCX/TXT.
+    Loads everything at once – prefer iter_pages_from_file for big files.
+    """
+    return list(iter_pages_from_file(filepath))
+
 # ----------------------------
 # Vector index (FAISS)
 # ----------------------------
-_EMBED_MODEL = os.getenv("EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
-
-def index_text_with_faiss(text: str):
-    splitter = RecursiveCharacterTextSplitter(chunk_size=300, chunk_overlap=50)
-    chunks = splitter.split_text(text)
-    documents = [Document(page_content=chunk) for chunk in chunks]
-
-    embeddings = HuggingFaceEmbeddings(model_name=_EMBED_MODEL)
-    vectorstore = FAISS.from_documents(documents, embedding=embeddings)
-    vectorstore.save_local(INDEX_DIR)
-    return vectorstore
-
-def load_existing_index():
-    index_file = os.path.join(INDEX_DIR, "index.faiss")
-    if not os.path.exists(index_file):
-        return None
-    embeddings = HuggingFaceEmbeddings(model_name=_EMBED_MODEL)
-    return FAISS.load_local(INDEX_DIR, embeddings, allow_dangerous_deserialization=True)
+# Модель эмбеддингов и индексы живут в памяти процесса, а не грузятся на каждый запрос.
+# У каждого чата (tenant) свой индекс в INDEX_DIR/<tenant>.
+index_registry = IndexRegistry(INDEX_DIR)
 
 # ----------------------------
-# OpenRouter LLM (robust routing)
+# Warm-up (before the first update)
 # ----------------------------
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+WARMUP_INDEXES = int(os.getenv("WARMUP_INDEXES", "8"))  # сколько последних индексов грузить заранее
 
-DEFAULT_MODELS = [
-    "deepseek/deepseek-chat-v3-0324",  # stable id (may require credits)
-    "deepseek/deepseek-chat",          # alias / fallback
-]
+def warm_up_model() -> float:
+    """
+    Loads the embedding model (and the reranker, if configured) and runs one
+    inference, which is noticeably slower than the following ones.
+    """
+    t0 = time.perf_counter()
+    get_embeddings().embed_query("warm-up")
+    reranker = get_reranker()
+    if reranker is not None:
+        reranker.model.predict([("warm-up", "warm-up")], show_progress_bar=False)
+    return time.perf_counter() - t0
+
+def warm_up_indexes(limit: int = WARMUP_INDEXES) -> int:
+    """
+    Loads the most recently updated tenant indexes while they fit the memory budget.
+    Returns how many were loaded.
+    """
+    tenants = []
+    for name in os.listdir(INDEX_DIR):
+        path = os.path.join(INDEX_DIR, name)
+        if os.path.isdir(path) and not name.endswith(".tmp"):
+            current = os.path.join(path, "CURRENT")
+            tenants.append((os.path.getmtime(current if os.path.exists(current) else path), name))
+    loaded = 0
+    for _mtime, tenant in sorted(tenants, reverse=True)[:limit]:
+        if index_registry.get(tenant).get() is not None:
+            loaded += 1
+        if index_registry.resident_bytes() >= index_registry.budget_bytes:
+            break
+    return loaded
+
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))
+
+def iter_chunks(pages, doc_id: str, filename: str, start: int = 0):
+    """
+    pages -> Documents, one page at a time. Each chunk keeps its page number
+    and character span (start/end in the page text; for DOCX/TXT, which have
+    no pages, in the text of the whole document).
+    """
+    splitter = RecursiveCharacterTextSplitter(chunk_size=300, chunk_overlap=50)
+    n = start
+    base = 0
+    for page, text in pages:
+        pos = 0
+        for chunk in splitter.split_text(text):
+            # сплиттер возвращает подстроки текста (с overlap) – ищем от предыдущего начала
+            at = text.find(chunk, pos)
+            if at >= 0:
+                pos = at + 1
+            metadata = {"doc_id": doc_id, "filename": filename, "page": page, "chunk": n}
+            if at >= 0:
+                metadata["start"] = base + at
+                metadata["end"] = base + at + len(chunk)
+            yield Document(page_content=chunk, metadata=metadata)
+            n += 1
+        if page is None:
+            base += len(text)
+
+def chunk_pages(pages, doc_id: str, filename: str) -> list[Document]:
+    return list(iter_chunks(pages, doc_id, filename))
+
+def iter_batches(items, size: int):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def index_document(pages, filename: str, doc_id: str | None = None, tenant=None) -> str | None:
+    """
+    Adds one document to the knowledge base without touching the others.
+    `pages` may be any iterable (e.g. iter_pages_from_file): it is chunked,
+    embedded and indexed batch by batch, so memory stays bounded.
+    Returns doc_id (None if the document is empty).
+    """
+    doc_id = doc_id or new_doc_id()
+    batches = ((batch, None) for batch in iter_batches(iter_chunks(pages, doc_id, filename), EMBED_BATCH_SIZE))
+    if not index_chunk_batches(batches, filename, doc_id, tenant=tenant):
+        return None
+    return doc_id
 
-def _models_from_env():
-    raw = os.getenv("OPENROUTER_MODELS", "").strip()
-    if not raw:
-        return DEFAULT_MODELS
-    return [m.strip() for m in raw.split(",") if m.strip()]
+def index_file(filepath: str, filename: str, doc_id: str | None = None, tenant=None) -> str | None:
+    return index_document(iter_pages_from_file(filepath), filename, doc_id=doc_id, tenant=tenant)
 
-OPENROUTER_MODELS = _models_from_env()
+def new_doc_id() -> str:
+    return uuid4().hex[:8]
 
-HEADERS = {
-    "Authorization": f"Bearer {OPENROUTER_API_KEY}" if OPENROUTER_API_KEY else "",
-    "Content-Type": "application/json",
-    "HTTP-Referer": os.getenv("OPENROUTER_REFERER", "http://localhost"),
-    "X-Title": os.getenv("OPENROUTER_APP_NAME", "BizSense"),
-}
+def embed_chunks(documents: list[Document]) -> list[list[float]]:
+    return get_embeddings().embed_documents([d.page_content for d in documents])
 
-OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
+def index_chunks(documents: list[Document], filename: str, doc_id: str, tenant=None, vectors=None):
+    """
+    Adds already chunked (and optionally embedded) documents to the tenant's index.
+    """
+    return index_chunk_batches([(documents, vectors)], filename, doc_id, tenant=tenant)
 
-def call_openrouter(messages, temperature: float = 0.3, max_tokens: int | None = None) -> str:
+def index_chunk_batches(batches, filename: str, doc_id: str, tenant=None, replace_filename: bool = True) -> list[str]:
     """
-    Tries models in OPENROUTER_MODELS until one responds successfully.
-    Returns assistant text or a readable error message.
+    Streams (documents, vectors_or_None) batches into the tenant's index.
+    Returns the chunk ids.
     """
-    if not OPENROUTER_API_KEY:
-        return "Ошибка: не задан OPENROUTER_API_KEY в переменных окружения."
+    chunk_ids = index_registry.get(tenant).add_document_batches(doc_id, filename, batches, replace_filename=replace_filename)
+    index_registry.enforce_budget(keep=tenant)
+    _invalidate_answers(tenant)
+    return chunk_ids
+
+def index_text_with_faiss(text: str, filename: str = "document", doc_id: str | None = None, tenant=None):
+    index_document([(None, text)], filename, doc_id=doc_id, tenant=tenant)
+    return load_existing_index(tenant)
+
+def list_documents(tenant=None) -> dict:
+    return index_registry.get(tenant).documents()
 
-    last_err = None
-    for model in OPENROUTER_MODELS:
-        body = {"model": model, "messages": messages, "temperature": temperature}
-        if max_tokens is not None:
-            body["max_tokens"] = max_tokens
+def remove_document(doc_id: str, tenant=None) -> bool:
+    removed = index_registry.get(tenant).remove_document(doc_id)
+    _invalidate_answers(tenant)
+    return removed
 
-        try:
-            resp = requests.post(OPENROUTER_URL, headers=HEADERS, json=body, timeout=60)
-        except Exception as e:
-            last_err = f"Ошибка запроса к LLM: {e}"
-            continue
+def load_existing_index(tenant=None):
+    store = index_registry.get(tenant).get()
+    index_registry.enforce_budget(keep=tenant)
+    return store
 
-        if resp.status_code == 200:
-            data = resp.json()
-            try:
-                return data["choices"][0]["message"]["content"]
-            except Exception:
-                return f"Ошибка разбора ответа LLM: {data}"
+def reset_index(tenant=None) -> bool:
+    existed = index_registry.get(tenant).reset()
+    _invalidate_answers(tenant)
+    return existed
 
-        try:
-            err_json = resp.json()
-        except Exception:
-            err_json = {"raw": resp.text}
+# ----------------------------
+# Answer cache (/askfile)
+# ----------------------------
+answer_cache = AnswerCache()
+
+def _tenant_key(tenant) -> str:
+    return str(tenant) if tenant is not None else DEFAULT_TENANT
+
+def _invalidate_answers(tenant):
+    answer_cache.invalidate(_tenant_key(tenant), keep_version=index_registry.get(tenant).version)
 
-        msg = err_json.get("error", {}).get("message") or str(err_json)
-        last_err = f"Ошибка запроса к LLM ({resp.status_code}) для модели {model}: {msg}"
+def _chunk_key(doc) -> str:
+    meta = doc.metadata or {}
+    if "doc_id" in meta and "chunk" in meta:
+        return f"{meta['doc_id']}:{meta['chunk']}"
+    # старые индексы без метаданных
+    return str(hash(doc.page_content))
 
-        if resp.status_code == 404 and "No endpoints found" in msg:
-            continue  # try next model
+def _remember_answer(cache_key, reply: str):
+    if cache_key is not None and not is_error_reply(reply):
+        answer_cache.put(cache_key, reply)
 
-        break
+def _collect_metrics():
+    """
+    Gauges read from existing stats at /metrics scrape time.
+    """
+    samples = [
+        ("index_resident_bytes", index_registry.resident_bytes(), None),
+        ("index_evictions", index_registry.stats["evictions"], None),
+        ("answer_cache_entries", len(answer_cache), None),
+    ]
+    samples += [("answer_cache_lookups", v, {"result": k}) for k, v in answer_cache.stats.items()]
+    embeddings = loaded_embeddings()  # не грузим модель ради метрик
+    if isinstance(embeddings, CachedEmbeddings):
+        samples += [(f"embedding_cache_{k}", v, None) for k, v in embeddings.stats().items()]
+        embeddings = embeddings.base
+    if hasattr(embeddings, "stats"):
+        samples += [(f"embedding_engine_{k}", v, None) for k, v in embeddings.stats().items()]
+    return samples
 
-    return last_err or "Не удалось получить ответ от LLM."
+metrics.register_collector(_collect_metrics)
 
+# ----------------------------
+# OpenRouter LLM (see llm_client.py)
+# ----------------------------
 DEFAULT_SYSTEM_PROMPT = os.getenv(
     "SYSTEM_PROMPT",
     "Ты – ассистент для ответов по документам. "
@@ -155,13 +337,14 @@ DEFAULT_SYSTEM_PROMPT = os.getenv(
 
 # --- RAG gating (anti-hallucination) ---
 RAG_MIN_CONTEXT_CHARS = int(os.getenv("RAG_MIN_CONTEXT_CHARS", "300"))
-RAG_MAX_L2_DISTANCE = float(os.getenv("RAG_MAX_L2_DISTANCE", "1.1"))
+RAG_MAX_L2_DISTANCE = float(os.getenv("RAG_MAX_L2_DISTANCE", "1.1"))  # для flat; HNSW / IVF-PQ – см. ann_index
 RAG_REFUSAL_TEXT = os.getenv(
     "RAG_REFUSAL_TEXT",
     "В текущей базе документов нет информации для ответа на этот вопрос.\n"
     "Я отвечаю только на основе загруженных материалов. "
     "Уточните запрос или загрузите другой документ."
 )
+NO_INDEX_TEXT = "❌ База знаний не найдена. Пожалуйста, загрузите документ."
 
 def _normalize_ru(s: str) -> str:
     s = s.lower()
@@ -180,6 +363,29 @@ def _has_overlap(question: str, context: str, min_hits: int = 1) -> bool:
     hits = sum(1 for w in set(q_words) if w in c)
     return hits >= min_hits
 
+# --- Hybrid retrieval (FAISS + BM25) ---
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "8"))
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") == "1"
+RRF_K = 60  # стандартная константа reciprocal rank fusion
+
+def _fuse_with_lexical(manager, question: str, vector_hits, k: int = RAG_TOP_K) -> list:
+    """
+    Reciprocal rank fusion of vector hits and BM25 hits; returns top k documents.
+    """
+    lexical_ids = [chunk_id for chunk_id, _score in manager.lexical_search(question, k=k)]
+    fused, docs_by_key = {}, {}
+    ranked_lists = (
+        [doc for doc, _score in vector_hits],
+        manager.get_chunks(lexical_ids),
+    )
+    for ranked in ranked_lists:
+        for rank, doc in enumerate(ranked):
+            key = _chunk_key(doc)
+            docs_by_key[key] = doc
+            fused[key] = fused.get(key, 0.0) + 1.0 / (RRF_K + rank + 1)
+    best = sorted(fused, key=fused.get, reverse=True)[:k]
+    return [docs_by_key[key] for key in best]
+
 def _build_strict_rag_prompt(context: str, question: str) -> str:
     return (
         "Контекст (выдержки из документов):\n"
@@ -193,68 +399,315 @@ def _build_strict_rag_prompt(context: str, question: str) -> str:
         "Ответ:"
     )
 
-def query_index(question: str, announce: bool = False):
-    vectorstore = load_existing_index()
+def _rag_messages(context: str, question: str):
+    full_prompt = _build_strict_rag_prompt(context, question)
+    return [
+        {"role": "system", "content": DEFAULT_SYSTEM_PROMPT},
+        {"role": "user", "content": full_prompt},
+    ]
+
+def _refused(gate: str):
+    metrics.inc("rag_refusals_total", gate=gate)
+    return None, RAG_REFUSAL_TEXT, None, None
+
+def _prepare_rag(question: str, tenant=None, question_vec=None, hits=None):
+    """
+    Retrieval + gating without the LLM call.
+    Returns (messages, None, cache_key, docs) if the LLM should be asked
+    (docs – the retrieved chunks, to check the answer's quotes against),
+    or (None, text, None, None) with a ready reply (no index / refusal / cached answer).
+    `question_vec` / `hits` – already computed by a batch search (_prepare_rag_batch).
+    """
+    with metrics.timer("index_load"):
+        vectorstore = load_existing_index(tenant)
     if not vectorstore:
-        return "❌ База знаний не найдена. Пожалуйста, загрузите документ."
+        return None, NO_INDEX_TEXT, None, None
+    manager = index_registry.get(tenant)
+    # С cross-encoder достаём больше кандидатов, в LLM уйдут лучшие RERANK_TOP_N
+    reranker = get_reranker()
+    k = RERANK_CANDIDATES if reranker is not None else RAG_TOP_K
 
     # 1) Достаём релевантные фрагменты вместе со score (distance)
     # Для FAISS в LangChain обычно это L2-distance: чем меньше, тем лучше.
     try:
-        hits = vectorstore.similarity_search_with_score(question, k=8)
+        if hits is None:
+            with metrics.timer("embed_query"):
+                question_vec = get_embeddings().embed_query(question)
+            with metrics.timer("vector_search", index=manager.index_kind()):
+                hits = manager.similarity_search_with_score(question, k=k, embedding=question_vec)
     except Exception:
         # fallback, если у твоей версии нет with_score
         retriever = vectorstore.as_retriever(search_type="mmr", search_kwargs={"k": 4})
         results = retriever.get_relevant_documents(question)
         context = "\n".join(doc.page_content.strip() for doc in results).strip()
         if len(context) < RAG_MIN_CONTEXT_CHARS:
-            return (("🔍 Ищу ответ...", RAG_REFUSAL_TEXT) if announce else RAG_REFUSAL_TEXT)
-        
-        # если контекст есть – идём в LLM
-        full_prompt = _build_strict_rag_prompt(context, question)
-        messages = [
-            {"role": "system", "content": DEFAULT_SYSTEM_PROMPT},
-            {"role": "user", "content": full_prompt},
-        ]
-        reply = call_openrouter(messages=messages, temperature=0.3)
-        return ("🔍 Ищу ответ...", reply) if announce else reply
+            return _refused("context_length")
 
+        # если контекст есть – идём в LLM
+        return _rag_messages(context, question), None, None, results
 
     # 2) Сбор контекста + проверка качества
     if not hits:
-        return (("🔍 Ищу ответ...", RAG_REFUSAL_TEXT) if announce else RAG_REFUSAL_TEXT)
+        return _refused("no_hits")
 
-    docs = [doc for (doc, _score) in hits]
     scores = [_score for (_doc, _score) in hits]
+    if HYBRID_SEARCH:
+        with metrics.timer("hybrid_fusion"):
+            docs = _fuse_with_lexical(manager, question, hits, k=k)
+    else:
+        docs = [doc for (doc, _score) in hits]
+
+    rerank_best = None
+    if reranker is not None:
+        with metrics.timer("rerank"):
+            ranked = reranker.rerank(question, docs, [_chunk_key(d) for d in docs])
+        docs = [doc for doc, _score in ranked]
+        rerank_best = ranked[0][1] if ranked else 0.0
+    chunk_ids = [_chunk_key(d) for d in docs]
 
     context = "\n".join(d.page_content.strip() for d in docs).strip()
     best_score = min(scores) if scores else 999.0
 
-    # Gate A: контекст слишком короткий (обычно означает "не нашлось")
-    # Gate B: даже лучший score слабый (далеко от вопроса)
-    if len(context) < RAG_MIN_CONTEXT_CHARS or best_score > RAG_MAX_L2_DISTANCE:
-        return (("🔍 Ищу ответ...", RAG_REFUSAL_TEXT) if announce else RAG_REFUSAL_TEXT)
-    min_hits = 0 if len(question.strip()) < 35 else 1
-    if not _has_overlap(question, context, min_hits=min_hits):
-        return (("🔍 Ищу ответ...", RAG_REFUSAL_TEXT) if announce else RAG_REFUSAL_TEXT)
+    with metrics.timer("gates"):
+        # Gate A: контекст слишком короткий (обычно означает "не нашлось")
+        if len(context) < RAG_MIN_CONTEXT_CHARS:
+            return _refused("context_length")
+        # Gate B: даже лучший фрагмент слабо связан с вопросом – по калиброванной
+        # оценке cross-encoder, если он включён, иначе по L2 (порог зависит от типа индекса)
+        if rerank_best is not None:
+            if rerank_best < RAG_MIN_RERANK_SCORE:
+                return _refused("rerank_score")
+        elif best_score > max_l2_distance(RAG_MAX_L2_DISTANCE, manager.index_kind()):
+            return _refused("l2_distance")
+        # Gate C: пересечение терминов вопроса с найденными фрагментами
+        # (по статистике BM25-индекса; для старых индексов – по тексту)
+        min_hits = 0 if len(question.strip()) < 35 else 1
+        overlap = manager.lexical_overlap(question, chunk_ids)
+        if overlap is None:
+            if not _has_overlap(question, context, min_hits=min_hits):
+                return _refused("overlap")
+        elif overlap < min_hits:
+            return _refused("overlap")
+
+    # 3) Тот же вопрос по тем же фрагментам уже задавали – отвечаем из кэша
+    cache_key = None
+    if ANSWER_CACHE:
+        cache_key = AnswerKey(
+            _tenant_key(tenant), manager.version, _normalize_ru(question),
+            chunk_ids, question_vec,
+        )
+        cached = answer_cache.get(cache_key)
+        if cached is not None:
+            metrics.inc("answer_cache_hits_total")
+            return None, cached, None, None
+
+    # 4) Есть релевантный контекст – склеиваем соседние фрагменты, убираем дубли,
+    # укладываемся в бюджет токенов и зовём LLM
+    with metrics.timer("context_packing"):
+        # векторы чанков берём из самого индекса, а не считаем заново
+        packed = pack_context(docs, vectors=manager.chunk_vectors(chunk_ids))
+    metrics.inc("rag_context_tokens_total", packed.tokens)
+    metrics.inc("rag_prompt_tokens_saved_total", packed.tokens_saved)
+    metrics.trace("context_packed", tokens=packed.tokens, tokens_before=packed.tokens_before,
+                  spans=packed.spans, duplicates=packed.dropped_duplicates)
+    logger.debug(
+        "Context: %d -> %d tokens (saved %d, %d spans, %d duplicates dropped)",
+        packed.tokens_before, packed.tokens, packed.tokens_saved, packed.spans, packed.dropped_duplicates,
+    )
+    return _rag_messages(packed.text, question), None, cache_key, docs
+
+def _citations(reply: str, docs, tenant=None) -> list:
+    """
+    Every quote of the reply, looked up in the retrieved chunks, with its
+    file and page from the span table (no LLM calls).
+    """
+    if not CITATIONS or not docs or is_error_reply(reply):
+        return []
+    with metrics.timer("citation_check"):
+        keys = [_chunk_key(d) for d in docs]
+        spans = index_registry.get(tenant).chunk_spans(keys)
+        sources = [(d.page_content, spans.get(key) or span_from_metadata(d.metadata)) for key, d in zip(keys, docs)]
+        citations = verify_quotes(reply, sources)
+    for c in citations:
+        metrics.inc("citation_quotes_total", result="verified" if c.verified else "unverified")
+    if citations:
+        metrics.trace("citations", quotes=len(citations), verified=sum(c.verified for c in citations))
+    return citations
+
+def _cite(reply: str, docs, tenant=None) -> str:
+    """
+    "📄 Источники" footer for the reply ("" if it has no quotes).
+    """
+    return format_sources(_citations(reply, docs, tenant))
+
+def query_index(question: str, announce: bool = False, tenant=None):
+    messages, early, cache_key, docs = _prepare_rag(question, tenant)
+    if early is not None:
+        if early == NO_INDEX_TEXT:
+            return early
+        # отказ или ответ из кэша – в той же форме, что и свежий ответ
+        return ("🔍 Ищу ответ...", early) if announce else early
 
-    # 3) Есть релевантный контекст – зовём LLM
-    full_prompt = _build_strict_rag_prompt(context, question)
-    messages = [
-        {"role": "system", "content": DEFAULT_SYSTEM_PROMPT},
-        {"role": "user", "content": full_prompt},
-    ]
-    
     reply = call_openrouter(messages=messages, temperature=0.3)
+    if not is_error_reply(reply):
+        reply += _cite(reply, docs, tenant)
+        _remember_answer(cache_key, reply)
     return ("🔍 Ищу ответ...", reply) if announce else reply
 
-def summarize_pdf(announce: bool = False):
-    vectorstore = load_existing_index()
+async def aquery_index(question: str, tenant=None) -> str:
+    """
+    Non-blocking query_index for the bot: retrieval runs in a worker thread,
+    the LLM call goes through the pooled async client.
+    """
+    messages, early, cache_key, docs = await asyncio.to_thread(_prepare_rag, question, tenant)
+    if early is not None:
+        return early
+    reply = await acall_openrouter(messages=messages, temperature=0.3, user=_tenant_key(tenant))
+    if is_error_reply(reply):
+        return reply
+    reply += await asyncio.to_thread(_cite, reply, docs, tenant)
+    _remember_answer(cache_key, reply)
+    return reply
+
+async def astream_query_index(question: str, tenant=None):
+    """
+    Same as aquery_index, but yields the answer as text deltas.
+    Refusals, cached answers and errors arrive as a single piece;
+    the sources footer comes last, once the whole answer can be checked.
+    """
+    messages, early, cache_key, docs = await asyncio.to_thread(_prepare_rag, question, tenant)
+    if early is not None:
+        yield early
+        return
+    parts = []
+    async for delta in astream_openrouter(messages=messages, temperature=0.3, user=_tenant_key(tenant)):
+        parts.append(delta)
+        yield delta
+    reply = join_reply(parts)
+    if is_error_reply(reply):
+        return
+    footer = await asyncio.to_thread(_cite, reply, docs, tenant)
+    if footer:
+        parts.append(footer)
+        yield footer
+    _remember_answer(cache_key, "".join(parts))
+
+# ----------------------------
+# Batch questions (checklists)
+# ----------------------------
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))   # одновременных запросов к LLM на один пакет
+
+def _prepare_rag_batch(questions: list[str], tenant=None) -> list | None:
+    """
+    _prepare_rag for many questions: all of them are embedded in one batch and
+    searched in one FAISS call; gates, cache and packing then run per question.
+    Returns None if the tenant has no index.
+    """
+    with metrics.timer("index_load"):
+        if not load_existing_index(tenant):
+            return None
+    manager = index_registry.get(tenant)
+    k = RERANK_CANDIDATES if get_reranker() is not None else RAG_TOP_K
+    with metrics.timer("embed_batch"):
+        vectors = get_embeddings().embed_queries(questions)
+    with metrics.timer("vector_search_batch", index=manager.index_kind()):
+        hits = manager.similarity_search_batch(vectors, k=k)
+    return [
+        _prepare_rag(question, tenant, question_vec=vec, hits=question_hits)
+        for question, vec, question_hits in zip(questions, vectors, hits)
+    ]
+
+async def aquery_index_batch(questions: list[str], tenant=None, concurrency: int = BATCH_CONCURRENCY, on_progress=None):
+    """
+    Answers a list of questions against the tenant's documents.
+    Retrieval is batched (see _prepare_rag_batch), LLM calls run at most
+    `concurrency` at a time with background priority, so a long checklist does
+    not hold up interactive /askfile requests. `on_progress(done, total)` is
+    awaited after every answer.
+    Returns [{"question", "status", "answer", "citations", "seconds"}, ...]
+    in input order (status: answered / refused / error; seconds – LLM time,
+    0 for refusals and cached answers), or None without an index.
+    """
+    prepared = await asyncio.to_thread(_prepare_rag_batch, questions, tenant)
+    if prepared is None:
+        return None
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    done = 0
+
+    async def answer(question, messages, early, cache_key, docs):
+        nonlocal done
+        citations = []
+        seconds = 0.0
+        if early is not None:
+            reply = early
+        else:
+            async with semaphore:
+                t0 = time.perf_counter()
+                reply = await acall_openrouter(
+                    messages=messages, temperature=0.3, user=_tenant_key(tenant), priority=PRIORITY_BACKGROUND,
+                )
+                seconds = time.perf_counter() - t0
+            if not is_error_reply(reply):
+                citations = await asyncio.to_thread(_citations, reply, docs, tenant)
+                _remember_answer(cache_key, reply + format_sources(citations))
+        if is_error_reply(reply):
+            status = "error"
+        elif reply == RAG_REFUSAL_TEXT or reply.startswith("В документах это не найдено"):
+            status = "refused"
+        else:
+            status = "answered"
+        metrics.inc("batch_questions_total", status=status)
+        done += 1
+        if on_progress is not None:
+            await on_progress(done, len(questions))
+        return {
+            "question": question, "status": status, "answer": reply,
+            "citations": citations, "seconds": seconds,
+        }
+
+    return await asyncio.gather(*(answer(q, *prep) for q, prep in zip(questions, prepared)))
+
+# ----------------------------
+# Summaries (precomputed at ingest, MMR fallback)
+# ----------------------------
+PRECOMPUTE_SUMMARIES = os.getenv("PRECOMPUTE_SUMMARIES", "1") == "1"
+
+async def precompute_summary(doc_id: str, tenant=None) -> bool:
+    """
+    Map-reduce summary of the whole document, stored next to the tenant's index.
+    """
+    manager = index_registry.get(tenant)
+    texts = await asyncio.to_thread(manager.chunk_texts, doc_id)
+    if not texts:
+        return False
+    # фоновая задача – уступает интерактивным запросам к LLM
+    summary = await summarize_texts(texts, DEFAULT_SYSTEM_PROMPT, user=_tenant_key(tenant), priority=PRIORITY_BACKGROUND)
+    return await asyncio.to_thread(manager.set_summary, doc_id, summary)
+
+def _precomputed_summary(tenant=None) -> str | None:
+    """
+    Ready summary covering every document of the tenant, or None
+    if some document has none yet (still being summarized, old index).
+    """
+    manager = index_registry.get(tenant)
+    docs = manager.documents()
+    summaries = manager.summaries()
+    if not docs or set(docs) - set(summaries):
+        return None
+    if len(docs) == 1:
+        return next(iter(summaries.values()))["summary"]
+    ordered = sorted(docs, key=lambda d: docs[d].get("added_at", 0))
+    return "\n\n".join(f"### {docs[d]['filename']}\n{summaries[d]['summary']}" for d in ordered)
+
+_SUMMARY_QUERY = "Основное содержание документа, тезисы, выводы"
+
+def _summary_messages(tenant=None):
+    vectorstore = load_existing_index(tenant)
     if not vectorstore:
-        return "❌ Индекс не найден. Пожалуйста, загрузите документ."
+        return None
 
     retriever = vectorstore.as_retriever(search_type="mmr", search_kwargs={"k": 6})
-    results = retriever.get_relevant_documents("Основное содержание документа, тезисы, выводы")
+    results = retriever.get_relevant_documents(_SUMMARY_QUERY)
 
     text = "\n".join(doc.page_content.strip() for doc in results)
     prompt = (
@@ -263,9 +716,42 @@ def summarize_pdf(announce: bool = False):
         f"{text}"
     )
 
-    messages = [
+    return [
         {"role": "system", "content": DEFAULT_SYSTEM_PROMPT},
         {"role": "user", "content": prompt},
     ]
+
+def summarize_pdf(announce: bool = False, tenant=None):
+    ready = _precomputed_summary(tenant)
+    if ready is not None:
+        return ("📖 Пересказываю текст...", ready) if announce else ready
+
+    messages = _summary_messages(tenant)
+    if messages is None:
+        return "❌ Индекс не найден. Пожалуйста, загрузите документ."
+
     reply = call_openrouter(messages=messages, temperature=0.3)
     return ("📖 Пересказываю текст...", reply) if announce else reply
+
+async def asummarize_pdf(tenant=None) -> str:
+    ready = await asyncio.to_thread(_precomputed_summary, tenant)
+    if ready is not None:
+        return ready
+
+    messages = await asyncio.to_thread(_summary_messages, tenant)
+    if messages is None:
+        return "❌ Индекс не найден. Пожалуйста, загрузите документ."
+    return await acall_openrouter(messages=messages, temperature=0.3, user=_tenant_key(tenant))
+
+async def astream_summarize_pdf(tenant=None):
+    ready = await asyncio.to_thread(_precomputed_summary, tenant)
+    if ready is not None:
+        yield ready
+        return
+
+    messages = await asyncio.to_thread(_summary_messages, tenant)
+    if messages is None:
+        yield "❌ Индекс не найден. Пожалуйста, загрузите документ."
+        return
+    async for delta in astream_openrouter(messages=messages, temperature=0.3, user=_tenant_key(tenant)):
+        yield delta
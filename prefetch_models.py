@@ -0,0 +1,35 @@
+"""
+Downloads the models the bot loads at startup into the local caches
+(HF_HOME for Hugging Face, TIKTOKEN_CACHE_DIR for tiktoken), so that a
+container built with them starts without going to the network.
+
+    HF_HOME=/opt/models/hf python prefetch_models.py
+"""
+import os
+import time
+
+from embedding_engine import EmbeddingEngine
+from reranker import RERANK_MODEL
+from context_packer import TIKTOKEN_ENCODING, tiktoken
+
+EMBED_MODEL = os.getenv("EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+
+def main():
+    t0 = time.perf_counter()
+    # тот же бэкенд, что и в боте (torch / onnx): скачиваются именно нужные файлы
+    EmbeddingEngine(EMBED_MODEL).embed_documents(["prefetch"])
+    print(f"{EMBED_MODEL}: {time.perf_counter() - t0:.1f}s")
+
+    if RERANK_MODEL:
+        from sentence_transformers import CrossEncoder
+
+        t0 = time.perf_counter()
+        CrossEncoder(RERANK_MODEL, device="cpu")
+        print(f"{RERANK_MODEL}: {time.perf_counter() - t0:.1f}s")
+
+    if tiktoken is not None:
+        tiktoken.get_encoding(TIKTOKEN_ENCODING)
+        print(f"tiktoken {TIKTOKEN_ENCODING}: ok")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import os
+import math
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# ----------------------------
+# Settings
+# ----------------------------
+# Пусто – rerank выключен. Для русского подходит мультиязычная модель,
+# например cross-encoder/mmarco-mMiniLMv2-L12-H384-v1
+RERANK_MODEL = os.getenv("RERANK_MODEL", "").strip()
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "24"))   # сколько кандидатов достаём до rerank
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", "4"))              # сколько отдаём в LLM
+RERANK_BATCH = int(os.getenv("RERANK_BATCH", "16"))
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "20000"))
+# Калибровка (Platt scaling): p = sigmoid(a * logit + b); a, b подбираются на размеченных парах
+RERANK_CALIBRATION_A = float(os.getenv("RERANK_CALIBRATION_A", "1.0"))
+RERANK_CALIBRATION_B = float(os.getenv("RERANK_CALIBRATION_B", "0.0"))
+# Ниже этой вероятности релевантности у лучшего фрагмента – отказ
+RAG_MIN_RERANK_SCORE = float(os.getenv("RAG_MIN_RERANK_SCORE", "0.3"))
+
+def calibrate(logit: float) -> float:
+    z = RERANK_CALIBRATION_A * logit + RERANK_CALIBRATION_B
+    if z < -60:
+        return 0.0
+    return 1.0 / (1.0 + math.exp(-z))
+
+class Reranker:
+    """
+    Local CPU cross-encoder scoring (question, chunk) pairs.
+    Calibrated scores are cached per (question hash, chunk id) in an LRU,
+    so repeated and follow-up questions over the same chunks cost nothing.
+    """
+
+    def __init__(self, model_name: str = RERANK_MODEL, cache_size: int = RERANK_CACHE_SIZE):
+        from sentence_transformers import CrossEncoder
+
+        t0 = time.perf_counter()
+        self.model = CrossEncoder(model_name, device="cpu")
+        logger.info("Rerank model %s loaded in %.2fs", model_name, time.perf_counter() - t0)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._model_lock = threading.Lock()
+        self.stats = {"pairs_scored": 0, "cache_hits": 0}
+
+    @staticmethod
+    def _question_hash(question: str) -> str:
+        return hashlib.sha1(" ".join(question.lower().split()).encode("utf-8")).hexdigest()
+
+    def scores(self, question: str, chunk_ids: list[str], texts: list[str]) -> list[float]:
+        """
+        Calibrated relevance (0..1) of each text to the question.
+        """
+        qh = self._question_hash(question)
+        out = [None] * len(texts)
+        with self._lock:
+            for i, chunk_id in enumerate(chunk_ids):
+                score = self._cache.get((qh, chunk_id))
+                if score is not None:
+                    self._cache.move_to_end((qh, chunk_id))
+                    out[i] = score
+        missing = [i for i, score in enumerate(out) if score is None]
+        self.stats["cache_hits"] += len(texts) - len(missing)
+
+        if missing:
+            pairs = [(question, texts[i]) for i in missing]
+            with self._model_lock:
+                logits = self.model.predict(pairs, batch_size=RERANK_BATCH, show_progress_bar=False)
+            self.stats["pairs_scored"] += len(pairs)
+            with self._lock:
+                for i, logit in zip(missing, logits):
+                    out[i] = calibrate(float(logit))
+                    self._cache[(qh, chunk_ids[i])] = out[i]
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return out
+
+    def rerank(self, question: str, docs: list, chunk_ids: list[str], top_n: int = RERANK_TOP_N) -> list[tuple]:
+        """
+        [(doc, score), ...] best first, at most top_n.
+        """
+        scores = self.scores(question, chunk_ids, [d.page_content for d in docs])
+        ranked = sorted(zip(docs, scores), key=lambda pair: pair[1], reverse=True)
+        return ranked[:top_n]
+
+_reranker = None
+_reranker_lock = threading.Lock()
+
+def get_reranker() -> Reranker | None:
+    """
+    Process-wide reranker, or None if RERANK_MODEL is not set.
+    """
+    global _reranker
+    if not RERANK_MODEL:
+        return None
+    if _reranker is None:
+        with _reranker_lock:
+            if _reranker is None:
+                _reranker = Reranker()
+    return _reranker
@@ -0,0 +1,64 @@
+import os
+import time
+import logging
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Отсчёт – с момента импорта этого модуля (bot.py импортирует его первым)
+_t0 = time.perf_counter()
+_last = _t0
+_stages = []      # [(stage, seconds)]
+_reported = False
+
+def _process_age() -> float | None:
+    """
+    Seconds since the OS started this process (Linux), i.e. including
+    interpreter startup before any of our code ran.
+    """
+    try:
+        with open("/proc/self/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime", "r") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+_interpreter = _process_age()
+
+def mark(stage: str) -> float:
+    """
+    Records the time since the previous mark as `stage`.
+    """
+    global _last
+    now = time.perf_counter()
+    seconds = now - _last
+    _last = now
+    _stages.append((stage, seconds))
+    return seconds
+
+def record(stage: str, seconds: float):
+    """
+    Records a stage measured elsewhere (e.g. in a background thread).
+    """
+    _stages.append((stage, seconds))
+
+def stages() -> dict:
+    result = {"interpreter": _interpreter} if _interpreter is not None else {}
+    result.update(_stages)
+    result["total"] = time.perf_counter() - _t0 + (_interpreter or 0.0)
+    return result
+
+def report() -> dict:
+    """
+    Logs the startup timeline once and exposes it as startup_seconds{stage=...}.
+    """
+    global _reported
+    timings = stages()
+    if not _reported:
+        _reported = True
+        logger.info("Startup: %s", ", ".join(f"{k} {v:.2f}s" for k, v in timings.items()))
+        metrics.register_collector(lambda: [("startup_seconds", v, {"stage": k}) for k, v in timings.items()])
+    return timings
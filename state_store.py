@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# ----------------------------
+# Settings
+# ----------------------------
+# memory – один процесс; sqlite – несколько процессов на одной машине;
+# redis://host:6379/0 – несколько машин
+STATE_STORE = os.getenv("STATE_STORE", "memory")
+STATE_DB = os.getenv("STATE_DB", "./state.db")
+
+class MemoryStateStore:
+    """
+    Key -> JSON-serializable value with optional TTL, in this process only.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at is not None and expires_at < time.time():
+                del self._data[key]
+                return default
+            return json.loads(value)
+
+    def set(self, key: str, value, ttl: float | None = None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (json.dumps(value, ensure_ascii=False), expires_at)
+
+    def pop(self, key: str, default=None):
+        value = self.get(key, default)
+        self.delete(key)
+        return value
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def close(self):
+        pass
+
+class SQLiteStateStore:
+    """
+    Same interface, in an SQLite file (WAL) that several processes can share.
+    """
+
+    def __init__(self, path: str = STATE_DB):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            row = self._db().execute(
+                "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at >= ?)", (key, time.time()),
+            ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key: str, value, ttl: float | None = None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._db().execute(
+                "INSERT INTO kv (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+                (key, json.dumps(value, ensure_ascii=False), expires_at),
+            )
+
+    def pop(self, key: str, default=None):
+        with self._lock:
+            row = self._db().execute(
+                "DELETE FROM kv WHERE key = ? RETURNING value, expires_at", (key,),
+            ).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return default
+        return json.loads(row[0])
+
+    def delete(self, key: str):
+        with self._lock:
+            self._db().execute("DELETE FROM kv WHERE key = ?", (key,))
+            # заодно подчищаем истёкшие ключи
+            self._db().execute("DELETE FROM kv WHERE expires_at < ?", (time.time(),))
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+class RedisStateStore:
+    """
+    Same interface on top of Redis (needs the `redis` package).
+    """
+
+    def __init__(self, url: str, prefix: str = "finpilot:"):
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key: str, default=None):
+        value = self._redis.get(self.prefix + key)
+        return json.loads(value) if value is not None else default
+
+    def set(self, key: str, value, ttl: float | None = None):
+        self._redis.set(self.prefix + key, json.dumps(value, ensure_ascii=False), px=int(ttl * 1000) if ttl else None)
+
+    def pop(self, key: str, default=None):
+        pipe = self._redis.pipeline()
+        pipe.get(self.prefix + key)
+        pipe.delete(self.prefix + key)
+        value, _deleted = pipe.execute()
+        return json.loads(value) if value is not None else default
+
+    def delete(self, key: str):
+        self._redis.delete(self.prefix + key)
+
+    def close(self):
+        self._redis.close()
+
+def open_state_store(spec: str = STATE_STORE):
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStateStore(spec)
+    if spec == "sqlite":
+        return SQLiteStateStore(STATE_DB)
+    if spec.startswith("sqlite:///"):
+        return SQLiteStateStore(spec[len("sqlite:///"):])
+    if spec != "memory":
+        logger.warning("Unknown STATE_STORE %r, using memory", spec)
+    return MemoryStateStore()
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_state_store():
+    """
+    Process-wide store selected by STATE_STORE.
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = open_state_store()
+    return _store
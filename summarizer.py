@@ -0,0 +1,91 @@
+import os
+import asyncio
+import logging
+
+from llm_client import acall_openrouter, is_error_reply
+from llm_scheduler import PRIORITY_BACKGROUND
+
+logger = logging.getLogger(__name__)
+
+# ----------------------------
+# Map-reduce summarization
+# ----------------------------
+SUMMARY_GROUP_CHARS = int(os.getenv("SUMMARY_GROUP_CHARS", "6000"))    # текста на один map-вызов
+SUMMARY_MAX_CONCURRENCY = int(os.getenv("SUMMARY_MAX_CONCURRENCY", "4"))
+SUMMARY_MAX_ROUNDS = int(os.getenv("SUMMARY_MAX_ROUNDS", "4"))
+
+MAP_PROMPT = (
+    "Ниже фрагмент документа. Перечисли 3–6 ключевых фактов, определений и выводов из него. "
+    "Только то, что есть в тексте, коротко.\n\n{text}"
+)
+REDUCE_PROMPT = (
+    "Ниже конспекты последовательных частей одного документа. "
+    "Объедини их, убрав повторы, сохранив ключевые факты и порядок изложения.\n\n{text}"
+)
+FINAL_PROMPT = (
+    "Сделай краткое резюме документа в 7–12 пунктов. "
+    "Укажи ключевые идеи, определения и выводы.\n\n{text}"
+)
+
+class SummaryError(Exception):
+    pass
+
+def group_texts(texts, max_chars: int = SUMMARY_GROUP_CHARS) -> list[str]:
+    """
+    Packs consecutive texts into groups of at most ~max_chars.
+    """
+    groups, buf, size = [], [], 0
+    for text in texts:
+        text = text.strip()
+        if not text:
+            continue
+        if buf and size + len(text) > max_chars:
+            groups.append("\n".join(buf))
+            buf, size = [], 0
+        buf.append(text)
+        size += len(text) + 1
+    if buf:
+        groups.append("\n".join(buf))
+    return groups
+
+async def _ask(prompt: str, system_prompt: str, semaphore: asyncio.Semaphore, user=None,
+               priority: int = PRIORITY_BACKGROUND) -> str:
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt},
+    ]
+    async with semaphore:
+        reply = await acall_openrouter(messages=messages, temperature=0.2, user=user, priority=priority)
+    if is_error_reply(reply):
+        raise SummaryError(reply)
+    return reply
+
+async def summarize_texts(texts, system_prompt: str, user=None, priority: int = PRIORITY_BACKGROUND) -> str:
+    """
+    Map: summarize groups of chunks in parallel (at most SUMMARY_MAX_CONCURRENCY LLM calls).
+    Reduce: merge partial summaries group by group until they fit one call,
+    then write the final 7–12 point summary.
+    `user` / `priority` are passed to the LLM scheduler.
+    """
+    semaphore = asyncio.Semaphore(SUMMARY_MAX_CONCURRENCY)
+
+    def ask(prompt: str):
+        return _ask(prompt, system_prompt, semaphore, user, priority)
+
+    groups = group_texts(texts)
+    if not groups:
+        raise SummaryError("empty document")
+
+    if len(groups) > 1:
+        partials = await asyncio.gather(*(ask(MAP_PROMPT.format(text=g)) for g in groups))
+        groups = group_texts(partials)
+        rounds = 1
+        while len(groups) > 1 and rounds < SUMMARY_MAX_ROUNDS:
+            partials = await asyncio.gather(*(ask(REDUCE_PROMPT.format(text=g)) for g in groups))
+            groups = group_texts(partials)
+            rounds += 1
+        if len(groups) > 1:
+            # не сошлось за SUMMARY_MAX_ROUNDS – берём начало каждого конспекта
+            groups = ["\n".join(g[: SUMMARY_GROUP_CHARS // len(groups)] for g in groups)]
+
+    return await ask(FINAL_PROMPT.format(text=groups[0]))
@@ -0,0 +1,225 @@
+"""
+Webhook serving mode: one front process receives Telegram updates over HTTP and
+hands each one to one of WEBHOOK_WORKERS bot processes, picked by a stable hash
+of the chat id. A chat always lands on the same worker, so its updates stay in
+order and its index is normally written by a single process; the index files
+themselves are still safe to share (see IndexManager), and dialog state / Drive
+tokens live in the shared STATE_STORE.
+
+    WEBHOOK_URL=https://bot.example.com/telegram WEBHOOK_SECRET=... python bot.py
+"""
+import os
+import json
+import zlib
+import queue
+import signal
+import asyncio
+import logging
+import threading
+import multiprocessing as mp
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# ----------------------------
+# Settings
+# ----------------------------
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")   # проверяется по X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", str(os.cpu_count() or 2)))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))   # на воркер; при переполнении – 503
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+def chat_key(update: dict) -> int:
+    """
+    Chat id of a raw update (user id if there is no chat, 0 if neither).
+    """
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        if value.get("from"):
+            return value["from"]["id"]
+    return 0
+
+def worker_for(update: dict, workers: int) -> int:
+    # crc32, а не hash(): у hash() строк своя соль в каждом процессе
+    return zlib.crc32(str(chat_key(update)).encode()) % workers
+
+# ----------------------------
+# Worker process
+# ----------------------------
+def _worker_env(index: int, workers: int) -> dict:
+    """
+    Per-worker environment: split CPU threads between workers, give each its own
+    metrics port, share state through SQLite unless set. The embedding cache
+    directory is shared – EmbeddingCache locks it across processes.
+    """
+    cpus = os.cpu_count() or 2
+    env = {
+        "EMBED_THREADS": os.getenv("EMBED_THREADS") or str(max(1, cpus // workers)),
+        "INGEST_PROCESSES": os.getenv("INGEST_PROCESSES") or str(max(1, cpus // (2 * workers))),
+        "STATE_STORE": os.getenv("STATE_STORE") or "sqlite",
+    }
+    if metrics.METRICS_PORT:
+        env["METRICS_PORT"] = str(metrics.METRICS_PORT + 1 + index)
+    return env
+
+@contextmanager
+def _environ(overrides: dict):
+    """
+    Temporarily sets env vars in this process. A spawned child copies the
+    environment when it starts – and reads settings while importing modules
+    (including the parent's main script), i.e. before its target runs –
+    so overrides have to be in place around Process.start().
+    """
+    saved = {key: os.environ.get(key) for key in overrides}
+    os.environ.update(overrides)
+    try:
+        yield
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+def _worker_main(index: int, workers: int, updates):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # останавливает фронт, присылая None
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "INFO"),
+        format=f"%(asctime)s %(levelname)s worker{index} %(name)s: %(message)s",
+    )
+    import bot
+
+    asyncio.run(_serve_updates(bot, updates))
+
+async def _serve_updates(bot, updates):
+    from telegram import Update
+
+    app = bot.build_application(polling=False)
+    loop = asyncio.get_running_loop()
+    async with app:
+        await bot.on_startup(app)
+        await app.start()
+        try:
+            while True:
+                data = await loop.run_in_executor(None, updates.get)
+                if data is None:
+                    break
+                await app.update_queue.put(Update.de_json(data, app.bot))
+        finally:
+            await app.stop()
+            await bot.on_shutdown(app)
+
+# ----------------------------
+# Front (HTTP -> worker queues)
+# ----------------------------
+class _Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        if server.path and self.path.split("?")[0] != server.path:
+            self._reply(404)
+            return
+        if WEBHOOK_SECRET and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            self._reply(403)
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            update = json.loads(self.rfile.read(length))
+        except ValueError:
+            self._reply(400)
+            return
+        index = worker_for(update, len(server.queues))
+        try:
+            server.queues[index].put(update, timeout=1)
+        except queue.Full:
+            # Telegram повторит доставку позже
+            metrics.inc("webhook_updates_total", worker=index, result="rejected")
+            self._reply(503)
+            return
+        metrics.inc("webhook_updates_total", worker=index, result="accepted")
+        self._reply(200)
+
+    def do_GET(self):
+        alive = sum(1 for p in self.server.processes if p.is_alive())
+        self._reply(200 if alive == len(self.server.processes) else 503, f"workers alive: {alive}\n")
+
+    def _reply(self, status: int, body: str = ""):
+        payload = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug("webhook %s", format % args)
+
+async def _set_webhook(token: str):
+    from telegram import Bot
+
+    async with Bot(token) as tg:
+        await tg.set_webhook(
+            WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET or None,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+
+def serve(workers: int = WEBHOOK_WORKERS):
+    """
+    Registers the webhook, starts the workers and the HTTP front, restarts
+    workers that die, and shuts everything down on SIGINT / SIGTERM.
+    """
+    ctx = mp.get_context("spawn")
+    queues = [ctx.Queue(WEBHOOK_QUEUE_SIZE) for _ in range(workers)]
+    processes = [None] * workers
+
+    def start_worker(i: int):
+        # не daemon: у воркера свой пул процессов для загрузки документов
+        p = ctx.Process(target=_worker_main, args=(i, workers, queues[i]), name=f"bot-worker-{i}")
+        with _environ(_worker_env(i, workers)):
+            p.start()
+        processes[i] = p
+
+    for i in range(workers):
+        start_worker(i)
+
+    asyncio.run(_set_webhook(os.getenv("TELEGRAM_TOKEN")))
+
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), _Handler)
+    server.queues = queues
+    server.processes = processes
+    server.path = urlparse(WEBHOOK_URL).path or None
+    threading.Thread(target=server.serve_forever, name="webhook-http", daemon=True).start()
+    metrics.register_collector(lambda: [("webhook_queue_depth", q.qsize(), {"worker": i}) for i, q in enumerate(queues)])
+    metrics.start_http_server()
+    logger.info("Webhook front on %s:%d, %d workers", WEBHOOK_HOST, WEBHOOK_PORT, workers)
+
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+    while not stop.wait(1.0):
+        for i, p in enumerate(processes):
+            if not p.is_alive():
+                logger.warning("Worker %d exited with %s, restarting", i, p.exitcode)
+                metrics.inc("webhook_worker_restarts_total", worker=i)
+                start_worker(i)
+
+    server.shutdown()
+    server.server_close()
+    for q in queues:
+        q.put(None)
+    for p in processes:
+        p.join(timeout=30)
+        if p.is_alive():
+            p.terminate()
+    metrics.stop_http_server()